@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import logging
+import sys
+
+from merak.benchmark import DATASETS, Benchmark, generate, load
+from merak.client import Client
+from merak.graph import LayeredGraph
+from merak.hnsw import HNSW
+from merak.storage import NebulaStorage
+from merak.importer import BulkImporter
+from merak.metric import METRICS
+
+
+def import_command(args):
+    client = Client(args.ip, args.port, pool_size=args.pool_size or args.workers)
+    try:
+        # writes are grouped, the importer flushes them before every checkpoint
+        graph = LayeredGraph(args.max_top_layer, NebulaStorage(client), write_behind=True,
+                             flush_size=args.flush_size)
+        hnsw = HNSW(args.max_top_layer, metric=args.metric, graph=graph)
+        importer = BulkImporter(hnsw, args.checkpoint, m=args.m, m_max=args.m_max, ef=args.ef,
+                                ml=args.max_top_layer, workers=args.workers,
+                                batch_size=args.batch_size, id_stride=args.id_stride)
+        importer.run(args.path)
+        graph.close()
+    finally:
+        client.close()
+
+
+def bench_command(args):
+    if args.path is not None:
+        ids, vectors = load(args.path, args.id_stride, args.count)
+    else:
+        count, dim = DATASETS[args.dataset]
+        ids, vectors = generate(args.count or count, args.dim or dim, args.seed)
+    _, queries = generate(args.queries, vectors.shape[1], args.seed + 1)
+
+    if args.ip is None:
+        results = Benchmark(ids, vectors, queries, k=args.k, metric=args.metric,
+                            workers=args.workers).sweep(args.m, args.ef, args.ml, args.ef_construction)
+    else:
+        client = Client(args.ip, args.port, pool_size=args.workers)
+
+        def storage():
+            return NebulaStorage(client)
+
+        try:
+            benchmark = Benchmark(ids, vectors, queries, k=args.k, metric=args.metric,
+                                  storage=storage, workers=args.workers)
+            results = benchmark.sweep(args.m, args.ef, args.ml, args.ef_construction)
+        finally:
+            client.close()
+
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text)
+
+
+def int_list(text: str):
+    return [int(x) for x in text.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='merak')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_import = commands.add_parser('import', help='build an index from part{N}.npz files')
+    parser_import.add_argument('path', help='directory of the part files')
+    parser_import.add_argument('--ip', default='127.0.0.1', help='ip of nebula graphd')
+    parser_import.add_argument('--port', type=int, default=9669, help='port of nebula graphd')
+    parser_import.add_argument('--checkpoint', default='merak_import.json',
+                               help='progress file, an existing one is resumed')
+    parser_import.add_argument('--workers', type=int, default=8)
+    parser_import.add_argument('--pool-size', type=int, default=None,
+                               help='nebula sessions, defaults to the number of workers')
+    parser_import.add_argument('--batch-size', type=int, default=1000)
+    parser_import.add_argument('--flush-size', type=int, default=10000,
+                               help='buffered points and edges written to nebula with one request')
+    parser_import.add_argument('--id-stride', type=int, default=1000000,
+                               help='ids of parts without an id array are part * stride + row')
+    parser_import.add_argument('--m', type=int, default=16)
+    parser_import.add_argument('--m-max', type=int, default=32)
+    parser_import.add_argument('--ef', type=int, default=200)
+    parser_import.add_argument('--max-top-layer', type=int, default=4)
+    parser_import.add_argument('--metric', choices=sorted(METRICS), default='l2',
+                               help='cosine or ip for the nlp and cv embeddings')
+    parser_import.set_defaults(func=import_command)
+
+    parser_bench = commands.add_parser('bench', help='measure build time, recall, QPS and latency')
+    parser_bench.add_argument('path', nargs='?', default=None,
+                              help='directory of part files, a random dataset is generated if absent')
+    parser_bench.add_argument('--dataset', choices=sorted(DATASETS), default='small',
+                              help='shape of the generated dataset')
+    parser_bench.add_argument('--count', type=int, default=None, help='number of points to index')
+    parser_bench.add_argument('--dim', type=int, default=None, help='dimension of generated points')
+    parser_bench.add_argument('--id-stride', type=int, default=1000000)
+    parser_bench.add_argument('--queries', type=int, default=100)
+    parser_bench.add_argument('--seed', type=int, default=0)
+    parser_bench.add_argument('--k', type=int, default=10)
+    parser_bench.add_argument('--m', type=int_list, default=[16], help='comma separated values to sweep')
+    parser_bench.add_argument('--ef', type=int_list, default=[50, 100, 200],
+                              help='comma separated values to sweep')
+    parser_bench.add_argument('--ml', type=int_list, default=[4], help='comma separated values to sweep')
+    parser_bench.add_argument('--ef-construction', type=int, default=200)
+    parser_bench.add_argument('--metric', choices=sorted(METRICS), default='l2')
+    parser_bench.add_argument('--workers', type=int, default=1, help='insert threads')
+    parser_bench.add_argument('--ip', default=None,
+                              help='ip of nebula graphd, the index is kept in memory if absent. '
+                                   'The space must be empty and takes a single build, i.e. one m and ml')
+    parser_bench.add_argument('--port', type=int, default=9669)
+    parser_bench.add_argument('--output', default=None, help='json file, stdout if absent')
+    parser_bench.set_defaults(func=bench_command)
+
+    args = parser.parse_args(argv)
+    # progress of imports is logged
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    # every build inserts into the same space, a second one would land on top of the first
+    if args.command == 'bench' and args.ip is not None and len(args.m) * len(args.ml) > 1:
+        parser.error('--ip sweeps a single build, give one value of --m and --ml')
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
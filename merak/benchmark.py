@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import itertools
+import os
+import time
+from typing import Callable, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.importer import list_parts, load_part
+from merak.metric import Metric, get_metric, squared_norms
+from merak.point import Point
+from merak.stats import QueryStats
+from merak.storage import MemoryStorage, Storage
+
+# (count, dim) of the example/random datasets, see example/random/data.py
+DATASETS = {
+    'small': (10000, 100),
+    'middle': (1000000, 500),
+}
+
+
+def generate(count: int, dim: int, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    ''' (ids, vectors) shaped like example/random, float16 in [0, 1) with ids from 1
+    '''
+    rng = np.random.default_rng(seed)
+    vectors = rng.random((count, dim), dtype=np.float32).astype(np.float16)
+    return np.arange(1, count + 1, dtype=np.int64), vectors
+
+
+def load(path: str, id_stride: int = 1000000, limit: int = None) -> Tuple[np.ndarray, np.ndarray]:
+    ''' (ids, vectors) of the part files under path, at most limit of them
+    '''
+    ids, vectors, count = [], [], 0
+    for part in list_parts(path):
+        part_ids, part_vectors = load_part(os.path.join(path, part), id_stride)
+        ids.append(part_ids)
+        vectors.append(part_vectors)
+        count += len(part_ids)
+        if limit is not None and count >= limit:
+            break
+    if not ids:
+        raise ValueError(f"no part files under {path}")
+    return np.concatenate(ids)[:limit], np.concatenate(vectors)[:limit]
+
+
+def ground_truth(base: np.ndarray, queries: np.ndarray, k: int, metric: Metric = None,
+                 block: int = 1024) -> Tuple[np.ndarray, np.ndarray]:
+    ''' Exact k nearest rows of base for every query.
+
+    Queries are scored against the whole base one block at a time, each block
+    is a single matrix product, so memory stays at block * len(base) floats.
+
+    Returns:
+        row indexes and distances of shape (len(queries), k), nearest first
+    '''
+    metric = get_metric(metric)
+    base = metric.prepare(np.asarray(base, dtype=np.float32))
+    queries = metric.prepare(np.atleast_2d(np.asarray(queries, dtype=np.float32)))
+    k = min(k, len(base))
+    base_norms = squared_norms(base)
+
+    rows = np.empty((len(queries), k), dtype=np.int64)
+    distances = np.empty((len(queries), k))
+    for begin in range(0, len(queries), block):
+        q = queries[begin:begin + block]
+        products = q @ base.T
+        if metric.name in ('l2', 'l2sq'):
+            d = np.maximum(base_norms[None, :] - 2 * products + squared_norms(q)[:, None], 0)
+            if metric.name == 'l2':
+                d = np.sqrt(d)
+        elif metric.name == 'cosine':
+            d = 1 - products
+        else:
+            d = -products
+        top = np.argpartition(d, k - 1, axis=1)[:, :k]
+        top_d = np.take_along_axis(d, top, axis=1)
+        order = np.argsort(top_d, axis=1, kind='stable')
+        rows[begin:begin + len(q)] = np.take_along_axis(top, order, axis=1)
+        distances[begin:begin + len(q)] = np.take_along_axis(top_d, order, axis=1)
+    return rows, distances
+
+
+def recall(found: np.ndarray, truth: np.ndarray) -> float:
+    ''' Mean fraction of the true neighbors found, both of shape (queries, k)
+    '''
+    hits = sum(len(set(f.tolist()) & set(t.tolist())) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def percentiles(latencies: Sequence[float]) -> Dict[str, float]:
+    p50, p90, p99 = np.percentile(np.asarray(latencies) * 1000, [50, 90, 99])
+    return {'p50_ms': float(p50), 'p90_ms': float(p90), 'p99_ms': float(p99)}
+
+
+class Benchmark:
+    ''' Build an index for every combination of m and ml, and measure recall@k,
+    QPS and latency of searches at every ef.
+
+    The index lives in a MemoryStorage unless a storage factory is given, so the
+    benchmark runs offline. Results are plain dicts, ready to dump as json.
+    '''
+
+    def __init__(self, ids: np.ndarray, vectors: np.ndarray, queries: np.ndarray, k: int = 10,
+                 metric: str = 'l2', storage: Callable[[], Storage] = None, workers: int = 1):
+        '''
+        ids, vectors: the points to index
+        queries: query matrix, searched one query at a time
+        storage: returns an empty storage for every build, MemoryStorage by default
+        workers: insert threads, 1 builds deterministically in order
+        '''
+        self._ids = np.asarray(ids)
+        self._vectors = vectors
+        self._queries = np.atleast_2d(queries)
+        self._k = k
+        self._metric = metric
+        self._storage = storage or (lambda: MemoryStorage(self._vectors.dtype))
+        self._workers = workers
+        rows, _ = ground_truth(vectors, self._queries, k, metric)
+        self._truth = self._ids[rows]
+
+    @property
+    def truth(self) -> np.ndarray:
+        ''' ids of the exact k nearest neighbors of every query
+        '''
+        return self._truth
+
+    def build(self, m: int, m_max: int, ef_construction: int, ml: int) -> Tuple[HNSW, float]:
+        ''' A new index of all points, with its build time in seconds
+        '''
+        hnsw = HNSW(ml, self._storage(), metric=self._metric)
+        points = [Point(int(id), vec) for id, vec in zip(self._ids, self._vectors)]
+        start = time.perf_counter()
+        if self._workers > 1:
+            hnsw.insert_many(points, m, m_max, ef_construction, ml, workers=self._workers)
+        else:
+            for p in points:
+                hnsw.insert(p, m, m_max, ef_construction, ml)
+        return hnsw, time.perf_counter() - start
+
+    def search(self, hnsw: HNSW, ef: int) -> Dict[str, float]:
+        ''' recall@k, QPS, latency percentiles and mean per query counters of the queries at ef
+        '''
+        found = np.full((len(self._queries), self._k), -1, dtype=np.int64)
+        latencies = []
+        totals = dict.fromkeys(('round_trips', 'nodes_fetched', 'distance_evals'), 0)
+        start = time.perf_counter()
+        for i, q in enumerate(self._queries):
+            stats = QueryStats()
+            begin = time.perf_counter()
+            knns = hnsw.knn_search(Point(-1, q), self._k, ef, stats=stats)
+            latencies.append(time.perf_counter() - begin)
+            found[i, :len(knns)] = [p.id for p in knns]
+            for counter in totals:
+                totals[counter] += getattr(stats, counter)
+        elapsed = time.perf_counter() - start
+
+        result = {'recall': recall(found, self._truth), 'qps': len(self._queries) / elapsed}
+        result.update(percentiles(latencies))
+        result.update({f'mean_{counter}': total / len(self._queries) for counter, total in totals.items()})
+        return result
+
+    def sweep(self, ms: Sequence[int], efs: Sequence[int], mls: Sequence[int],
+              ef_construction: int = 200, m_max: int = None) -> List[Dict]:
+        ''' One result per (m, ml, ef), m_max defaults to 2 * m
+        '''
+        results = []
+        for m, ml in itertools.product(ms, mls):
+            hnsw, build_seconds = self.build(m, m_max or 2 * m, ef_construction, ml)
+            for ef in efs:
+                result = {
+                    'm': m, 'm_max': m_max or 2 * m, 'ml': ml, 'ef_construction': ef_construction,
+                    'ef': ef, 'k': self._k, 'points': len(self._ids), 'queries': len(self._queries),
+                    'metric': self._metric, 'build_seconds': build_seconds,
+                    'build_rate': len(self._ids) / build_seconds,
+                }
+                result.update(self.search(hnsw, ef))
+                results.append(result)
+        return results
@@ -1,109 +1,371 @@
-from typing import Dict, List, Tuple
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Set, Tuple
 from time import sleep
 import numpy as np
 
 from nebula3.gclient.net import ConnectionPool
+from nebula3.gclient.net.Session import Session
 from nebula3.Config import Config
+from nebula3.Exception import IOErrorException, NotValidConnectionException
+
+from merak import stats
+from merak.codec import VectorCodec, DEFAULT_CODEC
 
 
 class InsertBatch:
-    def __init__(self):
+    def __init__(self, codec: VectorCodec = DEFAULT_CODEC):
+        self._codec = codec
         self._queries: List[str] = []
 
-    def insert_vertex(self, vid: int, vecStr: str):
-        query = f"INSERT VERTEX t1(col1) VALUES '{vid}': ('{vecStr}')"
+    def insert_vertex(self, vid: int, vec: np.ndarray):
+        query = f"INSERT VERTEX t1(col1) VALUES '{vid}': ('{self._codec.encode(vec)}')"
         self._queries.append(query)
 
     def insert_edge(self, src: int, level: int, dst: int):
         query = f"INSERT EDGE e1() VALUES '{src}' -> '{dst}' @{level}: ()"
         self._queries.append(query)
 
+    def delete_edge(self, src: int, level: int, dst: int):
+        query = f"DELETE EDGE e1 '{src}' -> '{dst}' @{level}"
+        self._queries.append(query)
+
+    def __len__(self) -> int:
+        return len(self._queries)
+
     def __str__(self) -> str:
         return ';'.join(self._queries)
 
 
 class Client:
-    def __init__(self, ip: str, port: int):
+    def __init__(self, ip: str, port: int, codec: VectorCodec = DEFAULT_CODEC, pool_size: int = 10,
+                 space: str = 'test', user: str = 'root', password: str = 'nebula',
+                 health_check_interval: float = 30.0):
         '''
         ip/port of nebula graphd
+        codec: serialization of vectors stored in the t1.col1 property
+        pool_size: max number of sessions, i.e. requests running in parallel
+        health_check_interval: a session idle for longer is pinged before use
         '''
+        assert pool_size > 0
+        self._codec = codec
+        self._space = space
+        self._user = user
+        self._password = password
+        self._pool_size = pool_size
+        self._health_check_interval = health_check_interval
+
         config = Config()
-        config.max_connection_pool_size = 10
+        config.max_connection_pool_size = pool_size
         self.pool = ConnectionPool()
         ok = self.pool.init([(ip, port)], config)
         if not ok:
             raise RuntimeError("connect failed")
-        self.session = self.pool.get_session('root', 'nebula')
-        self.session.execute('USE test')
+
+        # idle sessions with the time they were last used, most recent last
+        self._sessions: List[Tuple[Session, float]] = []
+        # guards the idle sessions and the count of open ones, notified whenever
+        # a session is returned or closed, i.e. one may be taken or opened
+        self._available = threading.Condition()
+        self._created = 0
+        # every open session, idle or checked out, all are released by close
+        self._open: Set[Session] = set()
+        self._closed = False
+        # open one session eagerly, so a wrong address or space fails here
+        self._checkin(self._checkout())
+
+    @property
+    def pool_size(self) -> int:
+        return self._pool_size
+
+    def _new_session(self) -> Session:
+        session = self.pool.get_session(self._user, self._password)
+        result = session.execute(f'USE {self._space}')
+        if not result.is_succeeded():
+            session.release()
+            raise RuntimeError(f"use space {self._space} failed")
+        return session
+
+    def _checkout(self) -> Session:
+        ''' Take an idle session, open a new one while below pool size, or wait for either
+        '''
+        with self._available:
+            while not self._closed and not self._sessions and self._created >= self._pool_size:
+                self._available.wait()
+            if self._closed:
+                raise RuntimeError("client is closed")
+            if self._sessions:
+                session, last_used = self._sessions.pop()
+            else:
+                self._created += 1
+                session = None
+
+        if session is None:
+            try:
+                session = self._new_session()
+            except Exception:
+                with self._available:
+                    self._created -= 1
+                    self._available.notify()
+                raise
+            with self._available:
+                closed = self._closed
+                if not closed:
+                    self._open.add(session)
+            if closed:
+                # close ran while the session was opened
+                session.release()
+                raise RuntimeError("client is closed")
+            return session
+
+        if time.monotonic() - last_used > self._health_check_interval and not session.ping():
+            self._discard(session)
+            return self._checkout()
+        return session
+
+    def _checkin(self, session: Session):
+        with self._available:
+            # after close the session is released already
+            if self._closed:
+                return
+            self._sessions.append((session, time.monotonic()))
+            self._available.notify()
+
+    def _discard(self, session: Session):
+        # a waiter may open a replacement now
+        with self._available:
+            self._created -= 1
+            self._open.discard(session)
+            self._available.notify()
+        try:
+            session.release()
+        except Exception:
+            pass
+
+    def _execute(self, query: str):
+        ''' Run query on a pooled session, reconnecting once if the session is broken
+        '''
+        query_stats = stats.current()
+        start = time.perf_counter()
+        try:
+            return self._execute_once(query)
+        finally:
+            if query_stats is not None:
+                query_stats.add('round_trips')
+                query_stats.add('round_trip_seconds', time.perf_counter() - start)
+
+    def _execute_once(self, query: str):
+        session = self._checkout()
+        try:
+            result = session.execute(query)
+        except (IOErrorException, NotValidConnectionException):
+            self._discard(session)
+            session = self._checkout()
+            try:
+                result = session.execute(query)
+            except Exception:
+                self._discard(session)
+                raise
+        except Exception:
+            self._discard(session)
+            raise
+        self._checkin(session)
+        return result
+
+    @property
+    def codec(self) -> VectorCodec:
+        return self._codec
 
     # todo: return Point
-    def get_neighbors(self, vid) -> Tuple[str, Dict]:
+    def get_neighbors(self, vid) -> Tuple[np.ndarray, Dict]:
         '''
         given a id, return the vector of id, and its neighbor of Dict[level, List[dst id]]
         '''
+        result = self.get_neighbors_many([vid])
+        if vid not in result:
+            raise RuntimeError("fetch no result")
+        return result[vid]
+
+    def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        '''
+        given a list of ids, return {id: (vector, Dict[level, List[dst id]])} with one FETCH
+        and one GO statement for the whole list. Ids without a vertex are left out.
+        If layer is given, only neighbors on that layer are returned.
+        '''
+        if len(vids) == 0:
+            return {}
+        id_list = ','.join("\'{}\'".format(vid) for vid in vids)
+
         # todo: replace t1 as tag, col1 as property
         # todo: use int id?
-        query = "FETCH PROP ON t1 \'{}\' YIELD properties(vertex).col1".format(vid)
-        result = self.session.execute(query)
+        query = "FETCH PROP ON t1 {} YIELD id(vertex) as vid, properties(vertex).col1 as vec".format(
+            id_list)
+        result = self._execute(query)
         if not result.is_succeeded():
             raise RuntimeError("fetch failed")
-        # get the vector of id
-        try:
-            vec = result.row_values(0)[0]
-        except OutOfRangeException:
-            raise RuntimeError("fetch no result")
+        # get the vectors of ids
+        vecs: Dict[int, np.ndarray] = {}
+        decoded = 0
+        for i in range(result.row_size()):
+            row = result.row_values(i)
+            vec_str = row[1].as_string()
+            decoded += len(vec_str)
+            vecs[row[0].as_int()] = self._codec.decode(vec_str)
+        stats.count('bytes_decoded', decoded)
+
+        neighbors = self.get_edges_many(list(vecs), layer)
+
+        # todo: return Point by assemble id, vec and neighbors
+        return {vid: (vec, neighbors.get(vid, {})) for vid, vec in vecs.items()}
+
+    def get_edges_many(self, vids: List[int], layer: int = None) -> Dict[int, Dict[int, List[int]]]:
+        '''
+        given a list of ids, return {id: Dict[level, List[dst id]]} with one GO statement and
+        without fetching any vector. Ids without edges are left out.
+        '''
+        if len(vids) == 0:
+            return {}
+        id_list = ','.join("\'{}\'".format(vid) for vid in vids)
 
         # todo: replace e1 as edge
-        query = "GO FROM \'{}\' OVER e1 YIELD rank(edge) as rank, dst(edge) as dst".format(vid)
-        result = self.session.execute(query)
+        query = "GO FROM {} OVER e1".format(id_list)
+        if layer is not None:
+            query += " WHERE rank(edge) == {}".format(layer)
+        query += " YIELD src(edge) as src, rank(edge) as rank, dst(edge) as dst"
+        result = self._execute(query)
         if not result.is_succeeded():
             raise RuntimeError("go failed")
 
-        # get neighbors of id
-        size = result.row_size()
-        neighbors: Dict[int, List[int]] = {}
-        for i in range(size):
+        # get neighbors of ids
+        neighbors: Dict[int, Dict[int, List[int]]] = {}
+        for i in range(result.row_size()):
             row = result.row_values(i)
-            # two column in each row rank and dst
-            rank = row[0].as_int()
-            dst = row[1].as_int()
-            if neighbors.get(rank):
-                neighbors[rank].append(dst)
-            else:
-                neighbors[rank] = [dst]
+            # three column in each row src, rank and dst
+            src = row[0].as_int()
+            rank = row[1].as_int()
+            dst = row[2].as_int()
+            neighbors.setdefault(src, {}).setdefault(rank, []).append(dst)
+        return neighbors
 
-        # todo: return Point by assemble id, vec and neighbors
-        return (vec, neighbors)
+    def get_sources_many(self, vids: List[int]) -> Dict[int, List[Tuple[int, int]]]:
+        '''
+        given a list of ids, return {id: List[(level, src id)]} of the edges pointing to
+        them, with one reverse GO statement. Ids without incoming edges are left out.
+        '''
+        if len(vids) == 0:
+            return {}
+        id_list = ','.join("\'{}\'".format(vid) for vid in vids)
+        query = "GO FROM {} OVER e1 REVERSELY YIELD src(edge) as src, rank(edge) as rank, dst(edge) as dst".format(
+            id_list)
+        result = self._execute(query)
+        if not result.is_succeeded():
+            raise RuntimeError("go failed")
+
+        sources: Dict[int, List[Tuple[int, int]]] = {}
+        for i in range(result.row_size()):
+            row = result.row_values(i)
+            sources.setdefault(row[2].as_int(), []).append((row[1].as_int(), row[0].as_int()))
+        return sources
+
+    def delete_vertices(self, vids: List[int]):
+        '''
+        delete vertices together with all their incoming and outgoing edges
+        '''
+        if len(vids) == 0:
+            return
+        id_list = ','.join("\'{}\'".format(vid) for vid in vids)
+        result = self._execute("DELETE VERTEX {} WITH EDGE".format(id_list))
+        if not result.is_succeeded():
+            raise RuntimeError("delete vertex failed")
 
-    def insert_vertex(self, vid, vector):
-        query = "INSERT VERTEX t1(col1) VALUES \'{}\': (\'{}\')".format(vid, vector)
-        result = self.session.execute(query)
+    def insert_vertex(self, vid, vector: np.ndarray):
+        query = "INSERT VERTEX t1(col1) VALUES \'{}\': (\'{}\')".format(
+            vid, self._codec.encode(vector))
+        result = self._execute(query)
         if not result.is_succeeded():
             raise RuntimeError("insert vertex failed")
 
     def insert_edge(self, src, level, dst):
         query = "INSERT EDGE e1() VALUES \'{}\' -> \'{}\' @{}: ()".format(src, dst, level)
-        result = self.session.execute(query)
+        result = self._execute(query)
         if not result.is_succeeded():
             raise RuntimeError("insert edge failed")
 
     def insert_batch(self) -> InsertBatch:
-        return InsertBatch()
+        return InsertBatch(self._codec)
 
     def insert(self, batch: InsertBatch):
-        batchStr = ';'.join(batch)
-        result = self.session.execute(batchStr)
+        batchStr = str(batch)
+        result = self._execute(batchStr)
         if not result.is_succeeded():
             raise RuntimeError(f"insert batch {batchStr} failed")
 
     def execute(self, query):
-        return self.session.execute(query)
+        return self._execute(query)
 
     def close(self):
-        self.session.release()
+        ''' Release every session, checked out ones included. Later requests fail,
+        and so do requests waiting for a session.
+        '''
+        with self._available:
+            self._closed = True
+            sessions, self._open = self._open, set()
+            self._sessions = []
+            self._available.notify_all()
+        for session in sessions:
+            try:
+                session.release()
+            except Exception:
+                pass
         self.pool.close()
 
 
+class AsyncClient:
+    '''
+    asyncio variant of Client. nebula3 only has a blocking api, so requests run on a
+    bounded thread pool and several of them can be in flight from one event loop.
+    '''
+
+    def __init__(self, client: Client, max_in_flight: int = None):
+        '''
+        max_in_flight: defaults to the session pool size of client
+        '''
+        self._client = client
+        if max_in_flight is None:
+            max_in_flight = client.pool_size
+        self._executor = ThreadPoolExecutor(max_in_flight, thread_name_prefix='merak-aio')
+
+    @property
+    def client(self) -> Client:
+        return self._client
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        # run in a copy of the caller's context, so its stats are collected
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, func, *args)
+
+    async def get_neighbors(self, vid) -> Tuple[np.ndarray, Dict]:
+        return await self._run(self._client.get_neighbors, vid)
+
+    async def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        return await self._run(self._client.get_neighbors_many, vids, layer)
+
+    async def insert(self, batch: InsertBatch):
+        return await self._run(self._client.insert, batch)
+
+    async def execute(self, query):
+        return await self._run(self._client.execute, query)
+
+    def close(self):
+        ''' release the thread pool, the wrapped client is left open
+        '''
+        self._executor.shutdown(wait=True)
+
+
 if __name__ == "__main__":
     client = Client("192.168.8.211", 3999)
     client.execute(
@@ -113,6 +375,6 @@ if __name__ == "__main__":
     client.execute('create edge if not exists e1()')
     sleep(10)
     client.insertEdge(1, 0, 2)  # src, level, dst
-    client.insertVertex(1, "some vector")  # vid, vector
+    client.insertVertex(1, np.array([0.1, 0.2]))  # vid, vector
     client.get_neighbors(2)
     client.close()
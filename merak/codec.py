@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import base64
+import struct
+from typing import Optional, Union
+
+import numpy as np
+
+
+class VectorCodec(object):
+    ''' Serialize a vector to the property value stored in nebula and back.
+    '''
+
+    def encode(self, vec: np.ndarray) -> Union[str, bytes]:
+        raise NotImplementedError
+
+    def decode(self, data: Union[str, bytes]) -> np.ndarray:
+        raise NotImplementedError
+
+
+class BinaryCodec(VectorCodec):
+    ''' Raw little-endian vector bytes behind a small header.
+
+    Layout: version(u8) | dtype code(u8) | dim(u32) | dim * itemsize bytes.
+    The whole payload is base64 encoded when the property is a string column.
+    Decoding reads dtype and dim from the header, so vectors written with
+    different dtypes can live in the same space.
+
+    Without a dtype a vector keeps its own when it is supported and at most
+    4 bytes wide, e.g. float16 datasets are stored at half the size, anything
+    else is stored as float32.
+    '''
+
+    VERSION = 1
+    HEADER = struct.Struct('<BBI')
+
+    DTYPES = {
+        1: np.dtype('<f2'),
+        2: np.dtype('<f4'),
+        3: np.dtype('<f8'),
+        4: np.dtype('i1'),
+        5: np.dtype('u1'),
+    }
+    CODES = {dtype: code for code, dtype in DTYPES.items()}
+
+    def __init__(self, dtype=None, use_base64: bool = True) -> None:
+        '''
+        dtype: dtype every vector is stored as, see above if None
+        '''
+        self._dtype = None if dtype is None else np.dtype(dtype).newbyteorder('<')
+        if self._dtype is not None and self._dtype not in self.CODES:
+            raise ValueError(f"unsupported vector dtype {dtype}")
+        self._use_base64 = use_base64
+
+    @property
+    def dtype(self) -> Optional[np.dtype]:
+        return self._dtype
+
+    def encode(self, vec: np.ndarray) -> Union[str, bytes]:
+        vec = np.asarray(vec)
+        dtype = self._dtype
+        if dtype is None:
+            dtype = vec.dtype.newbyteorder('<')
+            if dtype not in self.CODES or dtype.itemsize > 4:
+                dtype = self.DTYPES[2]
+        vec = np.ascontiguousarray(vec, dtype=dtype).reshape(-1)
+        data = self.HEADER.pack(self.VERSION, self.CODES[dtype], vec.shape[0]) + vec.tobytes()
+        if self._use_base64:
+            return base64.b64encode(data).decode('ascii')
+        return data
+
+    def decode(self, data: Union[str, bytes]) -> np.ndarray:
+        if isinstance(data, str):
+            data = base64.b64decode(data)
+        version, code, dim = self.HEADER.unpack_from(data)
+        if version != self.VERSION:
+            raise ValueError(f"unsupported vector encoding version {version}")
+        if code not in self.DTYPES:
+            raise ValueError(f"unknown vector dtype code {code}")
+        dtype = self.DTYPES[code]
+        if len(data) != self.HEADER.size + dim * dtype.itemsize:
+            raise ValueError("vector payload size does not match header")
+        return np.frombuffer(data, dtype=dtype, count=dim, offset=self.HEADER.size)
+
+
+DEFAULT_CODEC = BinaryCodec()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import hashlib
+from typing import Callable, Hashable, Iterable, Optional, Union
+
+import numpy as np
+
+
+class Filter(object):
+    ''' Which ids a filtered search may return.
+
+    Filtered out points are still walked through, they are only kept out of
+    the results. A filter knowing its allowed ids lets a very selective search
+    fall back to brute force over them.
+    '''
+
+    def __call__(self, id: int) -> bool:
+        raise NotImplementedError
+
+    def size(self) -> Optional[int]:
+        ''' Number of allowed ids, None if unknown
+        '''
+        return None
+
+    def ids(self) -> Optional[np.ndarray]:
+        ''' The allowed ids, None if they can not be listed
+        '''
+        return None
+
+    def key(self) -> Hashable:
+        ''' Equal for filters allowing the same ids, the filter itself unless they can be compared
+        '''
+        return self
+
+
+class IdFilter(Filter):
+    ''' An allow-list of ids
+    '''
+
+    def __init__(self, ids: Iterable[int]):
+        self._ids = {int(id) for id in ids}
+
+    def __call__(self, id: int) -> bool:
+        return id in self._ids
+
+    def size(self) -> int:
+        return len(self._ids)
+
+    def ids(self) -> np.ndarray:
+        return np.fromiter(self._ids, dtype=np.int64, count=len(self._ids))
+
+    def key(self) -> Hashable:
+        return 'ids', frozenset(self._ids)
+
+
+class BitmapFilter(Filter):
+    ''' id is allowed if bitmap[id - offset] is set, ids outside the bitmap are not
+    '''
+
+    def __init__(self, bitmap: np.ndarray, offset: int = 0):
+        self._bitmap = np.asarray(bitmap, dtype=bool)
+        self._offset = offset
+
+    def __call__(self, id: int) -> bool:
+        i = id - self._offset
+        return 0 <= i < len(self._bitmap) and bool(self._bitmap[i])
+
+    def size(self) -> int:
+        return int(np.count_nonzero(self._bitmap))
+
+    def ids(self) -> np.ndarray:
+        return np.flatnonzero(self._bitmap).astype(np.int64) + self._offset
+
+    def key(self) -> Hashable:
+        digest = hashlib.blake2b(np.packbits(self._bitmap).tobytes(), digest_size=16).digest()
+        return 'bitmap', self._offset, len(self._bitmap), digest
+
+
+class PredicateFilter(Filter):
+    ''' Any predicate on ids, e.g. on an attribute looked up by id
+    '''
+
+    def __init__(self, predicate: Callable[[int], bool]):
+        self._predicate = predicate
+
+    def __call__(self, id: int) -> bool:
+        return bool(self._predicate(id))
+
+    def key(self) -> Hashable:
+        # predicates can't be compared, the same function is the same filter
+        return 'predicate', self._predicate
+
+
+def as_filter(filter: Union[Filter, Iterable[int], np.ndarray, Callable[[int], bool], None]) -> Optional[Filter]:
+    ''' A Filter from a Filter, a bool bitmap, a collection of ids or a predicate
+    '''
+    if filter is None or isinstance(filter, Filter):
+        return filter
+    if isinstance(filter, np.ndarray) and filter.dtype == bool:
+        return BitmapFilter(filter)
+    if callable(filter):
+        return PredicateFilter(filter)
+    return IdFilter(filter)
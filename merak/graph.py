@@ -1,11 +1,24 @@
-from typing import Dict, List, Tuple
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Set, Tuple
 import numpy as np
 
+from merak import stats
 from merak.point import Point
-from merak.client import Client
+from merak.point_cache import PointCache
+from merak.point_store import PointStore
+from merak.storage import Edge, MemoryStorage, Storage
+
+# rough per node bookkeeping cost of the python objects, used for cache sizing
+_NODE_OVERHEAD = 256
+# number of striped locks guarding the neighbor lists of nodes
+_LOCK_STRIPES = 1024
 
 
 class Node:
+    __slots__ = ('_point', '_neighbors')
+
     def __init__(self, point: Point, neighbors: Dict[int, List[int]]):
         self._point = point
         self._neighbors = neighbors
@@ -25,44 +38,134 @@ class Node:
     def layer(self) -> int:
         return self._layer
 
+    @property
+    def nbytes(self) -> int:
+        n = sum(len(ids) for ids in self._neighbors.values())
+        return self._point.nbytes + 8 * n + _NODE_OVERHEAD
+
     def layer_neighbors(self, layer: int) -> List[int]:
-        assert layer in self._neighbors
-        return self._neighbors[layer]
+        return self._neighbors.get(layer, [])
+
+    def neighbors(self) -> Dict[int, List[int]]:
+        return self._neighbors
 
 
 class AddBatch:
     def __init__(self):
         self._points: List[Point] = []
+        self._layers: List[int] = []
         self._edges: List[Tuple[int, int, int]] = []
+        self._deleted_edges: List[Tuple[int, int, int]] = []
 
-    def add_point(self, p: Point):
+    def add_point(self, p: Point, layer: int = 0):
+        ''' layer: top layer of the point
+        '''
         self._points.append(p)
+        self._layers.append(layer)
 
     def add_edge(self, layer: int, src: int, dst: int):
         self._edges.append((layer, src, dst))
 
+    def delete_edge(self, layer: int, src: int, dst: int):
+        self._deleted_edges.append((layer, src, dst))
+
     @property
     def points(self) -> List[Point]:
         return self._points
 
     @property
-    def edges(self) -> List[Tuple(int, int, int)]:
+    def layers(self) -> List[int]:
+        return self._layers
+
+    @property
+    def edges(self) -> List[Tuple[int, int, int]]:
         return self._edges
 
+    @property
+    def deleted_edges(self) -> List[Tuple[int, int, int]]:
+        return self._deleted_edges
+
 
 class LayeredGraph:
     '''
-    should not insert duplicate nodes
+    should not insert duplicate nodes, a changed point is removed before it is added again
+
+    Thread safe. Neighbor lists are guarded by striped node locks taken by the
+    writer, see lock_nodes. Entry point and top layer are read and changed
+    together under a lock of their own, which is never held while waiting for
+    another one. Inserts and compactions moving them are serialized by
+    entry_lock, taken before any node lock.
+
+    Deleted points are tombstoned first: they stay in the graph for routing
+    until remove takes them out, the search leaves them out of its results.
+
+    With write_behind, add only buffers its batch and the buffered points and
+    edges of many adds are written together by flush: in the background once
+    flush_size of them are buffered or the oldest waited flush_interval seconds,
+    or when flush is called. Reads see buffered writes, as the nodes they leave behind are
+    kept until written. Call flush or close before the process exits.
     '''
 
-    def __init__(self, max_top_layer: int, client: Client):
-        self._client = client
+    def __init__(self, max_top_layer: int, storage: Storage = None, cache: PointCache = None,
+                 store: PointStore = None, write_behind: bool = False, flush_size: int = 10000,
+                 flush_interval: float = 1.0, size: int = None):
+        '''
+        storage: where vectors and edges live, in process memory by default
+        cache, store: node cache and its vector store, used for remote storages only
+        write_behind: buffer writes and group them into large ones, see above
+        flush_size: buffered points and edges triggering a flush
+        flush_interval: seconds a buffered write waits at most
+        size: number of points already stored, counted from storage unless it is remote
+        '''
+        self._storage = MemoryStorage() if storage is None else storage
+        # vectors of cached nodes live in the store, rows are released on eviction
+        self._store = PointStore() if store is None else store
+        self._cache = PointCache() if cache is None else cache
+        self._cache.on_evict = self._release
         # layer in [0, top_layer], having top_layer+1 layers totally
         self._max_top_layer = max_top_layer
         self._curr_top_layer = -1
 
-        self._nodes: Dict[int, Node] = {}  # TODO(spw): should convert to cache
-        self._entry_point: int = -1
+        self._entry_point: Optional[int] = None
+        self._entry_lock = threading.RLock()
+        # guards the pair above, add takes it while holding node locks
+        self._top_lock = threading.Lock()
+
+        self._node_locks = [threading.Lock() for _ in range(_LOCK_STRIPES)]
+        # bumped on every write to a stripe, a fetch racing with a write is not cached
+        self._epochs = [0] * _LOCK_STRIPES
+
+        # resident copy of the layers >= _pin_layer, see pin_upper_layers
+        self._pinned: Optional[MemoryStorage] = None
+        self._pin_layer = self._max_top_layer + 1
+
+        # ids deleted but not removed yet, and the number of stored points. Remote
+        # storages can't count their points, without size it counts the points added since.
+        self._tombstones: Set[int] = set()
+        if size is None:
+            size = 0 if self._storage.remote else len(self._storage)
+        self._size = size
+        self._count_lock = threading.Lock()
+        # bumped by every write, results computed at an older version may be stale
+        self._version = 0
+
+        self._write_behind = write_behind
+        self._flush_size = flush_size
+        self._flush_interval = flush_interval
+        # nodes as buffered writes leave them, kept until those writes are stored
+        self._pending_nodes: Dict[int, Node] = {}
+        # writes not flushed yet, the last write of a point or an edge wins
+        self._pending_points: Dict[int, Point] = {}
+        self._pending_edges: Dict[Edge, bool] = {}
+        self._pending_since: Optional[float] = None
+        self._buffer_lock = threading.Lock()
+        # flushes are written one at a time and in order
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+        # set by add once the buffer is full, the flush thread then writes it
+        self._flush_wanted = threading.Event()
+        if write_behind:
+            threading.Thread(target=self._flush_loop, name='merak-flush', daemon=True).start()
 
     @property
     def top_layer(self) -> int:
@@ -73,42 +176,555 @@ class LayeredGraph:
         return self._max_top_layer
 
     @property
-    def entry_point(self) -> Point:
+    def storage(self) -> Storage:
+        return self._storage
+
+    @property
+    def cache(self) -> PointCache:
+        return self._cache
+
+    @property
+    def store(self) -> PointStore:
+        return self._store
+
+    @property
+    def entry_point(self) -> Optional[int]:
         return self._entry_point
 
-    # maybe no need this, will be set in add_point
-    @entry_point.setter
-    def set_entry_point(self, p: Point):
-        assert p.id in self._nodes
-        node = self._nodes[p.id]
+    @property
+    def pinned(self) -> Optional[MemoryStorage]:
+        return self._pinned
+
+    @property
+    def size(self) -> int:
+        return self._size
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    @property
+    def tombstone_count(self) -> int:
+        return len(self._tombstones)
+
+    @property
+    def tombstone_ratio(self) -> float:
+        return len(self._tombstones) / max(self._size, 1)
+
+    def tombstones(self) -> List[int]:
+        with self._count_lock:
+            return list(self._tombstones)
+
+    def is_deleted(self, id: int) -> bool:
+        return id in self._tombstones
+
+    def tombstone(self, id: int):
+        ''' Mark id deleted, it keeps routing searches until it is removed
+        '''
+        with self._count_lock:
+            self._tombstones.add(id)
+            self._version += 1
+
+    def remove(self, ids: List[int]):
+        ''' Take the points of ids out of the graph, with every edge from and to them
+
+        Their neighbors should be reconnected before, and the entry point moved
+        away from them, see HNSW.compact.
+        '''
+        self.flush()
+        with self.lock_nodes(ids):
+            sources = self._storage.delete(ids)
+            self._invalidate(ids)
+        with self.lock_nodes(sources):
+            self._invalidate(sources)
+        pinned = self._pinned
+        if pinned is not None:
+            pinned.delete([id for id in ids if id in pinned.store])
+        with self._count_lock:
+            self._size = max(self._size - len(ids), 0)
+            self._tombstones.difference_update(ids)
+            self._version += 1
+
+    @property
+    def entry_lock(self) -> threading.RLock:
+        return self._entry_lock
+
+    def entry(self) -> Tuple[Optional[int], int]:
+        ''' Consistent pair of entry point and top layer
+        '''
+        with self._top_lock:
+            return self._entry_point, self._curr_top_layer
+
+    def set_entry(self, entry_point: int, top_layer: int):
+        ''' Restore entry point and top layer of a graph already stored in nebula
+        '''
+        assert top_layer <= self._max_top_layer
+        with self._top_lock:
+            self._entry_point = entry_point
+            self._curr_top_layer = top_layer
+
+    def replace_entry(self, old: Optional[int], entry_point: Optional[int], top_layer: int) -> bool:
+        ''' Move the entry point from old to entry_point, unless an add moved it meanwhile
+        '''
+        assert top_layer <= self._max_top_layer
+        with self._top_lock:
+            if self._entry_point != old:
+                return False
+            self._entry_point = entry_point
+            self._curr_top_layer = top_layer
+            return True
+
+    @contextmanager
+    def lock_nodes(self, ids: Iterable[int]):
+        ''' Hold the locks of the neighbor lists of ids.
 
-        assert node.top_layer == self._curr_top_layer
-        self._entry_point = p
+        Stripes are always taken in ascending order, so two writers locking
+        overlapping sets can not deadlock.
+        '''
+        stripes = sorted({id % _LOCK_STRIPES for id in ids})
+        for stripe in stripes:
+            self._node_locks[stripe].acquire()
+        try:
+            yield
+        finally:
+            for stripe in reversed(stripes):
+                self._node_locks[stripe].release()
+
+    def pin_upper_layers(self, min_layer: int = 1) -> int:
+        ''' Keep the points and edges of layers >= min_layer resident in memory.
+
+        The upper layers are walked breadth first from the entry point, every
+        step reads the whole frontier with one request, so loading takes as many
+        requests as the walk has steps. Later writes keep the resident copy up
+        to date, and the descent of a search then only reads storage on layers
+        below min_layer. Call before serving, concurrent inserts are not picked up
+        during the walk.
+
+        Returns:
+            number of pinned points
+        '''
+        assert min_layer >= 1
+        self.flush()
+        entry_point, _ = self.entry()
+        pinned = None
+        frontier = [] if entry_point is None else [entry_point]
+        seen = set(frontier)
+        while frontier:
+            fetched = self._storage.get_neighbors_many(frontier)
+            points, edges, next_frontier = [], [], []
+            for id in frontier:
+                if id not in fetched:
+                    raise RuntimeError(f"fetch no result of {id}")
+                vec, neighbors = fetched[id]
+                points.append(Point(id, vec))
+                for layer, dsts in neighbors.items():
+                    if layer < min_layer:
+                        continue
+                    for dst in dsts:
+                        edges.append((layer, id, dst))
+                        if dst not in seen:
+                            seen.add(dst)
+                            next_frontier.append(dst)
+            if pinned is None:
+                pinned = MemoryStorage(points[0].vec.dtype)
+            pinned.write(points, edges)
+            frontier = next_frontier
+
+        with self._entry_lock:
+            self._pinned = pinned
+            self._pin_layer = min_layer if pinned is not None else self._max_top_layer + 1
+        return len(seen)
+
+    def unpin(self):
+        with self._entry_lock:
+            self._pinned = None
+            self._pin_layer = self._max_top_layer + 1
 
     def add_batch(self) -> AddBatch:
         return AddBatch()
 
     def add(self, batch: AddBatch):
-        b = self._client.insert_batch()
-        for p in batch.points:
-            b.insert_vertex(p.id, p.vec_str)
-        for e in batch.edges:
-            layer, src, dst = e
-            b.insert_edge(layer, src, dst)
-            if layer > self._curr_top_layer:
-                self._curr_top_layer = layer
-                self._entry_point = src
-        self._client.insert(b)
+        ''' Write a batch with one request, or buffer it with write_behind. The caller
+        holds lock_nodes of the edge sources.
+        '''
+        if self._write_behind:
+            self._buffer(batch)
+        else:
+            self._storage.write(batch.points, batch.edges, batch.deleted_edges)
+        self._invalidate({src for _, src, _ in batch.edges + batch.deleted_edges})
+        with self._count_lock:
+            self._size += len(batch.points)
+            self._version += 1
+        pinned, pin_layer = self._pinned, self._pin_layer
+        if pinned is not None:
+            pinned.write([p for p, layer in zip(batch.points, batch.layers) if layer >= pin_layer],
+                         [edge for edge in batch.edges if edge[0] >= pin_layer],
+                         [edge for edge in batch.deleted_edges if edge[0] >= pin_layer])
+
+        # a point above the top layer becomes the entry point, only after it is written.
+        # The caller holds node locks, so this must not wait for the entry lock: an
+        # insert or compaction holding it may be waiting for those node locks.
+        if any(layer > self._curr_top_layer for layer in batch.layers):
+            with self._top_lock:
+                for p, layer in zip(batch.points, batch.layers):
+                    if layer > self._curr_top_layer:
+                        self._curr_top_layer = layer
+                        self._entry_point = p.id
+
+        if self._write_behind:
+            with self._buffer_lock:
+                buffered = len(self._pending_points) + len(self._pending_edges)
+                since = self._pending_since
+            if buffered >= self._flush_size or (since is not None and
+                                                time.monotonic() - since >= self._flush_interval):
+                # not flushed here, flush takes node locks and the caller holds some
+                self._flush_wanted.set()
+
+    def _buffer(self, batch: AddBatch):
+        ''' Buffer the writes of batch and the nodes they leave behind
+        '''
+        new_points = {p.id: p for p in batch.points}
+        sources = {src for _, src, _ in batch.edges + batch.deleted_edges}
+        # the caller holds the node locks of the sources, nobody else changes them meanwhile
+        nodes = {node.id: node for node in self._get_nodes([id for id in sources if id not in new_points])}
+        changed: Dict[int, Node] = {}
+        for id in sources | set(new_points):
+            node = nodes.get(id)
+            point = new_points.get(id) or node.point
+            neighbors = {} if node is None else {l: list(dsts) for l, dsts in node.neighbors().items()}
+            changed[id] = Node(point, neighbors)
+        # deletes first, as storages apply a batch
+        for layer, src, dst in batch.deleted_edges:
+            dsts = changed[src].neighbors().get(layer)
+            if dsts is not None and dst in dsts:
+                dsts.remove(dst)
+        for layer, src, dst in batch.edges:
+            dsts = changed[src].neighbors().setdefault(layer, [])
+            if dst not in dsts:
+                dsts.append(dst)
+
+        with self._buffer_lock:
+            self._pending_nodes.update(changed)
+            self._pending_points.update(new_points)
+            for edge in batch.deleted_edges:
+                self._pending_edges[edge] = False
+            for edge in batch.edges:
+                self._pending_edges[edge] = True
+            if self._pending_since is None:
+                self._pending_since = time.monotonic()
+
+    def flush(self):
+        ''' Write all buffered points and edges with one request. Must not be called
+        holding node locks.
+        '''
+        with self._flush_lock:
+            with self._buffer_lock:
+                if not self._pending_points and not self._pending_edges:
+                    return
+                points, edges = self._pending_points, self._pending_edges
+                nodes = dict(self._pending_nodes)
+                self._pending_points, self._pending_edges = {}, {}
+                self._pending_since = None
+            try:
+                self._storage.write(list(points.values()), [edge for edge, added in edges.items() if added],
+                                    [edge for edge, added in edges.items() if not added])
+            except Exception:
+                # put them back under later writes of the same points and edges
+                with self._buffer_lock:
+                    for id, p in points.items():
+                        self._pending_points.setdefault(id, p)
+                    for edge, added in edges.items():
+                        self._pending_edges.setdefault(edge, added)
+                    if self._pending_since is None:
+                        self._pending_since = time.monotonic()
+                raise
+            with self.lock_nodes(nodes):
+                # a read missing the pending nodes may have cached the rows they replace,
+                # drop those before the pending nodes stop shadowing them
+                self._invalidate(nodes)
+                with self._buffer_lock:
+                    for id, node in nodes.items():
+                        # a node changed again since is still pending
+                        if self._pending_nodes.get(id) is node:
+                            del self._pending_nodes[id]
+
+    def _flush_loop(self):
+        while not self._closed.is_set():
+            wanted = self._flush_wanted.wait(self._flush_interval / 2)
+            self._flush_wanted.clear()
+            since = self._pending_since
+            if wanted or (since is not None and time.monotonic() - since >= self._flush_interval):
+                try:
+                    self.flush()
+                except Exception:
+                    # the writes stay buffered, retried on the next tick or flush
+                    pass
+
+    def close(self):
+        ''' Stop the background flushes and write what is buffered
+        '''
+        self._closed.set()
+        self._flush_wanted.set()
+        self.flush()
+
+    def add_point(self, layer: int, p: Point):
+        ''' Write a single point whose top layer is layer
+        '''
+        batch = self.add_batch()
+        batch.add_point(p, layer)
+        self.add(batch)
+
+    def add_edge(self, layer: int, src: Point, dst: Point):
+        ''' Write a single edge src -> dst on layer
+        '''
+        batch = self.add_batch()
+        batch.add_edge(layer, src.id, dst.id)
+        with self.lock_nodes([src.id]):
+            self.add(batch)
+
+    def set_neighbors(self, layer: int, p: Point, neighbors: List[Point]):
+        ''' Replace the neighbors of p on layer
+        '''
+        self.flush()
+        with self.lock_nodes([p.id]):
+            self._storage.set_neighbors(layer, p.id, [n.id for n in neighbors])
+            self._invalidate([p.id])
+            with self._count_lock:
+                self._version += 1
+            if self._pinned is not None and layer >= self._pin_layer:
+                self._pinned.set_neighbors(layer, p.id, [n.id for n in neighbors])
+
+    def _invalidate(self, ids: Iterable[int]):
+        ''' Neighbors of ids changed, drop the stale copies. The caller holds lock_nodes of ids.
+        '''
+        for id in ids:
+            self._epochs[id % _LOCK_STRIPES] += 1
+            self._cache.remove(id)
+
+    def _get_node(self, id: int) -> Node:
+        return self._get_nodes([id])[0]
+
+    def _get_nodes(self, ids: List[int]) -> List[Node]:
+        nodes = self._find_nodes(ids)
+        for id in ids:
+            if id not in nodes:
+                raise RuntimeError(f"fetch no result of {id}")
+        return [nodes[id] for id in ids]
+
+    def _find_nodes(self, ids: List[int]) -> Dict[int, Node]:
+        nodes, missing = self._lookup(ids)
+        # fetch all cache misses with a single round trip
+        if missing:
+            stats.count('nodes_fetched', len(missing))
+            epochs = [self._epochs[id % _LOCK_STRIPES] for id in missing]
+            fetched = self._storage.get_neighbors_many(missing)
+            self._admit(nodes, missing, epochs, fetched)
+        return nodes
+
+    async def _find_nodes_async(self, ids: List[int]) -> Dict[int, Node]:
+        nodes, missing = self._lookup(ids)
+        if missing:
+            stats.count('nodes_fetched', len(missing))
+            epochs = [self._epochs[id % _LOCK_STRIPES] for id in missing]
+            fetched = await self._storage.get_neighbors_many_async(missing)
+            self._admit(nodes, missing, epochs, fetched)
+        return nodes
+
+    def _lookup(self, ids: List[int]) -> Tuple[Dict[int, Node], List[int]]:
+        pending = self._pending_nodes
+        if not self._storage.remote:
+            # reads of a local storage are as cheap as the cache
+            if not pending:
+                return {}, list(ids)
+            nodes = {id: pending[id] for id in ids if id in pending}
+            return nodes, [id for id in ids if id not in nodes]
+        nodes: Dict[int, Node] = {}
+        missing: List[int] = []
+        for id in ids:
+            node = pending.get(id)
+            if node is None:
+                node = self._cache.get(id)
+            if node is None:
+                missing.append(id)
+            else:
+                nodes[id] = node
+        query_stats = stats.current()
+        if query_stats is not None:
+            query_stats.add('cache_hits', len(nodes))
+            query_stats.add('cache_misses', len(missing))
+        return nodes, missing
+
+    def _admit(self, nodes: Dict[int, Node], missing: List[int], epochs: List[int],
+               fetched: Dict[int, Tuple[np.ndarray, Dict[int, List[int]]]]):
+        ''' Add the fetched nodes to nodes, ids absent from storage are left out
+        '''
+        for id, epoch in zip(missing, epochs):
+            if id not in fetched:
+                continue
+            vec, neighbor_ids = fetched[id]
+            if not self._storage.remote:
+                # a view of the local store, distances then use its cached norms
+                point = None if self._storage.store is None else self._storage.store.get(id)
+                node = Node(Point(id, vec) if point is None else point, neighbor_ids)
+            elif epoch == self._epochs[id % _LOCK_STRIPES]:
+                node = Node(self._store.add(id, vec), neighbor_ids)
+                self._cache.add(node)
+                # a write invalidating id between the check and the add found nothing
+                # to drop, the stale node is dropped here instead
+                if epoch != self._epochs[id % _LOCK_STRIPES]:
+                    self._cache.remove(id)
+            else:
+                # a write may have raced with the fetch, use it but don't cache it
+                node = Node(Point(id, vec), neighbor_ids)
+            nodes[id] = node
+
+    def _release(self, node: Node):
+        if self._store.get(node.id) is node.point:
+            self._store.remove(node.id)
+
+    def get_nodes(self, ids: List[int]) -> List[Node]:
+        ''' Nodes of ids, i.e. points together with their neighbors on all layers
+        '''
+        return self._get_nodes(ids)
+
+    def find_nodes(self, ids: List[int]) -> List[Node]:
+        ''' Nodes of the ids present in the graph, absent ids are left out
+        '''
+        nodes = self._find_nodes(ids)
+        return [nodes[id] for id in ids if id in nodes]
+
+    def get_neighbors(self, layer: int, p: Point) -> List[Point]:
+        return self.get_points(self.get_neighbor_ids(layer, p.id))
 
     def get_point(self, id: int) -> Point:
-        vec_str, neighbor_ids = self._client.get_neighbors(id)
-        vec = np.fromstring(vec_str)
-        p = Point(id, vec)
-        self._nodes[id] = Node(p, neighbor_ids)
-        return p
-
-    def get_neighbor_ids(self, layer: int, id: int) -> List[int]:
-        assert id in self._nodes and layer in self._nodes[id]
+        return self._get_node(id).point
+
+    def get_points(self, ids: List[int]) -> List[Point]:
+        points = self.find_points(ids)
+        if len(points) < len(ids):
+            found = {p.id for p in points}
+            raise RuntimeError(f"fetch no result of {next(id for id in ids if id not in found)}")
+        return points
+
+    def find_points(self, ids: List[int]) -> List[Point]:
+        ''' Points of the ids present in the graph, absent ids are left out
+
+        Searches read the graph with it, as a compaction may remove points
+        while they walk edges to them.
+        '''
+        pinned = self._pinned
+        if pinned is not None:
+            points = [pinned.store.get(id) for id in ids]
+            missing = [id for id, p in zip(ids, points) if p is None]
+            if missing:
+                found = {p.id: p for p in self._find_points(missing)}
+                points = [found.get(id) if p is None else p for id, p in zip(ids, points)]
+            return [p for p in points if p is not None]
+        return self._find_points(ids)
+
+    def _find_points(self, ids: List[int]) -> List[Point]:
+        store = self._storage.store
+        if not self._storage.remote and store is not None and not self._pending_nodes:
+            # straight from the local store, neighbor lists are not needed
+            return [p for p in (store.get(id) for id in ids) if p is not None]
+        nodes = self._find_nodes(ids)
+        return [nodes[id].point for id in ids if id in nodes]
+
+    async def get_points_async(self, ids: List[int]) -> List[Point]:
+        points = await self._find_points_async(ids)
+        for id in ids:
+            if id not in points:
+                raise RuntimeError(f"fetch no result of {id}")
+        return [points[id] for id in ids]
+
+    async def find_points_async(self, ids: List[int]) -> List[Point]:
+        ''' Same as find_points
+        '''
+        points = await self._find_points_async(ids)
+        return [points[id] for id in ids if id in points]
+
+    async def _find_points_async(self, ids: List[int]) -> Dict[int, Point]:
+        points: Dict[int, Point] = {}
+        pinned = self._pinned
+        if pinned is not None:
+            for id in ids:
+                p = pinned.store.get(id)
+                if p is not None:
+                    points[id] = p
+            ids = [id for id in ids if id not in points]
+        if ids:
+            points.update((id, node.point) for id, node in (await self._find_nodes_async(ids)).items())
+        return points
+
+    def get_neighbor_ids(self, layer: int, id: int, load_node: bool = True) -> List[int]:
+        ''' load_node: on a cache miss fetch and cache the whole node, else read the edges only
+        '''
+        neighbor_ids = self._neighbor_ids(layer, id, load_node)
+        if neighbor_ids is None:
+            raise RuntimeError(f"fetch no result of {id}")
+        return neighbor_ids
+
+    def find_neighbor_ids(self, layer: int, id: int, load_node: bool = True) -> List[int]:
+        ''' Same as get_neighbor_ids, but an id absent from the graph has no neighbors
+        '''
+        neighbor_ids = self._neighbor_ids(layer, id, load_node)
+        return [] if neighbor_ids is None else neighbor_ids
+
+    def _neighbor_ids(self, layer: int, id: int, load_node: bool) -> Optional[List[int]]:
+        ''' Neighbors of id on layer, None if id is absent
+        '''
+        assert 0 <= layer <= self._max_top_layer
+
+        neighbor_ids = self._pinned_neighbor_ids(layer, id)
+        if neighbor_ids is not None:
+            return neighbor_ids
+        node = self._pending_nodes.get(id)
+        if node is not None:
+            return node.layer_neighbors(layer)
+        if not self._storage.remote:
+            return self._layer_neighbors(layer, id)
+        if not load_node:
+            node = self._cache.get(id)
+            if node is None:
+                stats.count('cache_misses')
+                return self._layer_neighbors(layer, id)
+            stats.count('cache_hits')
+            return node.layer_neighbors(layer)
+        node = self._find_nodes([id]).get(id)
+        return None if node is None else node.layer_neighbors(layer)
+
+    def _layer_neighbors(self, layer: int, id: int) -> Optional[List[int]]:
+        try:
+            return self._storage.get_layer_neighbors(layer, id)
+        except KeyError:
+            return None
+
+    async def get_neighbor_ids_async(self, layer: int, id: int) -> List[int]:
+        neighbor_ids = await self._neighbor_ids_async(layer, id)
+        if neighbor_ids is None:
+            raise RuntimeError(f"fetch no result of {id}")
+        return neighbor_ids
+
+    async def find_neighbor_ids_async(self, layer: int, id: int) -> List[int]:
+        ''' Same as find_neighbor_ids
+        '''
+        neighbor_ids = await self._neighbor_ids_async(layer, id)
+        return [] if neighbor_ids is None else neighbor_ids
+
+    async def _neighbor_ids_async(self, layer: int, id: int) -> Optional[List[int]]:
         assert 0 <= layer <= self._max_top_layer
 
-        return self._nodes[id].layer_neighbors(layer)
+        neighbor_ids = self._pinned_neighbor_ids(layer, id)
+        if neighbor_ids is not None:
+            return neighbor_ids
+        node = (await self._find_nodes_async([id])).get(id)
+        return None if node is None else node.layer_neighbors(layer)
+
+    def _pinned_neighbor_ids(self, layer: int, id: int) -> Optional[List[int]]:
+        pinned = self._pinned
+        if pinned is None or layer < self._pin_layer:
+            return None
+        try:
+            return pinned.get_layer_neighbors(layer, id)
+        except KeyError:
+            return None
@@ -1,17 +1,124 @@
 #!/usr/bin/env python3
 
+import asyncio
 import random
-from typing import List, Dict
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple, Union
 
-from merak.graph import LayeredGraph
-from merak.point import Point, Points
+import numpy as np
+
+from merak import snapshot
+from merak.filter import Filter, PredicateFilter, as_filter
+from merak.graph import LayeredGraph, Node
+from merak.metric import Metric, get_metric
+from merak.point import Point, DistanceQueue, batch_distance
+from merak.point_store import PointStore
+from merak.quantizer import DistanceTable, Quantizer
+from merak.result_cache import ResultCache
+from merak.stats import QueryStats, count, current, measure
+from merak.storage import Storage
 
 
 class HNSW:
-    def __init__(self, max_top_layer: int) -> None:
-        self._graph = LayeredGraph(max_top_layer)
+    def __init__(self, max_top_layer: int, storage: Storage = None,
+                 metric: Union[str, Metric] = 'l2', quantizer: Quantizer = None,
+                 graph: LayeredGraph = None, brute_force_limit: int = 1024,
+                 compact_ratio: float = 0.1, compact_batch: int = 256, compact_min: int = 100,
+                 result_cache: ResultCache = None) -> None:
+        '''
+        storage: backend of the graph, in process memory by default
+        metric: l2, l2sq, ip or cosine, see merak.metric. Fixed for the life of the index.
+        quantizer: if given, knn_search walks the graph on compact codes and re-ranks
+            the final candidates with full vectors. Train it before inserting, see
+            train_quantizer.
+        graph: an existing graph to serve, e.g. one loaded from a snapshot, storage is ignored
+        brute_force_limit: filtered searches allowing at most this many ids skip the graph
+            and score all of them
+        compact_ratio: a delete leaving more tombstones than this fraction of the points
+            starts a compaction in the background, see compact
+        compact_batch: number of deleted points reconnected with one write
+        compact_min: fewest tombstones a delete starts a compaction with. A remote graph
+            reopened without its size (see LayeredGraph) counts only the points added
+            since, by ratio alone it would compact after every delete.
+        result_cache: if given, knn_search answers repeated queries from it, see merak.result_cache
+        '''
+        self._result_cache = result_cache
+        self._brute_force_limit = brute_force_limit
+        self._compact_ratio = compact_ratio
+        self._compact_batch = compact_batch
+        self._compact_min = compact_min
+        # one compaction at a time, run by a single background thread
+        self._compact_lock = threading.Lock()
+        self._compactor: Optional[ThreadPoolExecutor] = None
+        self._compaction: Optional[Future] = None
+        self._graph = LayeredGraph(max_top_layer, storage) if graph is None else graph
+        self._metric = get_metric(metric)
+        self._quantizer = quantizer
+        # codes of the points, kept in process memory and saved with snapshots.
+        # Filled lazily for points inserted by another process.
+        self._codes = PointStore(np.uint8)
+
+    @property
+    def graph(self) -> LayeredGraph:
+        return self._graph
+
+    @property
+    def metric(self) -> Metric:
+        return self._metric
+
+    @property
+    def quantizer(self) -> Quantizer:
+        return self._quantizer
+
+    @property
+    def codes(self) -> PointStore:
+        return self._codes
+
+    @property
+    def result_cache(self) -> Optional[ResultCache]:
+        return self._result_cache
+
+    def save(self, path: str):
+        ''' Write a snapshot of the index into directory path, see merak.snapshot
+        '''
+        snapshot.save(self._graph, path, self._metric.name,
+                      self._codes if self._quantizer is not None else None)
 
-    def __search_layer(self, q: Point, ep: List[int], ef: int, l: int) -> List[Point]:
+    @classmethod
+    def load(cls, path: str, base: Storage = None, quantizer: Quantizer = None) -> 'HNSW':
+        ''' Serve the snapshot at path, writes go to base, see merak.snapshot.SnapshotStorage
+
+        quantizer: the trained quantizer of the saved index, its codes are restored
+            from the snapshot instead of encoding every point on its first visit
+        '''
+        graph = snapshot.load(path, base)
+        metric = graph.storage.manifest['metric'] or 'l2'
+        hnsw = cls(graph.max_top_layer, metric=metric, quantizer=quantizer, graph=graph)
+        codes = snapshot.read_codes(path) if quantizer is not None else None
+        if codes is not None:
+            for id, code in zip(*codes):
+                hnsw._codes.add(int(id), code)
+        return hnsw
+
+    def flush(self):
+        ''' Write the inserts buffered by a write_behind graph, see LayeredGraph
+        '''
+        self._graph.flush()
+
+    def train_quantizer(self, vectors: np.ndarray):
+        ''' Train the quantizer on a sample of the vectors to be inserted
+        '''
+        assert self._quantizer is not None
+        self._quantizer.train(self._metric.prepare(np.asarray(vectors)))
+
+    def __prepare(self, q: Point) -> Point:
+        ''' q as the metric stores and searches it, e.g. normalized for cosine
+        '''
+        vec = self._metric.prepare(q.vec)
+        return q if vec is q.vec else Point(q.id, vec)
+
+    def __search_layer(self, q: Point, ep: List[int], ef: int, l: int, allowed: Filter = None) -> List[Point]:
         ''' Search closest ef points in layer l, with ep as the entry point set
 
         Args:
@@ -19,38 +126,271 @@ class HNSW:
             ep: entry points
             ef: number of nearest to q points to return
             l: layer number
+            allowed: if given, only points it allows are returned
 
         Returns:
             ef closest neighbors to q
         '''
         assert isinstance(ep, List)
 
-        visited = {point_id for point_id in ep}
-        ep = [self._graph.get_point(id) for id in ep]  # transform from id to point
-        result = Points(q, False, ep)
-        candidates = Points(q, True, ep)
+        ep = self.__find_entry(ep)  # transform from id to point
+        visited = {p.id for p in ep}
+        points: Dict[int, Point] = {p.id: p for p in ep}
+        result = DistanceQueue(ef)
+        candidates = DistanceQueue()
+        for p, dist in zip(ep, batch_distance(q, ep, self._metric)):
+            self.__admit(result, candidates, dist, p.id, allowed)
 
         while len(candidates) > 0:
-            curr = candidates.pop_nearest()
-            furthest_res = result.furthest()
+            # distances are kept in the heaps, never recomputed
+            curr_dist, curr_id = candidates.pop_nearest()
 
-            if curr.distance(q) > furthest_res.distance(q):
+            if result.full() and curr_dist > result.furthest()[0]:
                 break
 
-            for next_id in self._graph.get_neighbor_ids(l, curr.id):
-                if next_id in visited:
+            # fetch the whole unvisited neighborhood of curr in one call,
+            # and score it against q with one vectorized distance call
+            # a compaction may remove points meanwhile, they are skipped
+            next_ids = [id for id in self._graph.find_neighbor_ids(l, curr_id) if id not in visited]
+            visited.update(next_ids)
+            next_points = self._graph.find_points(next_ids)
+            for next_point, next_dist in zip(next_points, batch_distance(q, next_points, self._metric)):
+                # admitted only if result is not full or next is nearer than its furthest
+                if self.__admit(result, candidates, next_dist, next_point.id, allowed):
+                    points[next_point.id] = next_point
+
+        self.__count_visited(l, len(visited))
+        return [points[id] for _, id in result.sorted()]
+
+    def __find_entry(self, ep: List[int]) -> List[Point]:
+        ''' Points of ep present in the graph. If a compaction removed all of them
+        meanwhile, the walk restarts from the current entry point.
+        '''
+        points = self._graph.find_points(ep)
+        if len(ep) > 0 and len(points) == 0:
+            points = self._graph.find_points(self.__entry_ids())
+        return points
+
+    def __entry_ids(self) -> List[int]:
+        entry_point, _ = self._graph.entry()
+        return [] if entry_point is None else [entry_point]
+
+    @staticmethod
+    def __admit(result: DistanceQueue, candidates: DistanceQueue, dist: float, id: int,
+                allowed: Optional[Filter]) -> bool:
+        ''' Push a scored point to result and candidates, returns whether it became a candidate
+
+        A point the filter rejects is still a candidate to walk through, but never
+        enters result.
+        '''
+        if allowed is None:
+            if result.push(dist, id):
+                candidates.push(dist, id)
+                return True
+            return False
+        if result.full() and dist >= result.furthest()[0]:
+            return False
+        candidates.push(dist, id)
+        if allowed(id):
+            result.push(dist, id)
+        return True
+
+    @staticmethod
+    def __count_visited(l: int, n: int):
+        query_stats = current()
+        if query_stats is not None:
+            query_stats.add_visited(l, n)
+
+    def __search_layer_codes(self, table: DistanceTable, ep: List[int], ef: int,
+                             l: int, allowed: Filter = None) -> List[Tuple[float, int]]:
+        ''' Same as __search_layer, but scores codes instead of full vectors
+
+        Only neighbor ids are read from the graph, so a hop fetches no vector.
+
+        Returns:
+            (approximate distance, id) of the ef closest neighbors, nearest first
+        '''
+        assert isinstance(ep, List)
+
+        ep_ids, ep_distances = self.__code_distances(table, ep)
+        if len(ep) > 0 and len(ep_ids) == 0:
+            # removed by a compaction meanwhile, see __find_entry
+            ep_ids, ep_distances = self.__code_distances(table, self.__entry_ids())
+        visited = set(ep_ids)
+        result = DistanceQueue(ef)
+        candidates = DistanceQueue()
+        for id, dist in zip(ep_ids, ep_distances):
+            self.__admit(result, candidates, dist, id, allowed)
+
+        while len(candidates) > 0:
+            curr_dist, curr_id = candidates.pop_nearest()
+
+            if result.full() and curr_dist > result.furthest()[0]:
+                break
+
+            next_ids = [id for id in self._graph.find_neighbor_ids(l, curr_id, load_node=False)
+                        if id not in visited]
+            visited.update(next_ids)
+            for next_id, next_dist in zip(*self.__code_distances(table, next_ids)):
+                self.__admit(result, candidates, next_dist, next_id, allowed)
+
+        self.__count_visited(l, len(visited))
+        return result.sorted()
+
+    def __code_distances(self, table: DistanceTable, ids: List[int]) -> Tuple[List[int], np.ndarray]:
+        ''' Approximate distances of the ids present in the graph, and those ids
+        '''
+        missing = [id for id in ids if id not in self._codes]
+        if missing:
+            for p in self._graph.find_points(missing):
+                self._codes.add(p.id, self._quantizer.encode(p.vec))
+            ids = [id for id in ids if id in self._codes]
+        if len(ids) == 0:
+            return ids, np.empty(0)
+        count('distance_evals', len(ids))
+        return ids, table.distances(self._codes.gather(ids))
+
+    def __search_layer_batch(self, queries: np.ndarray, ep: List[List[int]], ef: int, l: int,
+                             nodes: Dict[int, Node], allowed: Filter = None) -> List[List[Tuple[float, int]]]:
+        ''' Run __search_layer for many queries in lockstep
+
+        Every round each walk still running expands its nearest candidate. The
+        unvisited neighbors of all expanded nodes are fetched together, and all
+        (query, neighbor) distances are computed with one numpy call.
+
+        Args:
+            queries: query matrix, one row per query
+            ep: entry points of every query
+            ef: number of nearest to q points to return
+            l: layer number
+            nodes: nodes loaded by the batch so far, shared by all layers
+            allowed: if given, only points it allows are returned
+
+        Returns:
+            (distance, id) of the ef closest neighbors of every query, nearest first
+        '''
+        n = len(queries)
+        visited = [set(ids) for ids in ep]
+        result = [DistanceQueue(ef) for _ in range(n)]
+        candidates = [DistanceQueue() for _ in range(n)]
+
+        pair_queries = [i for i in range(n) for _ in ep[i]]
+        pair_ids = [id for ids in ep for id in ids]
+        active = list(range(n))
+        while True:
+            self.__load_nodes(pair_ids, nodes)
+            # points removed by a compaction meanwhile are skipped
+            if any(id not in nodes for id in pair_ids):
+                pairs = [(i, id) for i, id in zip(pair_queries, pair_ids) if id in nodes]
+                pair_queries, pair_ids = [i for i, _ in pairs], [id for _, id in pairs]
+            for i, id, dist in zip(pair_queries, pair_ids,
+                                   self.__pair_distance(queries, pair_queries, pair_ids, nodes)):
+                self.__admit(result[i], candidates[i], dist, id, allowed)
+
+            # every walk still running expands its nearest candidate
+            expanding = []
+            for i in active:
+                if len(candidates[i]) == 0:
                     continue
-                visited.add(next_id)
+                curr_dist, curr_id = candidates[i].pop_nearest()
+                if result[i].full() and curr_dist > result[i].furthest()[0]:
+                    continue
+                expanding.append((i, curr_id))
+            if len(expanding) == 0:
+                break
+            active = [i for i, _ in expanding]
+
+            pair_queries, pair_ids = [], []
+            for i, curr_id in expanding:
+                for next_id in nodes[curr_id].layer_neighbors(l):
+                    if next_id not in visited[i]:
+                        visited[i].add(next_id)
+                        pair_queries.append(i)
+                        pair_ids.append(next_id)
+
+        self.__count_visited(l, sum(len(ids) for ids in visited))
+        return [queue.sorted() for queue in result]
+
+    def __load_nodes(self, ids: List[int], nodes: Dict[int, Node]):
+        ''' Fetch the nodes of ids not loaded by the batch yet, with one call. Ids
+        absent from the graph stay out of nodes.
+        '''
+        missing = list({id for id in ids if id not in nodes})
+        for node in self._graph.find_nodes(missing):
+            nodes[node.id] = node
 
-                furthest_res = result.furthest()
-                next_point = self._graph.get_point(next_id)
-                if next_point.distance(q) < furthest_res.distance(q) or len(result) < ef:
-                    candidates.push(next_point)
-                    result.push(next_point)
-                    while len(result) > ef:
-                        result.pop_furthest()
+    def __pair_distance(self, queries: np.ndarray, pair_queries: List[int], pair_ids: List[int],
+                        nodes: Dict[int, Node]) -> np.ndarray:
+        ''' Distance between queries[pair_queries[i]] and point pair_ids[i] for every i
+        '''
+        if len(pair_ids) == 0:
+            return np.empty(0)
+        count('distance_evals', len(pair_ids))
+        # stack every distinct vector once, then gather both sides of all pairs
+        unique_ids, inverse = np.unique(pair_ids, return_inverse=True)
+        vecs = np.stack([nodes[id].point.vec for id in unique_ids.tolist()])
+        return self._metric.rowwise(queries[pair_queries], vecs[inverse])
+
+    async def __expand_async(self, l: int, id: int, visited: Set[int]) -> List[Point]:
+        ''' Fetch the neighbors of id in layer l which are not visited yet
+        '''
+        next_ids = [next_id for next_id in await self._graph.find_neighbor_ids_async(l, id)
+                    if next_id not in visited]
+        return await self._graph.find_points_async(next_ids)
+
+    async def __search_layer_async(self, q: Point, ep: List[int], ef: int, l: int,
+                                   prefetch: int, allowed: Filter = None) -> List[Point]:
+        ''' Same as __search_layer, but pipelined
+
+        While a node is scored, the neighborhoods of the next best candidates are
+        fetched speculatively, with at most prefetch fetches in flight. Nodes are
+        expanded in the same order as __search_layer, so results are the same.
+        '''
+        assert isinstance(ep, List)
 
-        return result.values
+        ep_ids = ep
+        ep = await self._graph.find_points_async(ep_ids)
+        if len(ep_ids) > 0 and len(ep) == 0:
+            # removed by a compaction meanwhile, see __find_entry
+            ep = await self._graph.find_points_async(self.__entry_ids())
+        visited = {p.id for p in ep}
+        points: Dict[int, Point] = {p.id: p for p in ep}
+        result = DistanceQueue(ef)
+        candidates = DistanceQueue()
+        for p, dist in zip(ep, batch_distance(q, ep, self._metric)):
+            self.__admit(result, candidates, dist, p.id, allowed)
+
+        # candidate id -> fetch of its neighborhood
+        in_flight: Dict[int, asyncio.Future] = {}
+        try:
+            while len(candidates) > 0:
+                curr_dist, curr_id = candidates.pop_nearest()
+
+                if result.full() and curr_dist > result.furthest()[0]:
+                    break
+
+                task = in_flight.pop(curr_id, None)
+                if task is None:
+                    task = asyncio.ensure_future(self.__expand_async(l, curr_id, visited))
+                for _, next_id in candidates.nearest_n(prefetch):
+                    if len(in_flight) >= prefetch:
+                        break
+                    if next_id not in in_flight:
+                        in_flight[next_id] = asyncio.ensure_future(
+                            self.__expand_async(l, next_id, visited))
+
+                # points may have been visited since the fetch was issued
+                next_points = [p for p in await task if p.id not in visited]
+                visited.update(p.id for p in next_points)
+                for next_point, next_dist in zip(next_points, batch_distance(q, next_points, self._metric)):
+                    if self.__admit(result, candidates, next_dist, next_point.id, allowed):
+                        points[next_point.id] = next_point
+        finally:
+            for task in in_flight.values():
+                task.cancel()
+
+        self.__count_visited(l, len(visited))
+        return [points[id] for _, id in result.sorted()]
 
     def __select_neighbors_simple(self, q: Point, candidates: List[Point], m: int) -> List[Point]:
         ''' Select m nearest points from candidates to q 
@@ -67,8 +407,8 @@ class HNSW:
         assert q is not None
         assert len(candidates) >= m
 
-        points = Points(q, True, candidates)
-        return [points.pop_nearest() for i in range(0, m)]
+        order = np.argsort(batch_distance(q, candidates, self._metric), kind='stable')
+        return [candidates[i] for i in order[:m]]
 
     def __select_neighbors_heuristic(self, q: Point, c: List[int],
                                      m: int, l: int, extend: bool = True, keep: bool = True) -> List[Point]:
@@ -86,96 +426,420 @@ class HNSW:
             m points selected by the heuristic
         '''
 
-        candidate_points = [self._graph.get_point(id) for id in c]
-        result = Points(q, nearest=True)
-        candidates = Points(q, nearest=True, points=candidate_points)
-
+        # candidates a compaction removed meanwhile are left out
+        candidate_points = self._graph.find_points(c)
         if extend:
-            for p in candidate_points:
-                for next_id in self._graph.get_neighbor_ids(l, p.id):
-                    if next_id not in candidates:
-                        next_point = self._graph.get_point(next_id)
-                        candidates.push(next_point)
-
-        to_discard = Points(q, nearest=True)
-        while len(candidates) > 0 and len(result) < m:
-            curr = candidates.pop_nearest()
-            # TODO(spw): is this condition right?
-            if len(result) == 0 or curr.distance(q) < result.nearest().distance(q):
-                if curr != q:
-                    result.push(curr)
+            extend_ids = {next_id for p in candidate_points
+                          for next_id in self._graph.find_neighbor_ids(l, p.id)
+                          if not self._graph.is_deleted(next_id)} - set(c)
+            candidate_points += self._graph.find_points(list(extend_ids))
+
+        return self.__prune(q, candidate_points, m, keep)
+
+    def __prune(self, q: Point, candidates: List[Point], m: int, keep: bool = True) -> List[Point]:
+        ''' The neighbor selection heuristic on points already loaded
+
+        A candidate is selected only if it is nearer to q than to every point
+        selected before it, which keeps neighbors spread around q.
+
+        Args:
+            q: base element
+            candidates: candidate points
+            m: number of neighbors to return
+            keep: flag indicating whether or not to add discarded points
+
+        Returns:
+            at most m points, q itself excluded
+        '''
+        candidates = list({p.id: p for p in candidates if p.id != q.id}.values())
+        distances = batch_distance(q, candidates, self._metric)
+
+        result: List[Point] = []
+        discarded: List[Point] = []
+        for i in np.argsort(distances, kind='stable'):
+            if len(result) >= m:
+                break
+            curr = candidates[i]
+            if len(result) == 0 or distances[i] < batch_distance(curr, result, self._metric).min():
+                result.append(curr)
             else:
-                to_discard.push(curr)
+                discarded.append(curr)
 
         if keep:
-            while len(to_discard) > 0 and len(result) < m:
-                curr = to_discard.pop_nearest()
-                if curr != 1:
-                    result.push(curr)
-
-        return result.values
+            result += discarded[:m - len(result)]
+        return result
 
-    def knn_search(self, q: Point, k: int, ef: int) -> List[Point]:
+    def knn_search(self, q: Point, k: int, ef: int, stats: QueryStats = None,
+                   filter: Union[Filter, Iterable[int], np.ndarray, Callable[[int], bool]] = None) -> List[Point]:
         ''' Search the nearest k points for q
 
         Args:
             q: query element
             k: number of nearest neighbors to return
             ef: size of the dynamic candidate list
+            stats: filled in with the counters of this call, see merak.stats
+            filter: only return points it allows, an id allow-list, a bool bitmap
+                indexed by id, a predicate on ids or a Filter, see merak.filter.
+                An allow-list of at most brute_force_limit ids is searched by brute force.
         Returns:
             K nearest elements to q
         '''
-        entry_points = [] if self._graph.entry_point is None else [self._graph.entry_point]
-
-        for l in range(self._graph.top_layer, 0, -1):
+        with measure('knn_search', stats):
+            allowed = as_filter(filter)
+            if self._result_cache is None:
+                return self.__knn_search(q, k, ef, allowed)
+            # read before searching, a write during the search makes the entry stale
+            version = self._graph.version
+            return self._result_cache.search(q.vec, k, ef, allowed, version,
+                                             lambda n: self.__knn_search(q, n, ef, allowed))
+
+    def __knn_search(self, q: Point, k: int, ef: int, allowed: Optional[Filter]) -> List[Point]:
+        q = self.__prepare(q)
+        if allowed is not None and allowed.size() is not None and allowed.size() <= self._brute_force_limit:
+            return self.__brute_force(q, k, allowed.ids())
+        allowed = self.__live(allowed)
+        if self._quantizer is not None:
+            return self.__knn_search_quantized(q, k, ef, allowed)
+        entry_point, top_layer = self._graph.entry()
+        entry_points = [] if entry_point is None else [entry_point]
+
+        # the filter only applies to the results, i.e. to layer 0
+        for l in range(top_layer, 0, -1):
             nearest_points = self.__search_layer(q, entry_points, 1, l)
-            entry_points = [Points(q, True, nearest_points).pop_nearest()]
-        nearest_points = self.__search_layer(q, entry_points, ef, 0)
+            entry_points = [p.id for p in nearest_points[:1]]
+        nearest_points = self.__search_layer(q, entry_points, ef, 0, allowed)
+
+        # __search_layer returns points ordered from the nearest
+        return nearest_points[:k]
+
+    def __brute_force(self, q: Point, k: int, ids: np.ndarray) -> List[Point]:
+        ''' The exact k nearest of ids, allowed ids absent from the graph are skipped
+        '''
+        points = self._graph.find_points([id for id in ids.tolist() if not self._graph.is_deleted(id)])
+        order = np.argsort(batch_distance(q, points, self._metric), kind='stable')
+        return [points[i] for i in order[:k]]
+
+    def __live(self, allowed: Optional[Filter]) -> Optional[Filter]:
+        ''' allowed without the tombstoned points
+        '''
+        if self._graph.tombstone_count == 0:
+            return allowed
+        is_deleted = self._graph.is_deleted
+        if allowed is None:
+            return PredicateFilter(lambda id: not is_deleted(id))
+        return PredicateFilter(lambda id: not is_deleted(id) and allowed(id))
+
+    def __knn_search_quantized(self, q: Point, k: int, ef: int, allowed: Filter = None) -> List[Point]:
+        table = self._quantizer.table(q.vec, self._metric)
+        entry_point, top_layer = self._graph.entry()
+        entry_points = [] if entry_point is None else [entry_point]
+
+        for l in range(top_layer, 0, -1):
+            nearest = self.__search_layer_codes(table, entry_points, 1, l)
+            entry_points = [id for _, id in nearest[:1]]
+        nearest = self.__search_layer_codes(table, entry_points, ef, 0, allowed)
+
+        # re-rank the ef candidates with their full vectors, fetched together
+        points = self._graph.find_points([id for _, id in nearest])
+        order = np.argsort(batch_distance(q, points, self._metric), kind='stable')
+        return [points[i] for i in order[:k]]
+
+    async def knn_search_async(self, q: Point, k: int, ef: int, prefetch: int = 4,
+                               stats: QueryStats = None) -> List[Point]:
+        ''' Search the nearest k points for q, hiding fetch latency with prefetching
+
+        Args:
+            q: query element
+            k: number of nearest neighbors to return
+            ef: size of the dynamic candidate list
+            prefetch: max number of speculative neighborhood fetches in flight
+            stats: filled in with the counters of this call, see merak.stats
+        Returns:
+            K nearest elements to q, the same as knn_search
+        '''
+        with measure('knn_search_async', stats):
+            return await self.__knn_search_async(q, k, ef, prefetch)
+
+    async def __knn_search_async(self, q: Point, k: int, ef: int, prefetch: int = 4) -> List[Point]:
+        q = self.__prepare(q)
+        entry_point, top_layer = self._graph.entry()
+        entry_points = [] if entry_point is None else [entry_point]
+
+        for l in range(top_layer, 0, -1):
+            nearest_points = await self.__search_layer_async(q, entry_points, 1, l, prefetch)
+            entry_points = [p.id for p in nearest_points[:1]]
+        nearest_points = await self.__search_layer_async(q, entry_points, ef, 0, prefetch,
+                                                         self.__live(None))
+
+        return nearest_points[:k]
 
-        num = min(len(nearest_points), k)
-        points = Points(q, True, nearest_points)
-        return [points.pop_nearest() for _ in range(num)]
+    def knn_search_batch(self, queries: np.ndarray, k: int, ef: int,
+                         stats: QueryStats = None) -> Tuple[np.ndarray, np.ndarray]:
+        ''' Search the nearest k points for every row of queries
 
-    def insert(self, q: Point, m: int, m_max: int, ef: int, ml: int):
+        The walks of all queries run together, so every vertex is fetched at most
+        once per batch however many walks pass through it.
+
+        Args:
+            queries: query matrix, one row per query
+            k: number of nearest neighbors to return
+            ef: size of the dynamic candidate list
+            stats: filled in with the counters of this call, see merak.stats
+        Returns:
+            ids and metric distances of shape (len(queries), k), nearest first. Rows with
+            less than k results are padded with id -1 and distance inf.
+        '''
+        with measure('knn_search_batch', stats):
+            return self.__knn_search_batch(queries, k, ef)
+
+    def __knn_search_batch(self, queries: np.ndarray, k: int, ef: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = self._metric.prepare(np.atleast_2d(queries))
+        n = len(queries)
+        ids = np.full((n, k), -1, dtype=np.int64)
+        distances = np.full((n, k), np.inf)
+
+        entry_point, top_layer = self._graph.entry()
+        if entry_point is None:
+            return ids, distances
+
+        nodes: Dict[int, Node] = {}
+        entry_points = [[entry_point] for _ in range(n)]
+        for l in range(top_layer, 0, -1):
+            nearest = self.__search_layer_batch(queries, entry_points, 1, l, nodes)
+            # a walk whose entry points were all removed restarts from the entry point
+            entry_points = [[pairs[0][1]] if pairs else self.__entry_ids() for pairs in nearest]
+        nearest = self.__search_layer_batch(queries, entry_points, ef, 0, nodes, self.__live(None))
+
+        for i, pairs in enumerate(nearest):
+            pairs = pairs[:k]
+            ids[i, :len(pairs)] = [id for _, id in pairs]
+            distances[i, :len(pairs)] = [dist for dist, _ in pairs]
+        return ids, distances
+
+    def insert(self, q: Point, m: int, m_max: int, ef: int, ml: int, m_max0: int = None,
+               stats: QueryStats = None):
         ''' Insert element to graph with 
 
+        Safe to call from several threads at once, see insert_many.
+
         Args:
             q: new element
             m: number of established connections
             m_max: maximum number of connections for each element per layer
             ef: size of the dynamic candidate list
             ml: normalization factor for level generation
+            m_max0: maximum number of connections on layer 0, 2 * m_max by default
+            stats: filled in with the counters of this call, see merak.stats
         '''
-        add_batch = self._graph.add_batch()
-
-        entry_points: List[Point] = [] if self._graph.entry_point is None else [
-            self._graph.entry_point]
+        with measure('insert', stats):
+            self.__insert_point(q, m, m_max, ef, ml, m_max0)
+
+    def __insert_point(self, q: Point, m: int, m_max: int, ef: int, ml: int, m_max0: int):
+        if m_max0 is None:
+            m_max0 = 2 * m_max
+        q = self.__prepare(q)
+        if self._quantizer is not None:
+            # the code exists before any search can reach q
+            self._codes.add(q.id, self._quantizer.encode(q.vec))
         new_layer = 0
         while new_layer < ml and random.randint(0, 10000) % 2 == 1:
             new_layer += 1
-        add_batch.add_point(p)
+
+        # the first point and points above the top layer move the entry point,
+        # they are inserted holding the entry lock so no other insert races them
+        entry_lock = self._graph.entry_lock
+        hold_entry = new_layer > self._graph.top_layer
+        if hold_entry:
+            entry_lock.acquire()
+        try:
+            self.__insert(q, new_layer, m, m_max, m_max0, ef)
+        finally:
+            if hold_entry:
+                entry_lock.release()
+
+    def insert_many(self, points: List[Point], m: int, m_max: int, ef: int, ml: int,
+                    m_max0: int = None, workers: int = 8):
+        ''' Insert points with a pool of threads, see insert for the arguments
+
+        Nebula round trips dominate insert time and numpy releases the GIL in
+        distance computations, so inserts overlap well.
+        '''
+        with ThreadPoolExecutor(workers) as executor:
+            futures = [executor.submit(self.insert, p, m, m_max, ef, ml, m_max0) for p in points]
+            for future in futures:
+                future.result()
+
+    def delete(self, id: int):
+        ''' Delete the point of id
+
+        The point is tombstoned: searches leave it out of their results at once,
+        but still route through it. Once there are compact_min tombstones and
+        they exceed compact_ratio of the points, a background compaction
+        reconnects their neighbors and removes them, see compact.
+        '''
+        if len(self._graph.find_points([id])) == 0:
+            raise KeyError(id)
+        self._graph.tombstone(id)
+        if (self._graph.tombstone_count >= self._compact_min and
+                self._graph.tombstone_ratio > self._compact_ratio):
+            self.__schedule_compaction()
+
+    def update(self, q: Point, m: int, m_max: int, ef: int, ml: int, m_max0: int = None,
+               stats: QueryStats = None):
+        ''' Replace the vector of q.id, or insert q if its id is absent, see insert for the arguments
+
+        The old point is reconnected and removed right away, then q is inserted anew.
+        '''
+        with measure('update', stats):
+            if len(self._graph.find_points([q.id])) > 0:
+                self._graph.tombstone(q.id)
+                with self._compact_lock:
+                    self.__compact([q.id])
+            self.__insert_point(q, m, m_max, ef, ml, m_max0)
+
+    def compact(self, wait: bool = True) -> int:
+        ''' Reconnect the neighbors of the tombstoned points and remove them
+
+        Every neighbor linking to a deleted point loses that edge and picks
+        replacements among its other neighbors and the neighbors of the deleted
+        point, with the selection heuristic and within its current degree. The
+        edges of compact_batch deleted points are rewritten with one write.
+
+        Inserts racing with a compaction may still link a point being removed,
+        compact while inserts are paused for an exact graph.
+
+        Returns:
+            number of removed points
+        '''
+        if not wait and self._compact_lock.locked():
+            return 0
+        with self._compact_lock:
+            ids = self._graph.tombstones()
+            for begin in range(0, len(ids), self._compact_batch):
+                self.__compact(ids[begin:begin + self._compact_batch])
+            return len(ids)
+
+    @property
+    def compaction(self) -> Optional[Future]:
+        ''' The background compaction last started by delete, None if none was
+        '''
+        return self._compaction
+
+    def __schedule_compaction(self):
+        if self._compaction is not None and not self._compaction.done():
+            return
+        if self._compactor is None:
+            self._compactor = ThreadPoolExecutor(1, thread_name_prefix='merak-compact')
+        self._compaction = self._compactor.submit(self.compact)
+
+    def __compact(self, ids: List[int]):
+        ''' Reconnect the neighbors of the deleted ids with one write, then remove them.
+        The caller holds the compact lock.
+        '''
+        deleted = set(ids)
+        nodes = {node.id: node for node in self._graph.get_nodes(ids)}
+        layers = range(self._graph.max_top_layer + 1)
+        sources = {n for node in nodes.values() for l in layers for n in node.layer_neighbors(l)}
+        sources = [n for n in sources - deleted if not self._graph.is_deleted(n)]
+
+        # inserts moving the entry point hold the entry lock before any node lock
+        with self._graph.entry_lock, self._graph.lock_nodes(sources + ids):
+            batch = self._graph.add_batch()
+            for l in layers:
+                for n in sources:
+                    curr_ids = self._graph.get_neighbor_ids(l, n)
+                    dead = [id for id in curr_ids if id in deleted]
+                    if not dead:
+                        continue
+                    candidates = {id for id in curr_ids if id not in deleted}
+                    for id in dead:
+                        candidates.update(nodes[id].layer_neighbors(l))
+                    candidates = [id for id in candidates - deleted - {n} if not self._graph.is_deleted(id)]
+                    kept = self.__prune(self._graph.get_point(n), self._graph.find_points(candidates),
+                                        len(curr_ids))
+                    kept_ids = {p.id for p in kept}
+                    for dst in curr_ids:
+                        if dst not in kept_ids:
+                            batch.delete_edge(l, n, dst)
+                    for dst in kept_ids - set(curr_ids):
+                        batch.add_edge(l, n, dst)
+            self._graph.add(batch)
+
+            entry_point, top_layer = self._graph.entry()
+            if entry_point in deleted:
+                self.__move_entry(nodes[entry_point], top_layer, deleted, sources)
+        self._graph.remove(ids)
+        for id in ids:
+            self._codes.remove(id)
+
+    def __move_entry(self, entry: Node, top_layer: int, deleted: Set[int], sources: List[int]):
+        ''' Hand the entry point over to a live neighbor on the highest layer it has one,
+        else to any live neighbor of the deleted points
+        '''
+        for l in range(top_layer, -1, -1):
+            for id in entry.layer_neighbors(l):
+                if id not in deleted and not self._graph.is_deleted(id):
+                    self._graph.replace_entry(entry.id, id, l)
+                    return
+        if sources:
+            self._graph.replace_entry(entry.id, sources[0], 0)
+        else:
+            self._graph.replace_entry(entry.id, None, -1)
+
+    def __insert(self, q: Point, new_layer: int, m: int, m_max: int, m_max0: int, ef: int):
+        add_batch = self._graph.add_batch()
+        add_batch.add_point(q, new_layer)
+
+        entry_point, top_layer = self._graph.entry()
+        entry_points: List[int] = [] if entry_point is None else [entry_point]
 
         # l in [new_layer+1, top_layer], from top to bottom.
         # only find one entry point for next layer
-        for l in range(self._graph.top_layer, new_layer, -1):
+        for l in range(top_layer, new_layer, -1):
             nearest_points = self.__search_layer(q, entry_points, 1, l)
-            entry_points = [Points(q, nearest=True, points=nearest_points).nearest()]
+            entry_points = [p.id for p in nearest_points[:1]]
 
         # l in [0, new_layer], from top to bottom.
         # Find a entry point set for next layer
-        for l in range(min(self._graph.top_layer, new_layer), -1, -1):
-            nearest_points = self.__search_layer(q, entry_points, ef, l)
-            neighbors = self.__select_neighbors_heuristic(q, nearest_points, m, l)
+        layer_neighbors: Dict[int, List[Point]] = {}
+        # deleted points are no neighbor candidates
+        live = self.__live(None)
+        for l in range(min(top_layer, new_layer), -1, -1):
+            nearest_points = self.__search_layer(q, entry_points, ef, l, live)
+            if len(nearest_points) == 0:
+                continue
+            nearest_ids = [p.id for p in nearest_points]
+            neighbors = self.__select_neighbors_heuristic(q, nearest_ids, m, l)
             for e in neighbors:
-                add_batch.add_edge(l, q, e)
-
-            # TODO(spw): remove this temp for concurrent
-            # shrink connections if old element's edges greater than m_max
-            # for e in neighbors:
-            #     curr_neighbors = self._graph.get_neighbors(l, e)
-            #     if len(curr_neighbors) > m_max:
-            #         new_neighbors = self.__select_neighbors_heuristic(
-            #             e, curr_neighbors, m_max, l)
-            #         self._graph.set_neighbors(l, e, new_neighbors)
-            entry_points = nearest_points
-        self._graph.add(add_batch)
+                add_batch.add_edge(l, q.id, e.id)
+            layer_neighbors[l] = neighbors
+            entry_points = nearest_ids
+
+        # add the reverse edges e -> q, a neighbor list growing beyond its maximum
+        # degree is shrunk with the heuristic. Pruned edges are deleted in the same
+        # batch, so the whole update is one write.
+        touched = {e.id for neighbors in layer_neighbors.values() for e in neighbors}
+        with self._graph.lock_nodes(touched | {q.id}):
+            # a compaction may have removed neighbors since they were selected, the
+            # edges of q to them are left dangling and skipped by searches
+            present = {p.id for p in self._graph.find_points(list(touched))}
+            for l, neighbors in layer_neighbors.items():
+                max_degree = m_max0 if l == 0 else m_max
+                for e in neighbors:
+                    if e.id not in present:
+                        continue
+                    # read under the lock, concurrent inserts may have changed it
+                    curr_ids = self._graph.get_neighbor_ids(l, e.id)
+                    if q.id in curr_ids:
+                        continue
+                    if len(curr_ids) < max_degree:
+                        add_batch.add_edge(l, e.id, q.id)
+                        continue
+                    kept = self.__prune(e, self._graph.find_points(curr_ids) + [q], max_degree)
+                    kept_ids = {p.id for p in kept}
+                    for dst in curr_ids:
+                        if dst not in kept_ids:
+                            add_batch.delete_edge(l, e.id, dst)
+                    if q.id in kept_ids:
+                        add_batch.add_edge(l, e.id, q.id)
+            self._graph.add(add_batch)
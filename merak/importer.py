@@ -0,0 +1,345 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Set, Tuple
+
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.point import Point
+
+logger = logging.getLogger(__name__)
+
+
+def list_parts(path: str) -> List[str]:
+    ''' part{N}.npz files under path, ordered by N
+    '''
+    parts = []
+    for name in os.listdir(path):
+        match = re.fullmatch(r'part(\d+)\.npz', name)
+        if match:
+            parts.append((int(match.group(1)), name))
+    return [name for _, name in sorted(parts)]
+
+
+def load_part(file: str, id_stride: int) -> Tuple[np.ndarray, np.ndarray]:
+    ''' Load (ids, vectors) of a part file.
+
+    The random datasets store an id array, the nlp ones don't, their ids are
+    derived from the part number as part * id_stride + row.
+    '''
+    with np.load(file) as data:
+        vectors = data['vector']
+        if 'id' in data:
+            ids = data['id'].astype(np.int64)
+        else:
+            part = int(re.search(r'part(\d+)\.npz$', file).group(1))
+            ids = part * id_stride + np.arange(len(vectors), dtype=np.int64)
+    assert len(ids) == len(vectors)
+    return ids, vectors
+
+
+class Checkpoint:
+    ''' Progress of an import, saved as json after every finished batch.
+
+    For every part it keeps the number of leading rows known to be inserted,
+    together with entry point and top layer of the graph, so a new process
+    can continue the graph where the crashed one stopped. Batches that were
+    in flight during a crash are inserted again on resume.
+    '''
+
+    def __init__(self, file: str):
+        self._file = file
+        self._lock = threading.Lock()
+        self._parts: Dict[str, Dict] = {}
+        self.entry_point = None
+        self.top_layer = -1
+        if os.path.exists(file):
+            with open(file) as f:
+                state = json.load(f)
+            self._parts = state['parts']
+            self.entry_point = state['entry_point']
+            self.top_layer = state['top_layer']
+
+    def rows_done(self, part: str) -> int:
+        return self._parts.get(part, {}).get('rows', 0)
+
+    def part_done(self, part: str) -> bool:
+        return self._parts.get(part, {}).get('done', False)
+
+    def update(self, part: str, rows: int, done: bool, entry_point: int, top_layer: int):
+        with self._lock:
+            self._parts[part] = {'rows': rows, 'done': done}
+            self.entry_point = entry_point
+            self.top_layer = top_layer
+            state = {'parts': self._parts, 'entry_point': entry_point, 'top_layer': top_layer}
+            tmp = self._file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(state, f)
+            os.replace(tmp, self._file)
+
+
+class BulkImporter:
+    ''' Build an index from the part{N}.npz files of the example datasets.
+
+    Part files are read one at a time and cut into batches, batches are
+    inserted by a pool of worker threads with a bounded number in flight.
+    '''
+
+    def __init__(self, hnsw: HNSW, checkpoint_file: str, m: int = 16, m_max: int = 32,
+                 ef: int = 200, ml: int = 4, workers: int = 8, batch_size: int = 1000,
+                 id_stride: int = 1000000, report_interval: float = 10.0):
+        assert workers > 0 and batch_size > 0
+        self._hnsw = hnsw
+        self._checkpoint = Checkpoint(checkpoint_file)
+        self._m = m
+        self._m_max = m_max
+        self._ef = ef
+        self._ml = ml
+        self._workers = workers
+        self._batch_size = batch_size
+        self._id_stride = id_stride
+        self._report_interval = report_interval
+
+        self._count_lock = threading.Lock()
+        self._imported = 0
+        self._start = 0.0
+        self._last_report = 0.0
+
+    @property
+    def imported(self) -> int:
+        return self._imported
+
+    def rate(self) -> float:
+        ''' vectors inserted per second since run started
+        '''
+        elapsed = time.time() - self._start
+        return self._imported / elapsed if elapsed > 0 else 0.0
+
+    def run(self, path: str) -> int:
+        ''' Import every part under path not finished yet, returns vectors inserted
+        '''
+        graph = self._hnsw.graph
+        if self._checkpoint.entry_point is not None and graph.entry_point is None:
+            graph.set_entry(self._checkpoint.entry_point, self._checkpoint.top_layer)
+
+        self._start = self._last_report = time.time()
+        with ThreadPoolExecutor(self._workers) as executor:
+            for part in list_parts(path):
+                if self._checkpoint.part_done(part):
+                    continue
+                self._import_part(executor, part, os.path.join(path, part))
+        self._report(force=True)
+        return self._imported
+
+    def _import_part(self, executor: ThreadPoolExecutor, part: str, file: str):
+        ids, vectors = load_part(file, self._id_stride)
+        start = self._checkpoint.rows_done(part)
+        batches = [(begin, min(begin + self._batch_size, len(ids)))
+                   for begin in range(start, len(ids), self._batch_size)]
+
+        # batches finish out of order, the checkpoint only moves past contiguous ones
+        finished = set()
+        rows_done = start
+        in_flight = threading.Semaphore(2 * self._workers)
+        progress_lock = threading.Lock()
+
+        def on_done(future):
+            nonlocal rows_done
+            in_flight.release()
+            if future.exception() is not None:
+                return
+            with progress_lock:
+                finished.add(future.begin)
+                while rows_done in finished:
+                    finished.remove(rows_done)
+                    rows_done = min(rows_done + self._batch_size, len(ids))
+                graph = self._hnsw.graph
+                self._checkpoint.update(part, rows_done, rows_done == len(ids),
+                                        graph.entry_point, graph.top_layer)
+
+        futures = []
+        for begin, end in batches:
+            in_flight.acquire()
+            future = executor.submit(self._insert_batch, ids[begin:end], vectors[begin:end])
+            future.begin = begin
+            future.add_done_callback(on_done)
+            futures.append(future)
+        for future in futures:
+            # re-raise the first failure, its batch is retried on the next run
+            future.result()
+        if len(batches) == 0:
+            graph = self._hnsw.graph
+            self._checkpoint.update(part, len(ids), True, graph.entry_point, graph.top_layer)
+
+    def _insert_batch(self, ids: np.ndarray, vectors: np.ndarray):
+        for id, vec in zip(ids, vectors):
+            self._hnsw.insert(Point(int(id), vec), self._m, self._m_max, self._ef, self._ml)
+        # the checkpoint counts the batch as stored, so buffered writes must be
+        self._hnsw.flush()
+        with self._count_lock:
+            self._imported += len(ids)
+        self._report()
+
+    def _report(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_report < self._report_interval:
+            return
+        self._last_report = now
+        logger.info('imported %d vectors, %.1f vectors/s', self._imported, self.rate())
+
+
+class StreamImporter:
+    ''' Insert (id, vector, payload) tuples as embedding producers emit them.
+
+    Tuples are grouped into micro-batches, a batch is submitted once it holds
+    batch_size tuples or its oldest tuple waited max_delay seconds. Batches are
+    inserted by a pool of worker threads with at most max_pending of them in
+    flight. When the index falls behind, the reader blocks on the next batch and
+    stops taking tuples from the source, so a bounded producer queue fills up and
+    its producers block in put.
+    '''
+
+    def __init__(self, hnsw: HNSW, m: int = 16, m_max: int = 32, ef: int = 200, ml: int = 4,
+                 workers: int = 8, batch_size: int = 100, max_delay: float = 1.0,
+                 max_pending: int = None, on_batch: Callable[[List[int], List[Any]], None] = None,
+                 report_interval: float = 10.0):
+        '''
+        max_pending: batches submitted but not inserted yet, 2 * workers by default
+        on_batch: called with the ids and payloads of every batch once it is searchable,
+            e.g. to store the texts the vectors were embedded from
+        '''
+        assert workers > 0 and batch_size > 0 and max_delay >= 0
+        self._hnsw = hnsw
+        self._m = m
+        self._m_max = m_max
+        self._ef = ef
+        self._ml = ml
+        self._workers = workers
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._max_pending = max_pending or 2 * workers
+        self._on_batch = on_batch
+        self._report_interval = report_interval
+
+        self._count_lock = threading.Lock()
+        self._imported = 0
+        # tuples taken from the source and not searchable yet
+        self._pending = 0
+        # seconds from arrival to searchable of the oldest tuple of the last batch
+        self._lag = 0.0
+        self._start = 0.0
+        self._last_report = 0.0
+
+    @property
+    def imported(self) -> int:
+        return self._imported
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    @property
+    def lag(self) -> float:
+        return self._lag
+
+    def rate(self) -> float:
+        ''' vectors inserted per second since run started
+        '''
+        elapsed = time.time() - self._start
+        return self._imported / elapsed if elapsed > 0 else 0.0
+
+    def run(self, source, producers: int = 1) -> int:
+        ''' Insert every tuple of source until it ends, returns vectors inserted
+
+        source: a queue, i.e. anything with get(timeout=), e.g. a multiprocessing.Queue.
+            Every producer ends its stream with an empty tuple or None, like the
+            embedding processes of example/nlp. Any other iterable ends when exhausted.
+        producers: number of end markers closing a queue
+        '''
+        if not hasattr(source, 'get'):
+            source, producers = self._feed(source), 1
+
+        self._start = self._last_report = time.time()
+        batch: List[Tuple[int, np.ndarray, Any, float]] = []
+        in_flight = threading.Semaphore(self._max_pending)
+        futures: Set[Future] = set()
+        ended = 0
+        with ThreadPoolExecutor(self._workers) as executor:
+            while ended < producers:
+                timeout = None if not batch else max(batch[0][3] + self._max_delay - time.time(), 0)
+                try:
+                    item = source.get(timeout=timeout)
+                    if item is None or len(item) == 0:
+                        ended += 1
+                    else:
+                        batch.append((int(item[0]), item[1], item[2] if len(item) > 2 else None, time.time()))
+                        with self._count_lock:
+                            self._pending += 1
+                except queue.Empty:
+                    # the oldest tuple of the batch is due
+                    pass
+                if batch and (len(batch) >= self._batch_size or ended == producers or
+                              time.time() - batch[0][3] >= self._max_delay):
+                    self._submit(executor, in_flight, futures, batch)
+                    batch = []
+            for future in list(futures):
+                future.result()
+        self._hnsw.flush()
+        self._report(force=True)
+        return self._imported
+
+    def _feed(self, items: Iterable) -> queue.Queue:
+        ''' A bounded queue filled from items by a daemon thread, ended with None
+        '''
+        fed: queue.Queue = queue.Queue(self._batch_size * self._max_pending)
+
+        def feed():
+            for item in items:
+                fed.put(item)
+            fed.put(None)
+
+        threading.Thread(target=feed, name='merak-stream-feed', daemon=True).start()
+        return fed
+
+    def _submit(self, executor: ThreadPoolExecutor, in_flight: threading.Semaphore,
+                futures: Set[Future], batch: List[Tuple[int, np.ndarray, Any, float]]):
+        # blocks while max_pending batches are in flight, this is the backpressure
+        in_flight.acquire()
+        future = executor.submit(self._insert_batch, batch)
+        futures.add(future)
+
+        def on_done(future):
+            in_flight.release()
+
+        future.add_done_callback(on_done)
+        # re-raise the first failure without waiting for the end of the stream
+        for done in [f for f in futures if f.done()]:
+            futures.discard(done)
+            done.result()
+
+    def _insert_batch(self, batch: List[Tuple[int, np.ndarray, Any, float]]):
+        for id, vec, _, _ in batch:
+            self._hnsw.insert(Point(id, vec), self._m, self._m_max, self._ef, self._ml)
+        with self._count_lock:
+            self._imported += len(batch)
+            self._pending -= len(batch)
+            self._lag = time.time() - batch[0][3]
+        if self._on_batch is not None:
+            self._on_batch([id for id, _, _, _ in batch], [payload for _, _, payload, _ in batch])
+        self._report()
+
+    def _report(self, force: bool = False):
+        now = time.time()
+        if not force and now - self._last_report < self._report_interval:
+            return
+        self._last_report = now
+        logger.info('imported %d vectors, %.1f vectors/s, %d pending, lag %.2fs',
+                    self._imported, self.rate(), self._pending, self._lag)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+
+from typing import Dict, Optional, Union
+
+import numpy as np
+
+
+def _matvec(block: np.ndarray, q: np.ndarray) -> np.ndarray:
+    # some openblas sgemv kernels raise a spurious invalid flag on finite input,
+    # nan input still gives nan output
+    with np.errstate(invalid='ignore'):
+        return block @ q
+
+
+def _dot(a: np.ndarray, b: np.ndarray) -> float:
+    # accumulated in float64, a float16 product would round every step
+    return float(np.einsum('i,i->', a, b, dtype=np.float64))
+
+
+def squared_norms(block: np.ndarray) -> np.ndarray:
+    ''' Squared L2 norm of every row of block
+    '''
+    return np.einsum('ij,ij->i', block, block, dtype=np.float64)
+
+
+class Metric(object):
+    ''' Distance between vectors, smaller is nearer.
+
+    Every metric has a single pair kernel, a one-to-many kernel scoring a
+    query against the rows of a block, and a row-wise kernel. The one-to-many
+    kernel is a single matrix-vector product, it takes the squared norms of
+    the block rows if they are cached, see PointStore.
+    '''
+
+    name = ''
+
+    def prepare(self, vec: np.ndarray) -> np.ndarray:
+        ''' Transform a vector (or the rows of a matrix) before it is stored or searched
+        '''
+        return vec
+
+    def pair(self, a: np.ndarray, b: np.ndarray) -> float:
+        raise NotImplementedError
+
+    def one_to_many(self, q: np.ndarray, block: np.ndarray,
+                    norms: Optional[np.ndarray] = None) -> np.ndarray:
+        ''' Distance from q to every row of block.
+
+        norms: squared norms of the rows of block, computed if not given
+        '''
+        raise NotImplementedError
+
+    def rowwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        ''' Distance between a[i] and b[i] for every i
+        '''
+        raise NotImplementedError
+
+
+class SquaredL2(Metric):
+    ''' Squared euclidean distance, ordered as L2 but without the sqrt.
+    '''
+
+    name = 'l2sq'
+
+    def pair(self, a: np.ndarray, b: np.ndarray) -> float:
+        return max(_dot(a, a) - 2 * _dot(a, b) + _dot(b, b), 0.0)
+
+    def one_to_many(self, q: np.ndarray, block: np.ndarray,
+                    norms: Optional[np.ndarray] = None) -> np.ndarray:
+        if norms is None:
+            norms = squared_norms(block)
+        # |x - q|^2 = |x|^2 - 2 x.q + |q|^2
+        dists = norms - 2 * _matvec(block, q) + _dot(q, q)
+        return np.maximum(dists, 0, out=dists)
+
+    def rowwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        # accumulated in float64 as in squared_norms, float16 rows would round every step
+        d = np.subtract(a, b, dtype=np.float64)
+        return np.einsum('ij,ij->i', d, d)
+
+
+class L2(SquaredL2):
+    ''' Euclidean distance, the metric of the original index.
+    '''
+
+    name = 'l2'
+
+    def pair(self, a: np.ndarray, b: np.ndarray) -> float:
+        return np.sqrt(super().pair(a, b))
+
+    def one_to_many(self, q: np.ndarray, block: np.ndarray,
+                    norms: Optional[np.ndarray] = None) -> np.ndarray:
+        return np.sqrt(super().one_to_many(q, block, norms))
+
+    def rowwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return np.sqrt(super().rowwise(a, b))
+
+
+class InnerProduct(Metric):
+    ''' Negative inner product, so the largest product is the nearest.
+    '''
+
+    name = 'ip'
+
+    def pair(self, a: np.ndarray, b: np.ndarray) -> float:
+        return -_dot(a, b)
+
+    def one_to_many(self, q: np.ndarray, block: np.ndarray,
+                    norms: Optional[np.ndarray] = None) -> np.ndarray:
+        return -_matvec(block, q).astype(np.float64)
+
+    def rowwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return -np.einsum('ij,ij->i', a, b, dtype=np.float64)
+
+
+class Cosine(InnerProduct):
+    ''' 1 - cosine similarity. Vectors are normalized when stored and searched,
+    so the distance is computed as an inner product.
+    '''
+
+    name = 'cosine'
+
+    def prepare(self, vec: np.ndarray) -> np.ndarray:
+        vec = np.asarray(vec, dtype=np.float64 if vec.dtype == np.float64 else np.float32)
+        norm = np.linalg.norm(vec, axis=-1, keepdims=True)
+        return vec / np.where(norm > 0, norm, 1)
+
+    def pair(self, a: np.ndarray, b: np.ndarray) -> float:
+        return 1 + super().pair(a, b)
+
+    def one_to_many(self, q: np.ndarray, block: np.ndarray,
+                    norms: Optional[np.ndarray] = None) -> np.ndarray:
+        return 1 + super().one_to_many(q, block, norms)
+
+    def rowwise(self, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+        return 1 + super().rowwise(a, b)
+
+
+METRICS: Dict[str, Metric] = {metric.name: metric for metric in (L2(), SquaredL2(), InnerProduct(), Cosine())}
+
+DEFAULT_METRIC = METRICS['l2']
+
+
+def get_metric(metric: Union[str, Metric, None]) -> Metric:
+    ''' Metric by name, a Metric is returned as is and None means the default
+    '''
+    if metric is None:
+        return DEFAULT_METRIC
+    if isinstance(metric, Metric):
+        return metric
+    if metric not in METRICS:
+        raise ValueError(f"unknown metric {metric}")
+    return METRICS[metric]
@@ -2,14 +2,32 @@
 
 import heapq
 import numpy as np
-from typing import List, Set, Union
+from typing import TYPE_CHECKING, List, Optional, Set, Tuple
+
+from merak import stats
+from merak.codec import DEFAULT_CODEC
+from merak.metric import DEFAULT_METRIC, Metric
+
+if TYPE_CHECKING:
+    from merak.point_store import PointStore
 
 
 class Point(object):
-    def __init__(self, id: int, vec: np.ndarray, *args, **kwargs) -> None:
+    ''' A vector with its id.
+
+    A point either owns its vector, or is a view of a row in a PointStore
+    (see merak.point_store), in which case the vector lives in the store's
+    contiguous matrix and the point itself is only (id, row).
+    '''
+
+    __slots__ = ('_id', '_vec', '_store', '_row')
+
+    def __init__(self, id: int, vec: np.ndarray = None, store: 'PointStore' = None, row: int = None) -> None:
+        assert (vec is None) != (store is None)
         self._id = id
         self._vec = vec
-        self.__dict__.update(kwargs)
+        self._store = store
+        self._row = row
 
     def __hash__(self) -> int:
         return self._id
@@ -32,80 +50,206 @@ class Point(object):
         return self._id
 
     @property
-    def vec(self):
+    def vec(self) -> np.ndarray:
+        store = self._store
+        if store is not None:
+            return store.vector(self)
         return self._vec
 
+    @property
+    def nbytes(self) -> int:
+        ''' Size of the vector, without copying it out of the store
+        '''
+        store = self._store
+        if store is not None:
+            return store.dim * store.dtype.itemsize
+        return self._vec.nbytes
+
+    @property
+    def store(self) -> Optional['PointStore']:
+        return self._store
+
+    @property
+    def row(self) -> Optional[int]:
+        return self._row
+
     @property
     def vec_str(self):
-        ''' just simple encoding now
+        ''' vector encoded with the default codec, see merak.codec
         '''
-        return np.array2string(self._vec)
+        return DEFAULT_CODEC.encode(self.vec)
 
-    def distance(self, other: 'Point') -> float:
-        return np.linalg.norm(self.vec - other.vec)
+    def detach(self):
+        ''' Copy the vector out of the store, the row may be reused afterwards.
+        '''
+        if self._store is not None:
+            self._vec = self._store.row(self._row).copy()
+            self._store = None
+            self._row = None
 
+    def distance(self, other: 'Point', metric: Metric = DEFAULT_METRIC) -> float:
+        return metric.pair(self.vec, other.vec)
 
-class Points:
-    ''' Helper class to get the nearest and furthest element in an element vector.
+
+def batch_distance(base: Point, points: List[Point], metric: Metric = DEFAULT_METRIC) -> np.ndarray:
+    ''' Distances from base to every point, computed with a single numpy call.
+    '''
+    if len(points) == 0:
+        return np.empty(0)
+    stats.count('distance_evals', len(points))
+    store = points[0].store
+    if store is not None:
+        # gather the rows and their cached norms straight from the contiguous matrix
+        distances = store.distances(base.vec, points, metric)
+        if distances is not None:
+            return distances
+    vecs = np.stack([p.vec for p in points])
+    return metric.one_to_many(base.vec, vecs)
+
+
+class DistanceQueue:
+    ''' Min-max heap of (distance, id) pairs, keyed by precomputed distances.
+
+    Both the nearest and the furthest pair are available in O(1), push and pop
+    of either end are O(log n). With a capacity the queue keeps only the
+    capacity nearest pairs, which is the shape of the ef-bounded result set.
     '''
 
-    def __init__(self, base: Point, nearest: bool = True, points: List[Point] = []):
-        self._points_pair: List[(int, Point)] = []
-        self._points_set: Set[int] = set()
-        self._base = base
-        self._nearest = nearest
-        for p in points:
-            self.push(p)
+    def __init__(self, capacity: Optional[int] = None):
+        assert capacity is None or capacity > 0
+        self._heap: List[Tuple[float, int]] = []
+        self._ids: Set[int] = set()
+        self._capacity = capacity
 
     def __len__(self) -> int:
-        return len(self._points_pair)
+        return len(self._heap)
 
-    def __contains__(self, p: Union[Point, int]) -> bool:
-        if type(p) == Point:
-            return p.id in self._points_set
-        if type(p) == int:
-            return p in self._points_set
-        return False
+    def __contains__(self, id: int) -> bool:
+        return id in self._ids
 
     @property
-    def base(self) -> Point:
-        return self._base
+    def capacity(self) -> Optional[int]:
+        return self._capacity
 
     @property
-    def values(self) -> List[Point]:
-        return [pair[1] for pair in self._points_pair]
+    def ids(self) -> Set[int]:
+        return self._ids
 
-    def push(self, p: Point):
-        if p.id in self._points_set:
-            return
+    def full(self) -> bool:
+        return self._capacity is not None and len(self._heap) >= self._capacity
 
-        if self._nearest:
-            heapq.heappush(self._points_pair, (p.distance(self._base), p))
-        else:
-            heapq.heappush(self._points_pair, (-p.distance(self._base), p))
+    def push(self, distance: float, id: int) -> bool:
+        ''' Add a pair, returns whether it was admitted.
 
-        self._points_set.add(p.id)
+        A duplicate id is ignored. When the queue is full the pair is admitted
+        only if it is nearer than the current furthest, which is dropped.
+        '''
+        if id in self._ids:
+            return False
+        if self.full():
+            if distance >= self._heap[self._max_index()][0]:
+                return False
+            self.pop_furthest()
+        self._heap.append((distance, id))
+        self._ids.add(id)
+        self._bubble_up(len(self._heap) - 1)
+        return True
 
-    def pop_nearest(self) -> Point:
-        assert self._nearest is True
-        _, p = heapq.heappop(self._points_pair)
-        self._points_set.remove(p.id)
-        return p
+    def nearest(self) -> Tuple[float, int]:
+        return self._heap[0]
 
-    def nearest(self) -> Point:
-        if self._nearest:
-            return self._points_pair[0][1]
-        else:
-            return max(self._points_pair)[1]
+    def furthest(self) -> Tuple[float, int]:
+        return self._heap[self._max_index()]
 
-    def pop_furthest(self) -> Point:
-        assert self._nearest is False
-        _, p = heapq.heappop(self._points_pair)
-        self._points_set.remove(p.id)
-        return p
+    def pop_nearest(self) -> Tuple[float, int]:
+        return self._pop(0)
 
-    def furthest(self) -> Point:
-        if self._nearest is False:
-            return self._points_pair[0][1]
+    def pop_furthest(self) -> Tuple[float, int]:
+        return self._pop(self._max_index())
+
+    def nearest_n(self, n: int) -> List[Tuple[float, int]]:
+        ''' The n nearest pairs ordered from the nearest, the queue is unchanged.
+        '''
+        return heapq.nsmallest(n, self._heap)
+
+    def sorted(self) -> List[Tuple[float, int]]:
+        ''' All pairs from the nearest to the furthest, the queue is unchanged.
+        '''
+        return sorted(self._heap)
+
+    def _max_index(self) -> int:
+        h = self._heap
+        if len(h) <= 2:
+            return len(h) - 1
+        return 1 if h[1] > h[2] else 2
+
+    def _pop(self, i: int) -> Tuple[float, int]:
+        h = self._heap
+        item = h[i]
+        last = h.pop()
+        if i < len(h):
+            h[i] = last
+            self._trickle_down(i)
+            # the moved element may also belong above i
+            self._bubble_up(i)
+        self._ids.remove(item[1])
+        return item
+
+    @staticmethod
+    def _is_min_level(i: int) -> bool:
+        return (i + 1).bit_length() % 2 == 1
+
+    def _bubble_up(self, i: int):
+        if i == 0:
+            return
+        h = self._heap
+        parent = (i - 1) // 2
+        if self._is_min_level(i):
+            if h[i] > h[parent]:
+                h[i], h[parent] = h[parent], h[i]
+                self._bubble_up_grand(parent, max_level=True)
+            else:
+                self._bubble_up_grand(i, max_level=False)
         else:
-            return max(self._points_pair)[1]
+            if h[i] < h[parent]:
+                h[i], h[parent] = h[parent], h[i]
+                self._bubble_up_grand(parent, max_level=False)
+            else:
+                self._bubble_up_grand(i, max_level=True)
+
+    def _bubble_up_grand(self, i: int, max_level: bool):
+        h = self._heap
+        while i > 2:
+            grand = ((i - 1) // 2 - 1) // 2
+            if (h[i] > h[grand]) if max_level else (h[i] < h[grand]):
+                h[i], h[grand] = h[grand], h[i]
+                i = grand
+            else:
+                break
+
+    def _trickle_down(self, i: int):
+        h = self._heap
+        n = len(h)
+        max_level = not self._is_min_level(i)
+        while True:
+            first_child = 2 * i + 1
+            if first_child >= n:
+                return
+            # smallest (or largest on max levels) of children and grandchildren
+            descendants = [first_child, first_child + 1] + list(range(4 * i + 3, min(4 * i + 7, n)))
+            m = first_child
+            for d in descendants:
+                if d < n and ((h[d] > h[m]) if max_level else (h[d] < h[m])):
+                    m = d
+            if m > first_child + 1:
+                # m is a grandchild
+                if (h[m] > h[i]) if max_level else (h[m] < h[i]):
+                    h[m], h[i] = h[i], h[m]
+                    parent = (m - 1) // 2
+                    if (h[m] < h[parent]) if max_level else (h[m] > h[parent]):
+                        h[m], h[parent] = h[parent], h[m]
+                    i = m
+                    continue
+            elif (h[m] > h[i]) if max_level else (h[m] < h[i]):
+                h[m], h[i] = h[i], h[m]
+            return
@@ -1,14 +1,169 @@
 #!/usr/bin/env python3
 
-from merak.point import Point
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from merak.graph import Node
 
 
 class PointCache(object):
-    def __init__(self) -> None:
-        pass
+    ''' Bounded cache of graph nodes, i.e. a vector together with its per-layer neighbors.
+
+    The cache is capped both by the number of entries and by the estimated bytes of
+    the cached nodes, whichever is hit first triggers eviction.
+
+    Policies:
+        lru: evict the least recently used node.
+        2q: scan resistant 2Q. A node seen for the first time goes into a FIFO
+            probation queue, a node fetched again after falling out of probation
+            is admitted to the main LRU queue. A single long walk through cold
+            nodes therefore can not flush hot nodes near the entry point.
+    '''
+
+    POLICIES = ('lru', '2q')
+
+    def __init__(self, max_entries: int = 100000, max_bytes: int = 256 << 20,
+                 policy: str = 'lru', on_evict: Callable[['Node'], None] = None) -> None:
+        '''
+        on_evict: called with every node leaving the cache through eviction or remove
+        '''
+        assert max_entries > 0 and max_bytes > 0
+        if policy not in self.POLICIES:
+            raise ValueError(f"unknown cache policy {policy}")
+
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._policy = policy
+        self.on_evict = on_evict
+        self._lock = threading.Lock()
+
+        # main queue, ordered from least to most recently used
+        self._main: 'OrderedDict[int, Node]' = OrderedDict()
+        # 2q only: probation FIFO and ghost ids recently evicted from it
+        self._probation: 'OrderedDict[int, Node]' = OrderedDict()
+        self._ghost: 'OrderedDict[int, None]' = OrderedDict()
+        self._probation_entries = max(1, max_entries // 4)
+        self._ghost_entries = max(1, max_entries // 2)
+
+        self._nbytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._main) + len(self._probation)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._main or id in self._probation
+
+    @property
+    def policy(self) -> str:
+        return self._policy
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def evictions(self) -> int:
+        return self._evictions
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'entries': len(self),
+            'bytes': self._nbytes,
+            'hits': self._hits,
+            'misses': self._misses,
+            'evictions': self._evictions,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def get(self, id: int) -> Optional['Node']:
+        ''' Return the cached node of id, None if absent. Counts a hit or a miss.
+        '''
+        with self._lock:
+            node = self._main.get(id)
+            if node is not None:
+                self._main.move_to_end(id)
+                self._hits += 1
+                return node
+            node = self._probation.get(id)
+            if node is not None:
+                # 2q does not reorder the probation queue on hit
+                self._hits += 1
+                return node
+            self._misses += 1
+            return None
+
+    def add(self, node: 'Node'):
+        ''' Insert or replace a node, evicting others if the cache is over capacity.
+        '''
+        with self._lock:
+            self._remove(node.id)
+            if self._policy == 'lru' or node.id in self._ghost:
+                self._ghost.pop(node.id, None)
+                self._main[node.id] = node
+            else:
+                self._probation[node.id] = node
+            self._nbytes += node.nbytes
+            evicted = self._evict()
+        if self.on_evict is not None:
+            for node in evicted:
+                self.on_evict(node)
+
+    def remove(self, id: int):
+        ''' Drop a node, used when its neighbors have been changed by a write.
+        '''
+        with self._lock:
+            node = self._remove(id)
+        if node is not None and self.on_evict is not None:
+            self.on_evict(node)
+
+    def clear(self):
+        with self._lock:
+            nodes = list(self._main.values()) + list(self._probation.values())
+            self._main.clear()
+            self._probation.clear()
+            self._ghost.clear()
+            self._nbytes = 0
+        if self.on_evict is not None:
+            for node in nodes:
+                self.on_evict(node)
 
-    def getPoint(self, id: int) -> Point:
-        assert(False)
+    def _remove(self, id: int) -> Optional['Node']:
+        node = self._main.pop(id, None)
+        if node is None:
+            node = self._probation.pop(id, None)
+        if node is not None:
+            self._nbytes -= node.nbytes
+        return node
 
-    def addPoint(self, q: Point):
-        assert(False)
+    def _evict(self) -> List['Node']:
+        evicted = []
+        while len(self) > self._max_entries or (self._nbytes > self._max_bytes and len(self) > 1):
+            if self._probation and (len(self._probation) > self._probation_entries or not self._main):
+                id, node = self._probation.popitem(last=False)
+                self._ghost[id] = None
+                while len(self._ghost) > self._ghost_entries:
+                    self._ghost.popitem(last=False)
+            else:
+                id, node = self._main.popitem(last=False)
+            self._nbytes -= node.nbytes
+            self._evictions += 1
+            evicted.append(node)
+        return evicted
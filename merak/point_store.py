@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from merak.metric import DEFAULT_METRIC, Metric, squared_norms
+from merak.point import Point
+
+
+class PointStore(object):
+    ''' Vectors of many points kept in one contiguous matrix.
+
+    Every stored id owns a row of the matrix, the Point returned for it is a
+    view of (id, row). Rows of removed ids are recycled. The matrix grows by
+    doubling, the dimension is fixed by the first vector added. The squared
+    norm of every row is cached next to the matrix for the distance kernels.
+
+    A row may be recycled by another thread at any time, so rows are only
+    read under the store lock and what is read is copied out before it is
+    used, see vector and distances.
+    '''
+
+    def __init__(self, dtype=np.float32, capacity: int = 1024) -> None:
+        assert capacity > 0
+        self._dtype = np.dtype(dtype)
+        self._capacity = capacity
+        self._data: Optional[np.ndarray] = None
+        self._norms: Optional[np.ndarray] = None
+        # id -> view point, the point holds the row
+        self._points: Dict[int, Point] = {}
+        self._free_rows: List[int] = []
+        self._next_row = 0
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._points)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._points
+
+    @property
+    def dim(self) -> Optional[int]:
+        return None if self._data is None else self._data.shape[1]
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._dtype
+
+    @property
+    def nbytes(self) -> int:
+        return 0 if self._data is None else self._data.nbytes
+
+    @property
+    def data(self) -> Optional[np.ndarray]:
+        ''' The backing matrix, rows not owned by any id hold garbage.
+        '''
+        return self._data
+
+    def add(self, id: int, vec: np.ndarray) -> Point:
+        ''' Store vec for id and return its view, an existing id is overwritten in place.
+        '''
+        with self._lock:
+            point = self._points.get(id)
+            if point is not None:
+                self._set_row(point.row, vec)
+                return point
+
+            if self._data is None:
+                self._data = np.empty((self._capacity, len(vec)), dtype=self._dtype)
+                self._norms = np.zeros(self._capacity, dtype=np.float64)
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                if self._next_row == self._data.shape[0]:
+                    self._grow()
+                row = self._next_row
+                self._next_row += 1
+
+            self._set_row(row, vec)
+            point = Point(id, store=self, row=row)
+            self._points[id] = point
+            return point
+
+    def ids(self) -> List[int]:
+        with self._lock:
+            return list(self._points)
+
+    def get(self, id: int) -> Optional[Point]:
+        return self._points.get(id)
+
+    def remove(self, id: int):
+        ''' Release the row of id. Views still referenced elsewhere get a private copy.
+        '''
+        with self._lock:
+            point = self._points.pop(id, None)
+            if point is None:
+                return
+            row = point.row
+            point.detach()
+            self._free_rows.append(row)
+
+    def row(self, row: int) -> np.ndarray:
+        return self._data[row]
+
+    def vector(self, point: Point) -> np.ndarray:
+        ''' A copy of the vector of point, read while its row can't be recycled.
+        '''
+        with self._lock:
+            if point.store is self:
+                return self._data[point.row].copy()
+        # removed meanwhile, the point holds its own copy now
+        return point.vec
+
+    def rows(self, ids: List[int]) -> np.ndarray:
+        return np.fromiter((self._points[id].row for id in ids), dtype=np.int64, count=len(ids))
+
+    def vectors(self, rows: List[int]) -> np.ndarray:
+        ''' Gather rows into a new (len(rows), dim) matrix.
+        '''
+        return self._data[rows]
+
+    def gather(self, ids: List[int]) -> np.ndarray:
+        ''' Vectors of ids as a new (len(ids), dim) matrix, see vectors.
+        '''
+        with self._lock:
+            return self._data[self.rows(ids)]
+
+    def norms(self, rows: List[int]) -> np.ndarray:
+        ''' Cached squared norms of the given rows.
+        '''
+        return self._norms[rows]
+
+    def distances(self, vec: np.ndarray, points: List[Point],
+                  metric: Metric = DEFAULT_METRIC) -> Optional[np.ndarray]:
+        ''' Distances from vec to every point, None unless all are views of this store.
+
+        The rows are gathered under the lock, so none of them is recycled for
+        another id between checking the points and reading their vectors.
+        '''
+        with self._lock:
+            if not all(p.store is self for p in points):
+                return None
+            rows = [p.row for p in points]
+            block = self._data[rows]
+            norms = self._norms[rows]
+        if block.dtype != np.float32 and block.dtype != np.float64:
+            block = block.astype(np.float32)
+        return metric.one_to_many(vec, block, norms)
+
+    def _set_row(self, row: int, vec: np.ndarray):
+        self._data[row] = vec
+        self._norms[row] = squared_norms(self._data[row:row + 1].astype(np.float64))[0]
+
+    def _grow(self):
+        data = np.empty((self._data.shape[0] * 2, self._data.shape[1]), dtype=self._dtype)
+        data[:self._data.shape[0]] = self._data
+        self._data = data
+        norms = np.zeros(len(data), dtype=np.float64)
+        norms[:len(self._norms)] = self._norms
+        self._norms = norms
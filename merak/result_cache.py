@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+
+from merak.filter import Filter
+from merak.point import Point
+
+
+class ResultCache(object):
+    ''' Results of knn_search kept for repeated and near duplicate queries.
+
+    A query is keyed on its vector together with ef and the filter. With a step,
+    the vector is first rounded to a grid of that spacing, so queries closer than
+    about step per dimension share an entry and get the results of whichever of
+    them came first. Without one only identical vectors do.
+
+    An entry is valid as long as the graph version it was computed at is current,
+    i.e. any insert, delete or compaction invalidates all entries, and for at most
+    ttl seconds. Entries are evicted least recently used first.
+
+    With superset, a miss searches the ef nearest points instead of k and keeps
+    them all, so a later request with the same ef and a larger k, e.g. the next
+    page, is answered from the entry.
+    '''
+
+    def __init__(self, max_entries: int = 10000, ttl: float = 60.0, step: float = None,
+                 superset: bool = False):
+        '''
+        max_entries: entries kept at most, the least recently used go first
+        ttl: seconds an entry is served, None for no expiry
+        step: grid spacing the query vectors are rounded to, None to match exact vectors only
+        superset: keep ef results on a miss, see above
+        '''
+        assert max_entries > 0
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._step = step
+        self._superset = superset
+        self._lock = threading.Lock()
+        # key -> (graph version, time stored, results nearest first, number of results searched)
+        self._entries: 'OrderedDict[Hashable, Tuple[int, float, List[Point], int]]' = OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total > 0 else 0.0
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            'entries': len(self),
+            'hits': self._hits,
+            'misses': self._misses,
+            'hit_ratio': self.hit_ratio,
+        }
+
+    def key(self, vec: np.ndarray, ef: int, filter: Optional[Filter]) -> Hashable:
+        vec = np.asarray(vec, dtype=np.float32)
+        if self._step is not None:
+            vec = np.round(vec / self._step).astype(np.int64)
+        digest = hashlib.blake2b(vec.tobytes(), digest_size=16).digest()
+        return digest, ef, None if filter is None else filter.key()
+
+    def search(self, vec: np.ndarray, k: int, ef: int, filter: Optional[Filter], version: int,
+               search: Callable[[int], List[Point]]) -> List[Point]:
+        ''' The cached results of the query, or those of search(k) which are then cached
+
+        version: current version of the graph searched
+        search: runs the query for the given number of results
+        '''
+        key = self.key(vec, ef, filter)
+        results = self.get(key, k, version)
+        if results is not None:
+            return results
+        n = max(k, ef) if self._superset else k
+        results = search(n)
+        self.put(key, version, results, n)
+        return results[:k]
+
+    def get(self, key: Hashable, k: int, version: int) -> Optional[List[Point]]:
+        ''' The first k cached results of key, None if absent, stale or too few
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, stored, results, n = entry
+                if entry_version != version or (self._ttl is not None and time.monotonic() - stored > self._ttl):
+                    del self._entries[key]
+                elif k <= n:
+                    self._entries.move_to_end(key)
+                    self._hits += 1
+                    return results[:k]
+            self._misses += 1
+            return None
+
+    def put(self, key: Hashable, version: int, results: List[Point], n: int):
+        ''' Cache results of a search for n results, fewer mean the graph has no more
+        '''
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == version and entry[3] > n:
+                return
+            self._entries[key] = (version, time.monotonic(), results, n)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+import bisect
+import contextvars
+import heapq
+import itertools
+from concurrent.futures import ThreadPoolExecutor, wait
+from typing import Callable, Dict, List, Sequence, Tuple, Union
+
+import numpy as np
+
+from merak.client import Client
+from merak.filter import as_filter
+from merak.hnsw import HNSW
+from merak.metric import Metric
+from merak.point import Point, batch_distance
+from merak.stats import QueryStats, measure
+from merak.storage import MemoryStorage, NebulaStorage
+
+
+class ShardedHNSW:
+    ''' Ids partitioned over several HNSW sub-indexes, e.g. one per nebula space or host.
+
+    A point lives in exactly one shard, chosen from its id. Writes go to the
+    shard of the id, a search runs in every shard in parallel and the per-shard
+    top k are merged with a heap. Every shard walks a graph of only its part
+    of the points, so build and query capacity grow with the number of shards.
+    '''
+
+    PARTITIONS = ('hash', 'range')
+
+    def __init__(self, shards: Sequence[HNSW], partition: Union[str, Callable[[int], int]] = 'hash',
+                 bounds: Sequence[int] = None, efs: Sequence[float] = None, workers: int = None):
+        '''
+        shards: the sub-indexes, all with the same metric
+        partition: hash places id in shard id % len(shards), range in the shard whose
+            bounds interval holds it, or a function of the id returning a shard number
+        bounds: range partitioning only, len(shards) - 1 ascending ids, shard i holds
+            the ids in [bounds[i-1], bounds[i])
+        efs: per-shard factor applied to ef, e.g. lower for shards holding fewer points
+        workers: threads running shard calls, one per shard by default
+        '''
+        assert len(shards) > 0
+        if len({shard.metric.name for shard in shards}) > 1:
+            raise ValueError("shards must share one metric")
+        if callable(partition):
+            self._shard_of = partition
+        elif partition == 'hash':
+            n = len(shards)
+            self._shard_of = lambda id: id % n
+        elif partition == 'range':
+            if bounds is None or len(bounds) != len(shards) - 1 or list(bounds) != sorted(bounds):
+                raise ValueError("range partitioning needs len(shards) - 1 ascending bounds")
+            bounds = list(bounds)
+            self._shard_of = lambda id: bisect.bisect_right(bounds, id)
+        else:
+            raise ValueError(f"unknown partition {partition}")
+        if efs is not None and len(efs) != len(shards):
+            raise ValueError("efs needs one factor per shard")
+
+        self._shards = list(shards)
+        self._efs = list(efs) if efs is not None else [1.0] * len(shards)
+        self._executor = ThreadPoolExecutor(workers or len(shards), thread_name_prefix='merak-shard')
+
+    @classmethod
+    def memory(cls, count: int, max_top_layer: int, metric: Union[str, Metric] = 'l2',
+               dtype=np.float32, **kwargs) -> 'ShardedHNSW':
+        ''' count shards kept in process memory, kwargs are passed to the constructor
+        '''
+        return cls([HNSW(max_top_layer, MemoryStorage(dtype), metric=metric) for _ in range(count)],
+                   **kwargs)
+
+    @classmethod
+    def nebula(cls, hosts: Sequence[Tuple[str, int, str]], max_top_layer: int,
+               metric: Union[str, Metric] = 'l2', pool_size: int = 10, **kwargs) -> 'ShardedHNSW':
+        ''' One shard per (ip, port, space), kwargs are passed to the constructor
+        '''
+        shards = []
+        try:
+            for ip, port, space in hosts:
+                client = Client(ip, port, pool_size=pool_size, space=space)
+                shards.append(HNSW(max_top_layer, NebulaStorage(client), metric=metric))
+        except Exception:
+            for shard in shards:
+                shard.graph.storage.close()
+            raise
+        return cls(shards, **kwargs)
+
+    @property
+    def shards(self) -> List[HNSW]:
+        return self._shards
+
+    @property
+    def metric(self) -> Metric:
+        return self._shards[0].metric
+
+    def shard_of(self, id: int) -> int:
+        return self._shard_of(id)
+
+    def __submit(self, func, *args):
+        # run in a copy of the caller's context, so its stats are collected
+        return self._executor.submit(contextvars.copy_context().run, func, *args)
+
+    def __ef(self, ef: int, shard: int) -> int:
+        return max(1, int(round(ef * self._efs[shard])))
+
+    def __split(self, ids: Sequence[int]) -> Dict[int, List[int]]:
+        ''' shard -> positions in ids of the ids it holds
+        '''
+        groups: Dict[int, List[int]] = {}
+        for i, id in enumerate(ids):
+            groups.setdefault(self._shard_of(int(id)), []).append(i)
+        return groups
+
+    def insert(self, q: Point, m: int, m_max: int, ef: int, ml: int, m_max0: int = None,
+               stats: QueryStats = None):
+        ''' Insert q into its shard, see HNSW.insert
+        '''
+        self._shards[self._shard_of(q.id)].insert(q, m, m_max, ef, ml, m_max0, stats)
+
+    def insert_many(self, points: List[Point], m: int, m_max: int, ef: int, ml: int,
+                    m_max0: int = None, workers: int = 8):
+        ''' Insert points, every shard builds in parallel with workers threads of its own
+        '''
+        groups = self.__split([p.id for p in points])
+        futures = [self.__submit(self._shards[shard].insert_many, [points[i] for i in positions],
+                                 m, m_max, ef, ml, m_max0, workers)
+                   for shard, positions in groups.items()]
+        for future in futures:
+            future.result()
+
+    def delete(self, id: int):
+        self._shards[self._shard_of(id)].delete(id)
+
+    def update(self, q: Point, m: int, m_max: int, ef: int, ml: int, m_max0: int = None,
+               stats: QueryStats = None):
+        self._shards[self._shard_of(q.id)].update(q, m, m_max, ef, ml, m_max0, stats)
+
+    def knn_search(self, q: Point, k: int, ef: int, stats: QueryStats = None, filter=None,
+                   timeout: float = None) -> List[Point]:
+        ''' Search the nearest k points for q in all shards
+
+        Args:
+            q: query element
+            k: number of nearest neighbors to return
+            ef: size of the dynamic candidate list, scaled per shard by efs
+            stats: filled in with the counters of all shard searches
+            filter: passed to every shard, see HNSW.knn_search
+            timeout: early cutoff in seconds, shards not done by then are left out
+                of the result, at the cost of recall
+        Returns:
+            K nearest elements to q
+        '''
+        with measure('knn_search_sharded', stats):
+            # converted once, an iterable of ids can only be read once
+            filter = as_filter(filter)
+            futures = [self.__submit(shard.knn_search, q, k, self.__ef(ef, i), None, filter)
+                       for i, shard in enumerate(self._shards)]
+            done, _ = wait(futures, timeout)
+            # shard results come nearest first, so a heap merge of them is sorted
+            vec = self.metric.prepare(q.vec)
+            prepared = Point(q.id, vec)
+            # ties are broken by a counter shared by all runs, points don't compare
+            tie = itertools.count()
+            runs = []
+            for future in futures:
+                if future in done:
+                    points = future.result()
+                    runs.append(zip(batch_distance(prepared, points, self.metric).tolist(), tie, points))
+            return [p for _, _, p in itertools.islice(heapq.merge(*runs), k)]
+
+    def knn_search_batch(self, queries: np.ndarray, k: int, ef: int,
+                         stats: QueryStats = None) -> Tuple[np.ndarray, np.ndarray]:
+        ''' Search the nearest k points for every row of queries in all shards, see HNSW.knn_search_batch
+        '''
+        with measure('knn_search_batch_sharded', stats):
+            futures = [self.__submit(shard.knn_search_batch, queries, k, self.__ef(ef, i))
+                       for i, shard in enumerate(self._shards)]
+            results = [future.result() for future in futures]
+            ids = np.concatenate([ids for ids, _ in results], axis=1)
+            distances = np.concatenate([distances for _, distances in results], axis=1)
+            # padding has distance inf and sorts last
+            order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+            return np.take_along_axis(ids, order, axis=1), np.take_along_axis(distances, order, axis=1)
+
+    def close(self):
+        ''' Release the shard threads and close the storages of all shards
+        '''
+        self._executor.shutdown(wait=True)
+        for shard in self._shards:
+            shard.graph.storage.close()
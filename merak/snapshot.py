@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from merak.graph import LayeredGraph
+from merak.point import Point
+from merak.point_store import PointStore
+from merak.storage import Edge, Storage
+
+VERSION = 1
+MANIFEST = 'manifest.json'
+# ids read from the source storage per request while saving
+_CHUNK = 4096
+
+
+def _layer_files(layer: int) -> Dict[str, str]:
+    return {name: f'layer{layer}_{name}.npy' for name in ('ids', 'offsets', 'neighbors')}
+
+
+def _walk(graph: LayeredGraph) -> List[int]:
+    ''' Ids of all points reached from the entry point over layer 0 edges, breadth first
+    with one request per step, see LayeredGraph.pin_upper_layers. Only edges are read.
+    '''
+    entry_point, _ = graph.entry()
+    frontier = [] if entry_point is None else [entry_point]
+    seen = set(frontier)
+    while frontier:
+        next_frontier = []
+        for begin in range(0, len(frontier), _CHUNK):
+            fetched = graph.storage.get_edges_many(frontier[begin:begin + _CHUNK], 0)
+            for neighbors in fetched.values():
+                for dst in neighbors.get(0, []):
+                    if dst not in seen:
+                        seen.add(dst)
+                        next_frontier.append(dst)
+        frontier = next_frontier
+    return list(seen)
+
+
+def save(graph: LayeredGraph, path: str, metric: str = None, codes: PointStore = None):
+    ''' Write a snapshot of graph into directory path.
+
+    Every array is a .npy file, so a later process can map them with
+    np.load(mmap_mode='r') instead of reading them:
+        ids.npy                 sorted ids of all points, int64
+        vectors.npy             vector of ids[i] in row i
+        layer{L}_ids.npy        sorted ids having neighbors on layer L
+        layer{L}_offsets.npy    neighbors of layer{L}_ids[i] are neighbors[offsets[i]:offsets[i+1]]
+        layer{L}_neighbors.npy  neighbor ids, int64
+        tombstones.npy          sorted ids deleted but not compacted yet, int64
+        codes_ids.npy           ids having a quantizer code, with codes only
+        codes.npy               code of codes_ids[i] in row i
+    The manifest holds shapes, entry point and top layer. It is written last,
+    so a directory without one is an interrupted save. Writes to graph should
+    be paused while saving.
+
+    Storages that can't list their ids, i.e. nebula, are enumerated by walking
+    the layer 0 edges from the entry point, which reads the edges twice. Every point
+    an insert linked into the graph is reached, compact first if deletes left
+    points without incoming edges.
+    '''
+    graph.flush()
+    storage = graph.storage
+    entry_point, top_layer = graph.entry()
+    ids = storage.ids() if storage.listable else _walk(graph)
+    ids = np.array(sorted(ids), dtype=np.int64)
+    tombstones = np.array(sorted(graph.tombstones()), dtype=np.int64)
+    os.makedirs(path, exist_ok=True)
+    manifest_file = os.path.join(path, MANIFEST)
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    np.save(os.path.join(path, 'ids.npy'), ids)
+    np.save(os.path.join(path, 'tombstones.npy'), tombstones)
+    code_count = 0
+    if codes is not None and len(codes) > 0:
+        code_ids = codes.ids()
+        np.save(os.path.join(path, 'codes_ids.npy'), np.array(code_ids, dtype=np.int64))
+        np.save(os.path.join(path, 'codes.npy'), codes.gather(code_ids))
+        code_count = len(code_ids)
+
+    vectors = None
+    # layer -> (ids, neighbor lists), ids come in sorted order
+    adjacency: Dict[int, Tuple[List[int], List[List[int]]]] = {}
+    for begin in range(0, len(ids), _CHUNK):
+        chunk = ids[begin:begin + _CHUNK].tolist()
+        fetched = storage.get_neighbors_many(chunk)
+        for row, id in enumerate(chunk, begin):
+            vec, neighbors = fetched[id]
+            if vectors is None:
+                vectors = np.lib.format.open_memmap(os.path.join(path, 'vectors.npy'), mode='w+',
+                                                    dtype=vec.dtype, shape=(len(ids), len(vec)))
+            vectors[row] = vec
+            for layer, dsts in neighbors.items():
+                if len(dsts) > 0:
+                    layer_ids, lists = adjacency.setdefault(layer, ([], []))
+                    layer_ids.append(id)
+                    lists.append(dsts)
+    if vectors is None:
+        np.save(os.path.join(path, 'vectors.npy'), np.empty((0, 0), dtype=np.float32))
+        dtype, dim = 'float32', 0
+    else:
+        vectors.flush()
+        dtype, dim = str(vectors.dtype), vectors.shape[1]
+        del vectors
+
+    for layer, (layer_ids, lists) in adjacency.items():
+        files = _layer_files(layer)
+        offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+        np.cumsum([len(dsts) for dsts in lists], out=offsets[1:])
+        np.save(os.path.join(path, files['ids']), np.array(layer_ids, dtype=np.int64))
+        np.save(os.path.join(path, files['offsets']), offsets)
+        np.save(os.path.join(path, files['neighbors']),
+                np.fromiter((dst for dsts in lists for dst in dsts), dtype=np.int64, count=offsets[-1]))
+
+    manifest = {
+        'version': VERSION,
+        'count': len(ids),
+        'tombstones': len(tombstones),
+        'codes': code_count,
+        'dim': dim,
+        'dtype': dtype,
+        'layers': sorted(adjacency),
+        'entry_point': entry_point,
+        'top_layer': top_layer,
+        'max_top_layer': graph.max_top_layer,
+        'metric': metric,
+    }
+    tmp = manifest_file + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp, manifest_file)
+
+
+def read_manifest(path: str) -> Dict:
+    file = os.path.join(path, MANIFEST)
+    if not os.path.exists(file):
+        raise ValueError(f"{path} is not a complete snapshot")
+    with open(file) as f:
+        manifest = json.load(f)
+    if manifest['version'] != VERSION:
+        raise ValueError(f"unsupported snapshot version {manifest['version']}")
+    return manifest
+
+
+def read_codes(path: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    ''' (ids, codes) saved with the snapshot at path, None if it has none
+    '''
+    if not read_manifest(path).get('codes'):
+        return None
+    return (np.load(os.path.join(path, 'codes_ids.npy')),
+            np.load(os.path.join(path, 'codes.npy')))
+
+
+class _Layer(object):
+    def __init__(self, path: str, layer: int):
+        files = _layer_files(layer)
+        self.ids = np.load(os.path.join(path, files['ids']), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, files['offsets']), mmap_mode='r')
+        self.neighbors = np.load(os.path.join(path, files['neighbors']), mmap_mode='r')
+
+    def get(self, id: int) -> Optional[List[int]]:
+        i = np.searchsorted(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            return None
+        return self.neighbors[self.offsets[i]:self.offsets[i + 1]].tolist()
+
+
+class SnapshotStorage(Storage):
+    ''' Storage reading a snapshot written by save through memory maps.
+
+    Nothing is read up front, the OS page cache is the warm tier. Lookups are
+    binary searches in the mapped id arrays.
+
+    Writes go to the base storage, which must hold the whole graph, e.g. the
+    NebulaStorage the snapshot was taken from. Points written since loading
+    are read from base from then on, so the graph re-syncs incrementally.
+    Without a base the snapshot is read only.
+    '''
+
+    remote = False
+    # points written to base since loading are tracked as dirty
+    listable = True
+
+    def __init__(self, path: str, base: Storage = None):
+        self._path = path
+        self._manifest = read_manifest(path)
+        self._ids = np.load(os.path.join(path, 'ids.npy'), mmap_mode='r')
+        self._vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+        self._layers = {layer: _Layer(path, layer) for layer in self._manifest['layers']}
+        self._base = base
+        # ids whose vector or edges changed after the snapshot
+        self._dirty: Set[int] = set()
+        # ids deleted after the snapshot, a subset of dirty
+        self._deleted: Set[int] = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        with self._lock:
+            if not self._dirty:
+                return len(self._ids)
+        return len(self.ids())
+
+    @property
+    def manifest(self) -> Dict:
+        return self._manifest
+
+    @property
+    def base(self) -> Optional[Storage]:
+        return self._base
+
+    def ids(self) -> List[int]:
+        with self._lock:
+            dirty = set(self._dirty)
+            deleted = set(self._deleted)
+        ids = (set(self._ids.tolist()) | dirty) - deleted
+        return sorted(ids)
+
+    def _row(self, id: int) -> Optional[int]:
+        i = np.searchsorted(self._ids, id)
+        if i == len(self._ids) or self._ids[i] != id:
+            return None
+        return int(i)
+
+    def _split(self, vids: List[int]) -> Tuple[List[int], List[int]]:
+        ''' (ids served by the snapshot, ids served by base)
+        '''
+        with self._lock:
+            if self._base is None or not self._dirty:
+                return list(vids), []
+            return ([vid for vid in vids if vid not in self._dirty],
+                    [vid for vid in vids if vid in self._dirty])
+
+    def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        local, dirty = self._split(vids)
+        result = {}
+        layers = self._layers.items() if layer is None else \
+            [(layer, self._layers[layer])] if layer in self._layers else []
+        for vid in local:
+            row = self._row(vid)
+            if row is None:
+                if self._base is not None:
+                    dirty.append(vid)
+                continue
+            neighbors = {}
+            for l, adjacency in layers:
+                dsts = adjacency.get(vid)
+                if dsts is not None:
+                    neighbors[l] = dsts
+            result[vid] = (self._vectors[row], neighbors)
+        if dirty:
+            result.update(self._base.get_neighbors_many(dirty, layer))
+        return result
+
+    def get_layer_neighbors(self, layer: int, id: int) -> List[int]:
+        local, _ = self._split([id])
+        if local and self._row(id) is not None:
+            adjacency = self._layers.get(layer)
+            dsts = None if adjacency is None else adjacency.get(id)
+            return [] if dsts is None else dsts
+        if self._base is None:
+            raise KeyError(id)
+        return self._base.get_layer_neighbors(layer, id)
+
+    def write(self, points: List[Point], edges: Iterable[Edge], deleted_edges: Iterable[Edge] = ()):
+        if self._base is None:
+            raise RuntimeError("snapshot storage without a base storage is read only")
+        edges, deleted_edges = list(edges), list(deleted_edges)
+        self._base.write(points, edges, deleted_edges)
+        with self._lock:
+            self._dirty.update(p.id for p in points)
+            self._dirty.update(src for _, src, _ in edges)
+            self._dirty.update(src for _, src, _ in deleted_edges)
+            self._deleted.difference_update(p.id for p in points)
+
+    def delete(self, ids: List[int]) -> Set[int]:
+        if self._base is None:
+            raise RuntimeError("snapshot storage without a base storage is read only")
+        # base holds the whole graph, so it knows every source of an edge to ids
+        sources = self._base.delete(ids)
+        with self._lock:
+            self._dirty.update(ids)
+            self._dirty.update(sources)
+            self._deleted.update(ids)
+        return sources
+
+    def close(self):
+        if self._base is not None:
+            self._base.close()
+
+
+def load(path: str, base: Storage = None, **kwargs) -> LayeredGraph:
+    ''' A LayeredGraph serving the snapshot at path, with its entry point restored
+
+    base: storage taking the writes, see SnapshotStorage
+    kwargs: passed to LayeredGraph
+    '''
+    storage = SnapshotStorage(path, base)
+    manifest = storage.manifest
+    graph = LayeredGraph(manifest['max_top_layer'], storage, **kwargs)
+    if manifest['entry_point'] is not None:
+        graph.set_entry(manifest['entry_point'], manifest['top_layer'])
+    # snapshots written before tombstones were saved have none
+    if manifest.get('tombstones'):
+        for id in np.load(os.path.join(path, 'tombstones.npy')).tolist():
+            graph.tombstone(id)
+    return graph
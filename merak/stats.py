@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_current: contextvars.ContextVar = contextvars.ContextVar('merak_stats', default=None)
+
+
+class QueryStats(object):
+    ''' Counters of one call, e.g. a knn_search or an insert.
+
+    Pass an instance as stats= to the HNSW methods to have it filled in. The
+    counters are updated by the client, the graph and the search code running
+    on behalf of the call, in any thread or task the call uses.
+    '''
+
+    COUNTERS = ('round_trips', 'round_trip_seconds', 'nodes_fetched', 'bytes_decoded',
+                'distance_evals', 'cache_hits', 'cache_misses', 'seconds')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.round_trips = 0
+        self.round_trip_seconds = 0.0
+        self.nodes_fetched = 0
+        self.bytes_decoded = 0
+        self.distance_evals = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = 0.0
+        # layer -> number of points visited in it
+        self.visited: Dict[int, int] = {}
+
+    def __repr__(self) -> str:
+        return f'QueryStats({self.to_dict()})'
+
+    @property
+    def hit_ratio(self) -> float:
+        total = self.cache_hits + self.cache_misses
+        return self.cache_hits / total if total > 0 else 0.0
+
+    def add(self, counter: str, value: float = 1):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + value)
+
+    def add_visited(self, layer: int, count: int):
+        with self._lock:
+            self.visited[layer] = self.visited.get(layer, 0) + count
+
+    def to_dict(self) -> Dict:
+        result = {counter: getattr(self, counter) for counter in self.COUNTERS}
+        result['hit_ratio'] = self.hit_ratio
+        result['visited'] = dict(self.visited)
+        return result
+
+
+def current() -> Optional[QueryStats]:
+    ''' Stats of the call running in this context, None if it is not collected
+    '''
+    return _current.get()
+
+
+def count(counter: str, value: float = 1):
+    stats = _current.get()
+    if stats is not None:
+        stats.add(counter, value)
+
+
+@contextmanager
+def collect(stats: Optional[QueryStats]):
+    ''' Make stats the target of the counters updated in this context, a no-op for None
+    '''
+    if stats is None:
+        yield None
+        return
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def measure(operation: str, stats: Optional[QueryStats], registry: 'Registry' = None):
+    ''' Collect stats of the enclosed call and record it in the registry, a no-op for None
+    '''
+    if stats is None:
+        yield None
+        return
+    start = time.perf_counter()
+    try:
+        with collect(stats):
+            yield stats
+    finally:
+        stats.add('seconds', time.perf_counter() - start)
+        (registry or REGISTRY).record(operation, stats)
+
+
+class Registry(object):
+    ''' Totals of the collected calls per operation, e.g. knn_search, process wide.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._totals: Dict[str, Dict[str, float]] = {}
+        self._buckets: Dict[str, List[int]] = {}
+
+    def record(self, operation: str, stats: QueryStats):
+        with self._lock:
+            totals = self._totals.setdefault(operation, dict.fromkeys(('calls',) + QueryStats.COUNTERS, 0))
+            totals['calls'] += 1
+            for counter in QueryStats.COUNTERS:
+                totals[counter] += getattr(stats, counter)
+            totals['visited'] = totals.get('visited', 0) + sum(stats.visited.values())
+            buckets = self._buckets.setdefault(operation, [0] * len(LATENCY_BUCKETS))
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if stats.seconds <= bound:
+                    buckets[i] += 1
+
+    def snapshot(self) -> Dict[str, Dict[str, float]]:
+        with self._lock:
+            return {operation: dict(totals) for operation, totals in self._totals.items()}
+
+    def reset(self):
+        with self._lock:
+            self._totals.clear()
+            self._buckets.clear()
+
+    def prometheus(self) -> str:
+        ''' Totals in the Prometheus text exposition format
+        '''
+        lines = []
+        with self._lock:
+            names = sorted({counter for totals in self._totals.values() for counter in totals})
+            for counter in names:
+                if counter == 'seconds':
+                    continue
+                name = f'merak_{counter}_total'
+                lines.append(f'# TYPE {name} counter')
+                for operation, totals in sorted(self._totals.items()):
+                    lines.append(f'{name}{{operation="{operation}"}} {totals.get(counter, 0)}')
+
+            name = 'merak_call_seconds'
+            lines.append(f'# TYPE {name} histogram')
+            for operation, buckets in sorted(self._buckets.items()):
+                totals = self._totals[operation]
+                for bound, n in zip(LATENCY_BUCKETS, buckets):
+                    lines.append(f'{name}_bucket{{operation="{operation}",le="{bound}"}} {n}')
+                lines.append(f'{name}_bucket{{operation="{operation}",le="+Inf"}} {totals["calls"]}')
+                lines.append(f'{name}_sum{{operation="{operation}"}} {totals["seconds"]}')
+                lines.append(f'{name}_count{{operation="{operation}"}} {totals["calls"]}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
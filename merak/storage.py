@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from merak.client import AsyncClient, Client
+from merak.point import Point
+from merak.point_store import PointStore
+
+# (layer, src, dst)
+Edge = Tuple[int, int, int]
+
+
+class Storage(object):
+    ''' Where a LayeredGraph keeps its vectors and per-layer edges.
+    '''
+
+    # whether reads pay a round trip, LayeredGraph caches nodes of remote storages only
+    remote = True
+    # whether ids lists the stored points, nebula can't without an index
+    listable = False
+
+    @property
+    def store(self) -> Optional[PointStore]:
+        ''' PointStore holding the vectors in process, None for remote storages
+        '''
+        return None
+
+    def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        ''' {id: (vector, Dict[layer, List[dst id]])} of the given ids, missing ids are left out.
+        If layer is given, only neighbors on that layer are returned.
+        '''
+        raise NotImplementedError
+
+    async def get_neighbors_many_async(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        return self.get_neighbors_many(vids, layer)
+
+    def get_edges_many(self, vids: List[int], layer: int = None) -> Dict[int, Dict[int, List[int]]]:
+        ''' {id: Dict[layer, List[dst id]]} of the given ids, without reading their vectors
+        where the storage allows. Missing ids and ids without edges may be left out.
+        '''
+        return {vid: neighbors for vid, (_, neighbors) in self.get_neighbors_many(vids, layer).items()}
+
+    def get_layer_neighbors(self, layer: int, id: int) -> List[int]:
+        ''' Neighbors of id on one layer, without reading its vector where the storage allows
+        '''
+        return self.get_neighbors_many([id], layer)[id][1].get(layer, [])
+
+    def ids(self) -> List[int]:
+        ''' Ids of all stored points, only available if listable
+        '''
+        raise NotImplementedError
+
+    def write(self, points: List[Point], edges: Iterable[Edge], deleted_edges: Iterable[Edge] = ()):
+        ''' Write vertices, add and delete edges, as one request where the storage allows
+        '''
+        raise NotImplementedError
+
+    def delete(self, ids: List[int]) -> Set[int]:
+        ''' Remove the points of ids with every edge from and to them
+
+        Returns:
+            sources of the removed incoming edges, their neighbor lists changed
+        '''
+        raise NotImplementedError
+
+    def set_neighbors(self, layer: int, id: int, neighbor_ids: List[int]):
+        ''' Replace the neighbors of id on layer with one write
+        '''
+        fetched = self.get_neighbors_many([id], layer)
+        old = set(fetched[id][1].get(layer, [])) if id in fetched else set()
+        new = set(neighbor_ids)
+        self.write([], [(layer, id, dst) for dst in neighbor_ids if dst not in old],
+                   [(layer, id, dst) for dst in old - new])
+
+    def close(self):
+        pass
+
+
+class NebulaStorage(Storage):
+    ''' Vertices of tag t1 and edges e1 ranked by layer in a nebula space.
+    '''
+
+    remote = True
+
+    def __init__(self, client: Client):
+        self._client = client
+        self._async_client: Optional[AsyncClient] = None
+
+    @property
+    def client(self) -> Client:
+        return self._client
+
+    def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        return self._client.get_neighbors_many(vids, layer)
+
+    def get_edges_many(self, vids: List[int], layer: int = None) -> Dict[int, Dict[int, List[int]]]:
+        return self._client.get_edges_many(vids, layer)
+
+    def get_layer_neighbors(self, layer: int, id: int) -> List[int]:
+        # edges only, the vector is not fetched
+        return self._client.get_edges_many([id], layer).get(id, {}).get(layer, [])
+
+    async def get_neighbors_many_async(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        if self._async_client is None:
+            self._async_client = AsyncClient(self._client)
+        return await self._async_client.get_neighbors_many(vids, layer)
+
+    def write(self, points: List[Point], edges: Iterable[Edge], deleted_edges: Iterable[Edge] = ()):
+        b = self._client.insert_batch()
+        for p in points:
+            b.insert_vertex(p.id, p.vec)
+        for layer, src, dst in deleted_edges:
+            b.delete_edge(src, layer, dst)
+        for layer, src, dst in edges:
+            b.insert_edge(src, layer, dst)
+        if len(b) > 0:
+            self._client.insert(b)
+
+    def delete(self, ids: List[int]) -> Set[int]:
+        sources = self._client.get_sources_many(ids)
+        self._client.delete_vertices(ids)
+        deleted = set(ids)
+        return {src for edges in sources.values() for _, src in edges} - deleted
+
+    def close(self):
+        if self._async_client is not None:
+            self._async_client.close()
+        self._client.close()
+
+
+class _Slab(object):
+    ''' Adjacency of one layer as fixed-degree slabs.
+
+    Row r holds the neighbor ids of one node in ids[r, :degrees[r]]. The width
+    doubles when a node outgrows it, the row count doubles when nodes are added.
+    '''
+
+    def __init__(self, width: int, capacity: int = 1024):
+        self._rows: Dict[int, int] = {}
+        self._ids = np.empty((capacity, width), dtype=np.int64)
+        self._degrees = np.zeros(capacity, dtype=np.int32)
+        # rows of dropped nodes, reused before new rows
+        self._free_rows: List[int] = []
+        self._next_row = 0
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._rows
+
+    @property
+    def nbytes(self) -> int:
+        return self._ids.nbytes + self._degrees.nbytes
+
+    def neighbors(self, id: int) -> np.ndarray:
+        row = self._rows[id]
+        return self._ids[row, :self._degrees[row]]
+
+    def add(self, src: int, dst: int):
+        row = self._row(src)
+        degree = self._degrees[row]
+        if dst in self._ids[row, :degree]:
+            return
+        if degree == self._ids.shape[1]:
+            ids = np.empty((self._ids.shape[0], 2 * self._ids.shape[1]), dtype=np.int64)
+            ids[:, :degree] = self._ids
+            self._ids = ids
+        self._ids[row, degree] = dst
+        self._degrees[row] = degree + 1
+
+    def remove(self, src: int, dst: int):
+        if src not in self._rows:
+            return
+        row = self._rows[src]
+        degree = self._degrees[row]
+        neighbors = self._ids[row, :degree]
+        keep = neighbors[neighbors != dst]
+        self._ids[row, :len(keep)] = keep
+        self._degrees[row] = len(keep)
+
+    def drop(self, ids: Set[int]) -> Set[int]:
+        ''' Drop the rows of ids and every edge to them, returns the sources of those edges
+        '''
+        for id in ids:
+            row = self._rows.pop(id, None)
+            if row is not None:
+                self._degrees[row] = 0
+                self._free_rows.append(row)
+        # one vectorized scan of the used rows for edges to ids
+        used = self._ids[:self._next_row]
+        valid = np.arange(used.shape[1])[None, :] < self._degrees[:self._next_row, None]
+        hit_rows = np.flatnonzero((np.isin(used, list(ids)) & valid).any(axis=1))
+        if len(hit_rows) == 0:
+            return set()
+        owners = {row: id for id, row in self._rows.items()}
+        sources = set()
+        for row in hit_rows.tolist():
+            neighbors = self._ids[row, :self._degrees[row]]
+            keep = neighbors[~np.isin(neighbors, list(ids))]
+            self._ids[row, :len(keep)] = keep
+            self._degrees[row] = len(keep)
+            sources.add(owners[row])
+        return sources
+
+    def _row(self, id: int) -> int:
+        row = self._rows.get(id)
+        if row is None:
+            if self._free_rows:
+                row = self._free_rows.pop()
+            else:
+                row = self._next_row
+                self._next_row += 1
+            if row == self._ids.shape[0]:
+                self._ids = np.concatenate([self._ids, np.empty_like(self._ids)])
+                self._degrees = np.concatenate([self._degrees, np.zeros_like(self._degrees)])
+            self._rows[id] = row
+        return row
+
+
+class MemoryStorage(Storage):
+    ''' Everything in process memory: vectors in one PointStore matrix and the
+    adjacency of every layer in integer slabs. Serves hops without any round trip,
+    for hot indexes, benchmarks and tests.
+    '''
+
+    remote = False
+    listable = True
+
+    def __init__(self, dtype=np.float32, degree: int = 16):
+        '''
+        dtype: dtype of the vector matrix
+        degree: initial slab width, grown on demand
+        '''
+        self._store = PointStore(dtype)
+        self._degree = degree
+        self._layers: Dict[int, _Slab] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._store)
+
+    @property
+    def store(self) -> PointStore:
+        return self._store
+
+    @property
+    def nbytes(self) -> int:
+        return self._store.nbytes + sum(slab.nbytes for slab in self._layers.values())
+
+    def get_neighbors_many(self, vids: List[int], layer: int = None) -> Dict[int, Tuple[np.ndarray, Dict]]:
+        result = {}
+        with self._lock:
+            layers = self._slabs(layer)
+            for vid in vids:
+                point = self._store.get(vid)
+                if point is None:
+                    continue
+                neighbors = {l: slab.neighbors(vid).tolist() for l, slab in layers if vid in slab}
+                result[vid] = (point.vec, neighbors)
+        return result
+
+    def get_edges_many(self, vids: List[int], layer: int = None) -> Dict[int, Dict[int, List[int]]]:
+        with self._lock:
+            layers = self._slabs(layer)
+            return {vid: {l: slab.neighbors(vid).tolist() for l, slab in layers if vid in slab}
+                    for vid in vids if vid in self._store}
+
+    def _slabs(self, layer: Optional[int]) -> List[Tuple[int, _Slab]]:
+        if layer is None:
+            return list(self._layers.items())
+        return [(layer, self._layers[layer])] if layer in self._layers else []
+
+    def ids(self) -> List[int]:
+        return self._store.ids()
+
+    def get_layer_neighbors(self, layer: int, id: int) -> List[int]:
+        with self._lock:
+            if id not in self._store:
+                raise KeyError(id)
+            slab = self._layers.get(layer)
+            if slab is None or id not in slab:
+                return []
+            return slab.neighbors(id).tolist()
+
+    def write(self, points: List[Point], edges: Iterable[Edge], deleted_edges: Iterable[Edge] = ()):
+        with self._lock:
+            for p in points:
+                self._store.add(p.id, p.vec)
+            for layer, src, dst in deleted_edges:
+                if layer in self._layers:
+                    self._layers[layer].remove(src, dst)
+            for layer, src, dst in edges:
+                if layer not in self._layers:
+                    self._layers[layer] = _Slab(self._degree)
+                self._layers[layer].add(src, dst)
+
+    def delete(self, ids: List[int]) -> Set[int]:
+        deleted = set(ids)
+        sources: Set[int] = set()
+        with self._lock:
+            for id in deleted:
+                self._store.remove(id)
+            for slab in self._layers.values():
+                sources |= slab.drop(deleted)
+        return sources - deleted
@@ -9,5 +9,10 @@ setup(
     packages=["merak"],
     install_requires=[
         "numpy"
-    ]
+    ],
+    entry_points={
+        "console_scripts": [
+            "merak=merak.__main__:main"
+        ]
+    }
 )
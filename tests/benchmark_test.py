@@ -0,0 +1,50 @@
+import io
+import unittest
+from unittest import mock
+import numpy as np
+
+from merak.__main__ import main
+from merak.benchmark import Benchmark, generate, ground_truth, recall
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self) -> None:
+        self._ids, self._vectors = generate(300, 8)
+        _, self._queries = generate(20, 8, seed=1)
+
+    def test_ground_truth(self):
+        base = self._vectors.astype(np.float32)
+        rows, distances = ground_truth(base, self._queries, 5, block=7)
+        for q, r, d in zip(self._queries.astype(np.float32), rows, distances):
+            exact = np.linalg.norm(base - q, axis=1)
+            self.assertTrue(np.array_equal(r, np.argsort(exact, kind='stable')[:5]))
+            self.assertTrue(np.allclose(d, exact[r], atol=1e-4))
+        rows, _ = ground_truth(base, self._queries, 5, metric='ip')
+        self.assertTrue(np.array_equal(rows[0], np.argsort(-(base @ self._queries[0].astype(np.float32)))[:5]))
+
+    def test_recall(self):
+        truth = np.array([[1, 2], [3, 4]])
+        self.assertEqual(recall(truth, truth), 1.0)
+        self.assertEqual(recall(np.array([[2, 9], [-1, -1]]), truth), 0.25)
+
+    def test_sweep(self):
+        benchmark = Benchmark(self._ids, self._vectors, self._queries, k=5)
+        results = benchmark.sweep([4], [10, 40], [2], ef_construction=20)
+        self.assertEqual([r['ef'] for r in results], [10, 40])
+        for r in results:
+            for key in ('build_seconds', 'recall', 'qps', 'p50_ms', 'p90_ms', 'p99_ms'):
+                self.assertIn(key, r)
+            self.assertGreater(r['qps'], 0)
+        self.assertGreaterEqual(results[1]['recall'], 0.9)
+
+    def test_nebula_sweep_rejected(self):
+        # several builds would share one nebula space
+        with mock.patch('merak.__main__.Client') as client, \
+                mock.patch('sys.stderr', new_callable=io.StringIO):
+            with self.assertRaises(SystemExit):
+                main(['bench', '--ip', '127.0.0.1', '--m', '8,16'])
+        client.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,212 @@
+import threading
+import unittest
+from unittest import mock
+import numpy as np
+
+from nebula3.Exception import IOErrorException
+
+from merak.client import Client
+
+
+class FakeValue:
+    def __init__(self, value):
+        self._value = value
+
+    def as_int(self):
+        return int(self._value)
+
+    def as_string(self):
+        return str(self._value)
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def is_succeeded(self):
+        return True
+
+    def row_size(self):
+        return len(self._rows)
+
+    def row_values(self, i):
+        return [FakeValue(value) for value in self._rows[i]]
+
+
+class FakeSession:
+    ''' Records its queries and answers each with the rows answer returns for it
+    '''
+
+    def __init__(self, answer):
+        self.queries = []
+        self.released = False
+        self.alive = True
+        self.error = None
+        self._answer = answer
+
+    def execute(self, query):
+        if self.error is not None:
+            raise self.error
+        self.queries.append(query)
+        return FakeResult(self._answer(query))
+
+    def ping(self):
+        return self.alive
+
+    def release(self):
+        self.released = True
+
+
+class FakePoolTestCase(unittest.TestCase):
+    ''' Clients created by the tests talk to FakeSessions answering with _answer
+    '''
+
+    def setUp(self) -> None:
+        self._sessions = []
+
+        def get_session(user, password):
+            self._sessions.append(FakeSession(self._answer))
+            return self._sessions[-1]
+
+        patcher = mock.patch('merak.client.ConnectionPool')
+        pool = patcher.start().return_value
+        pool.init.return_value = True
+        pool.get_session.side_effect = get_session
+        self.addCleanup(patcher.stop)
+
+    def _answer(self, query):
+        return []
+
+
+class TestClientPool(FakePoolTestCase):
+    def test_reuse(self):
+        client = Client('127.0.0.1', 9669, pool_size=2)
+        client.execute('YIELD 1')
+        client.execute('YIELD 2')
+        # the eager session is reused for every sequential request
+        self.assertEqual(len(self._sessions), 1)
+        self.assertEqual(self._sessions[0].queries, ['USE test', 'YIELD 1', 'YIELD 2'])
+
+    def test_reconnect(self):
+        client = Client('127.0.0.1', 9669, pool_size=1)
+        self._sessions[0].error = IOErrorException(IOErrorException.E_CONNECT_BROKEN, 'broken')
+        client.execute('YIELD 1')
+        self.assertTrue(self._sessions[0].released)
+        self.assertEqual(len(self._sessions), 2)
+        self.assertEqual(self._sessions[1].queries, ['USE test', 'YIELD 1'])
+
+    def test_health_check(self):
+        client = Client('127.0.0.1', 9669, pool_size=1, health_check_interval=0)
+        self._sessions[0].alive = False
+        client.execute('YIELD 1')
+        self.assertTrue(self._sessions[0].released)
+        self.assertEqual(self._sessions[1].queries, ['USE test', 'YIELD 1'])
+
+    def test_discard_wakes_waiter(self):
+        client = Client('127.0.0.1', 9669, pool_size=1)
+        session = client._checkout()
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(client._checkout()), daemon=True)
+        waiter.start()
+        waiter.join(0.1)
+        # the pool is exhausted, the waiter blocks
+        self.assertTrue(waiter.is_alive())
+
+        # a discarded session frees capacity, the waiter opens a new one
+        client._discard(session)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertIs(taken[0], self._sessions[1])
+
+    def test_checkin_wakes_waiter(self):
+        client = Client('127.0.0.1', 9669, pool_size=1)
+        session = client._checkout()
+        taken = []
+        waiter = threading.Thread(target=lambda: taken.append(client._checkout()), daemon=True)
+        waiter.start()
+        client._checkin(session)
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertIs(taken[0], session)
+        self.assertEqual(len(self._sessions), 1)
+
+    def test_close(self):
+        client = Client('127.0.0.1', 9669, pool_size=2)
+        busy = client._checkout()
+        client._checkin(client._checkout())
+        self.assertEqual(len(self._sessions), 2)
+        client.close()
+        # checked out sessions are released too
+        self.assertTrue(all(session.released for session in self._sessions))
+        client._checkin(busy)
+        with self.assertRaises(RuntimeError):
+            client.execute('YIELD 1')
+        self.assertEqual(len(self._sessions), 2)
+
+    def test_close_wakes_waiter(self):
+        client = Client('127.0.0.1', 9669, pool_size=1)
+        client._checkout()
+        errors = []
+
+        def wait():
+            try:
+                client._checkout()
+            except RuntimeError as e:
+                errors.append(e)
+
+        waiter = threading.Thread(target=wait, daemon=True)
+        waiter.start()
+        waiter.join(0.1)
+        client.close()
+        waiter.join(5)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(len(errors), 1)
+
+
+class TestClientQueries(FakePoolTestCase):
+    def setUp(self) -> None:
+        super().setUp()
+        self._client = Client('127.0.0.1', 9669, pool_size=1)
+        self._vecs = {1: np.array([1, 2], dtype=np.float32), 2: np.array([3, 4], dtype=np.float32)}
+        # (src, rank, dst) of every stored edge
+        self._edges = [(1, 0, 2), (1, 1, 2), (2, 0, 1), (3, 0, 1)]
+
+    def _answer(self, query):
+        if query.startswith('FETCH'):
+            return [(vid, self._client.codec.encode(vec)) for vid, vec in self._vecs.items()
+                    if f"'{vid}'" in query]
+        if query.startswith('GO'):
+            return [edge for edge in self._edges if f"'{edge[0]}'" in query.split(' OVER ')[0] and
+                    ('rank(edge) ==' not in query or f'rank(edge) == {edge[1]}' in query)]
+        return []
+
+    def _queries(self):
+        return self._sessions[0].queries[1:]
+
+    def test_get_neighbors_many(self):
+        result = self._client.get_neighbors_many([1, 2, 5])
+        # one FETCH for all ids, one GO for the ids found
+        self.assertEqual(len(self._queries()), 2)
+        self.assertTrue(self._queries()[0].startswith("FETCH PROP ON t1 '1','2','5'"))
+        self.assertTrue(self._queries()[1].startswith("GO FROM '1','2' OVER e1"))
+        self.assertEqual(sorted(result), [1, 2])
+        self.assertTrue(np.array_equal(result[1][0], self._vecs[1]))
+        self.assertEqual(result[1][1], {0: [2], 1: [2]})
+        self.assertEqual(result[2][1], {0: [1]})
+
+        result = self._client.get_neighbors_many([1], layer=1)
+        self.assertIn('WHERE rank(edge) == 1', self._queries()[-1])
+        self.assertEqual(result[1][1], {1: [2]})
+        self.assertEqual(self._client.get_neighbors(2)[1], {0: [1]})
+
+    def test_get_edges_many(self):
+        self.assertEqual(self._client.get_edges_many([]), {})
+        self.assertEqual(self._queries(), [])
+        edges = self._client.get_edges_many([1, 3, 4])
+        self.assertEqual(len(self._queries()), 1)
+        self.assertEqual(edges, {1: {0: [2], 1: [2]}, 3: {0: [1]}})
+        self.assertEqual(self._client.get_edges_many([1], layer=0), {1: {0: [2]}})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+import numpy as np
+
+from merak.codec import BinaryCodec
+
+
+class TestBinaryCodec(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vec = np.random.random(1000)
+
+    def test_round_trip(self):
+        for dtype in [np.float16, np.float32, np.float64]:
+            codec = BinaryCodec(dtype)
+            data = codec.encode(self._vec)
+            self.assertTrue(isinstance(data, str))
+            vec = codec.decode(data)
+            self.assertEqual(vec.dtype, np.dtype(dtype))
+            self.assertEqual(vec.shape, self._vec.shape)
+            self.assertTrue(np.allclose(vec, self._vec.astype(dtype)))
+
+    def test_raw_bytes(self):
+        codec = BinaryCodec(np.float16, use_base64=False)
+        data = codec.encode(self._vec)
+        self.assertEqual(len(data), BinaryCodec.HEADER.size + 2 * len(self._vec))
+        self.assertTrue(np.array_equal(codec.decode(data), self._vec.astype(np.float16)))
+
+    def test_header_dtype(self):
+        # the header, not the codec instance, decides how a payload is decoded
+        data = BinaryCodec(np.float16).encode(self._vec)
+        self.assertEqual(BinaryCodec(np.float32).decode(data).dtype, np.float16)
+
+    def test_input_dtype(self):
+        codec = BinaryCodec(use_base64=False)
+        # float16 input stays float16, wider input is stored as float32
+        for dtype, itemsize in [(np.float16, 2), (np.float32, 4), (np.float64, 4), (np.int64, 4)]:
+            data = codec.encode(self._vec.astype(dtype))
+            self.assertEqual(len(data), BinaryCodec.HEADER.size + itemsize * len(self._vec))
+            self.assertTrue(np.allclose(codec.decode(data), self._vec.astype(dtype), atol=1e-3))
+
+    def test_corrupted(self):
+        data = BinaryCodec(use_base64=False).encode(self._vec)
+        with self.assertRaises(ValueError):
+            BinaryCodec().decode(data[:-1])
+        with self.assertRaises(ValueError):
+            BinaryCodec(np.complex64)
+
+
+if __name__ == '__main__':
+    unittest.main()
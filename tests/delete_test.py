@@ -0,0 +1,141 @@
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+from helpers import build, random_data
+from merak.graph import LayeredGraph
+from merak.hnsw import HNSW
+from merak.point import Point
+from merak.storage import MemoryStorage
+
+
+class TestDelete(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs, self._queries = random_data(300, 20)
+
+    def _recall(self, hnsw: HNSW, live: list, k: int = 10) -> float:
+        hits = 0
+        for q in self._queries:
+            exact = sorted(live, key=lambda i: np.linalg.norm(self._vecs[i] - q))[:k]
+            found = [p.id for p in hnsw.knn_search(Point(-1, q), k, 64)]
+            hits += len(set(found) & set(exact))
+        return hits / (k * len(self._queries))
+
+    def _edges(self, hnsw: HNSW) -> set:
+        storage = hnsw.graph.storage
+        fetched = storage.get_neighbors_many(storage.ids())
+        return {dst for _, neighbors in fetched.values() for dsts in neighbors.values() for dst in dsts}
+
+    def test_delete_and_compact(self):
+        hnsw = build(self._vecs, compact_ratio=1.0)
+        deleted = list(range(0, 300, 3))
+        # the entry point goes too
+        deleted.append(hnsw.graph.entry_point)
+        for id in set(deleted):
+            hnsw.delete(id)
+        with self.assertRaises(KeyError):
+            hnsw.delete(1000)
+        live = [i for i in range(300) if i not in set(deleted)]
+
+        # tombstoned points are left out of results, but still in the graph
+        for q in self._queries:
+            found = {p.id for p in hnsw.knn_search(Point(-1, q), 10, 64)}
+            self.assertFalse(found & set(deleted))
+        self.assertEqual(len(hnsw.graph.storage), 300)
+
+        self.assertEqual(hnsw.compact(), len(set(deleted)))
+        self.assertEqual(hnsw.graph.tombstone_count, 0)
+        self.assertEqual(sorted(hnsw.graph.storage.ids()), live)
+        self.assertFalse(self._edges(hnsw) & set(deleted))
+        self.assertNotIn(hnsw.graph.entry_point, set(deleted))
+        self.assertGreaterEqual(self._recall(hnsw, live), 0.9)
+        for q in self._queries[:5]:
+            ids, _ = hnsw.knn_search_batch(q[None, :], 10, 64)
+            self.assertFalse(set(ids[0].tolist()) & set(deleted))
+
+    def test_background_compaction(self):
+        hnsw = build(self._vecs, compact_ratio=0.05, compact_batch=8, compact_min=10)
+        for id in range(20):
+            hnsw.delete(id)
+        hnsw.compaction.result()
+        hnsw.compact()
+        self.assertEqual(hnsw.graph.tombstone_count, 0)
+        self.assertEqual(len(hnsw.graph.storage), 280)
+
+    def test_reopened_remote(self):
+        class RemoteStorage(MemoryStorage):
+            remote = True
+
+        storage = RemoteStorage(np.float32)
+        hnsw = build(self._vecs, storage=storage)
+        entry = hnsw.graph.entry()
+        # a new process serving the stored graph can't count its points
+        reopened = HNSW(4, graph=LayeredGraph(4, storage), compact_min=10)
+        reopened.graph.set_entry(*entry)
+        for id in range(9):
+            reopened.delete(id)
+        self.assertIsNone(reopened.compaction)
+        reopened.delete(9)
+        reopened.compaction.result()
+        self.assertEqual(len(storage), 290)
+
+        # with its size given the ratio applies again
+        sized = HNSW(4, graph=LayeredGraph(4, storage, size=290), compact_min=10)
+        sized.graph.set_entry(*reopened.graph.entry())
+        for id in range(10, 30):
+            sized.delete(id)
+        self.assertIsNone(sized.compaction)
+
+    def test_search_during_compaction(self):
+        class RemoteStorage(MemoryStorage):
+            remote = True
+
+        for storage in (MemoryStorage(np.float32), RemoteStorage(np.float32)):
+            hnsw = build(self._vecs, storage=storage, compact_ratio=0.01, compact_batch=16, compact_min=10)
+            deleted = set(range(0, 300, 3))
+            done = threading.Event()
+
+            def search(_):
+                # background compactions remove points these walks still reach
+                while not done.is_set():
+                    for q in self._queries:
+                        self.assertEqual(len(hnsw.knn_search(Point(-1, q), 10, 32)), 10)
+                    ids, _ = hnsw.knn_search_batch(self._queries, 10, 32)
+                    self.assertNotIn(-1, ids.tolist())
+
+            def insert(_):
+                for i, q in enumerate(self._queries):
+                    hnsw.insert(Point(1000 + i, q), 6, 12, 32, 4)
+
+            with ThreadPoolExecutor(4) as executor:
+                searches = [executor.submit(search, i) for i in range(3)]
+                try:
+                    inserts = executor.submit(insert, 0)
+                    for id in sorted(deleted):
+                        hnsw.delete(id)
+                    inserts.result()
+                    hnsw.compact()
+                finally:
+                    done.set()
+                for future in searches:
+                    future.result()
+
+            self.assertEqual(hnsw.graph.tombstone_count, 0)
+            for q in self._queries:
+                found = {p.id for p in hnsw.knn_search(Point(-1, q), 10, 32)}
+                self.assertFalse(found & deleted)
+
+    def test_update(self):
+        hnsw = build(self._vecs)
+        target = self._queries[0] + 10
+        hnsw.update(Point(5, target), 6, 12, 32, 4)
+        self.assertTrue(np.allclose(hnsw.graph.get_point(5).vec, target))
+        self.assertEqual(len(hnsw.graph.storage), 300)
+        self.assertEqual(hnsw.knn_search(Point(-1, target), 1, 32)[0].id, 5)
+        self._vecs[5] = target
+        self.assertGreaterEqual(self._recall(hnsw, list(range(300))), 0.9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import unittest
+import numpy as np
+
+from helpers import build, random_data
+from merak.filter import BitmapFilter, IdFilter, PredicateFilter, as_filter
+from merak.point import Point
+
+
+class TestFilter(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs, queries = random_data(400, 1)
+        self._q = queries[0]
+
+    def _exact(self, allowed, k):
+        ids = [i for i in range(len(self._vecs)) if allowed(i)]
+        return sorted(ids, key=lambda i: np.linalg.norm(self._vecs[i] - self._q))[:k]
+
+    def test_as_filter(self):
+        self.assertIsNone(as_filter(None))
+        self.assertIsInstance(as_filter([1, 2]), IdFilter)
+        self.assertIsInstance(as_filter(np.zeros(3, dtype=bool)), BitmapFilter)
+        self.assertIsInstance(as_filter(lambda id: True), PredicateFilter)
+        bitmap = BitmapFilter(np.array([True, False, True]), offset=10)
+        self.assertEqual(bitmap.ids().tolist(), [10, 12])
+        self.assertTrue(bitmap(12))
+        self.assertFalse(bitmap(11))
+        self.assertFalse(bitmap(2))
+        self.assertIsNone(PredicateFilter(lambda id: True).size())
+
+    def test_filtered_search(self):
+        k, ef = 10, 100
+        # brute force is disabled, so every filter goes through the graph
+        hnsw = build(self._vecs, brute_force_limit=0)
+        bitmap = np.arange(len(self._vecs)) % 3 == 0
+        for filter in (list(range(0, 400, 2)), bitmap, lambda id: id % 5 == 1):
+            allowed = as_filter(filter)
+            knns = hnsw.knn_search(Point(-1, self._q), k, ef, filter=filter)
+            ids = [p.id for p in knns]
+            self.assertEqual(len(ids), k)
+            self.assertTrue(all(allowed(id) for id in ids))
+            exact = self._exact(allowed, k)
+            self.assertGreaterEqual(len(set(ids) & set(exact)), k - 1)
+
+    def test_brute_force(self):
+        hnsw = build(self._vecs)
+        # 1000 is not in the graph and left out
+        allowed = [3, 50, 120, 399, 1000]
+        knns = hnsw.knn_search(Point(-1, self._q), 10, 20, filter=allowed)
+        self.assertEqual([p.id for p in knns], self._exact(IdFilter(allowed), 10))
+        self.assertEqual(hnsw.knn_search(Point(-1, self._q), 3, 20, filter=[]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
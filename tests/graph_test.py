@@ -1,8 +1,14 @@
+import threading
+import time
 import unittest
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 
 from merak.point import Point
 from merak.graph import LayeredGraph, Node
+from merak.hnsw import HNSW
+from merak.point_cache import PointCache
+from merak.storage import MemoryStorage
 
 
 class TestLayeredGraph(unittest.TestCase):
@@ -49,6 +55,155 @@ class TestLayeredGraph(unittest.TestCase):
         for p in [self._p1, self._p2]:
             self.assertTrue(p in neighbors0)
 
+    def test_pin_upper_layers(self):
+        self.assertEqual(self._graph.pin_upper_layers(), 3)
+        self.assertEqual(len(self._graph.pinned), 3)
+        self.assertEqual(sorted(self._graph.get_neighbor_ids(1, 0)), [1, 2])
+
+        # writes above the pinned layer keep the resident copy current
+        p5 = Point(5, np.array([2, 2]))
+        self._graph.add_point(1, p5)
+        self._graph.add_edge(1, self._p0, p5)
+        self._graph.add_edge(0, self._p0, p5)
+        self.assertEqual(sorted(self._graph.pinned.get_layer_neighbors(1, 0)), [1, 2, 5])
+        self.assertEqual(self._graph.pinned.get_layer_neighbors(0, 0), [])
+
+    def test_pinned_search(self):
+        class CountingStorage(MemoryStorage):
+            remote = True
+            layers = []
+
+            def get_neighbors_many(self, vids, layer=None):
+                self.layers.append(layer)
+                return super().get_neighbors_many(vids, layer)
+
+            def get_layer_neighbors(self, layer, id):
+                self.layers.append(layer)
+                return super().get_layer_neighbors(layer, id)
+
+        storage = CountingStorage()
+        hnsw = HNSW(4, storage)
+        vecs = np.random.random((100, 3))
+        for i, vec in enumerate(vecs):
+            hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        expected = [p.id for p in hnsw.knn_search(Point(1000, vecs[7]), 5, 16)]
+
+        graph = hnsw.graph
+        graph.pin_upper_layers()
+        graph.cache.clear()
+        storage.layers.clear()
+        pinned_ids = graph.pinned.ids()
+        graph.get_points(pinned_ids)
+        for id in pinned_ids:
+            for l in range(1, graph.top_layer + 1):
+                graph.get_neighbor_ids(l, id)
+        # the upper layers are served without reading storage
+        self.assertEqual(storage.layers, [])
+        self.assertEqual([p.id for p in hnsw.knn_search(Point(1000, vecs[7]), 5, 16)], expected)
+
+    def test_concurrent_eviction(self):
+        class RemoteStorage(MemoryStorage):
+            remote = True
+
+        # a cache far smaller than the graph, every search evicts nodes other searches still use
+        graph = LayeredGraph(4, RemoteStorage(np.float32), cache=PointCache(max_entries=200))
+        hnsw = HNSW(4, graph=graph)
+        rng = np.random.default_rng(0)
+        vecs = rng.random((500, 8), dtype=np.float32)
+        for i, vec in enumerate(vecs):
+            hnsw.insert(Point(i, vec), 6, 12, 32, 4)
+        queries = rng.random((30, 8), dtype=np.float32)
+        expected = [[p.id for p in hnsw.knn_search(Point(-1, q), 10, 32)] for q in queries]
+
+        def search(_):
+            results = []
+            for q in queries:
+                knns = hnsw.knn_search(Point(-1, q), 10, 32)
+                self.assertTrue(all(np.array_equal(p.vec, vecs[p.id]) for p in knns))
+                results.append([p.id for p in knns])
+            return results
+
+        with ThreadPoolExecutor(8) as executor:
+            for results in executor.map(search, range(8)):
+                self.assertEqual(results, expected)
+
+    def test_raise_top_under_node_locks(self):
+        # a compaction lowered the top layer below the layer an insert picked
+        self._graph.set_entry(3, 0)
+        compacting = threading.Event()
+
+        def compact():
+            # the lock order of compactions: entry lock, then node locks
+            with self._graph.entry_lock:
+                compacting.set()
+                with self._graph.lock_nodes([0]):
+                    pass
+
+        def insert():
+            batch = self._graph.add_batch()
+            batch.add_point(Point(5, np.array([2, 2])), 2)
+            batch.add_edge(0, 0, 5)
+            with self._graph.lock_nodes([0]):
+                compactor.start()
+                compacting.wait()
+                self._graph.add(batch)
+
+        compactor = threading.Thread(target=compact, daemon=True)
+        inserter = threading.Thread(target=insert, daemon=True)
+        inserter.start()
+        inserter.join(5)
+        compactor.join(5)
+        self.assertFalse(inserter.is_alive() or compactor.is_alive())
+        self.assertEqual(self._graph.entry(), (5, 2))
+
+    def test_write_behind(self):
+        class CountingStorage(MemoryStorage):
+            remote = True
+
+            def __init__(self):
+                super().__init__()
+                self.writes = 0
+
+            def write(self, points, edges, deleted_edges=()):
+                self.writes += 1
+                super().write(points, edges, deleted_edges)
+
+        storage = CountingStorage()
+        graph = LayeredGraph(4, storage, write_behind=True, flush_size=10 ** 6, flush_interval=3600)
+        hnsw = HNSW(4, graph=graph)
+        vecs = np.random.random((200, 3))
+        for i, vec in enumerate(vecs):
+            hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        self.assertEqual(storage.writes, 0)
+        self.assertEqual(len(storage), 0)
+        # buffered inserts are searchable
+        expected = [p.id for p in hnsw.knn_search(Point(1000, vecs[7]), 5, 32)]
+        self.assertEqual(expected[0], 7)
+
+        hnsw.flush()
+        self.assertEqual(storage.writes, 1)
+        self.assertEqual(len(storage), 200)
+        self.assertTrue(np.allclose(graph.get_point(7).vec, vecs[7]))
+        graph.cache.clear()
+        self.assertEqual([p.id for p in hnsw.knn_search(Point(1000, vecs[7]), 5, 32)], expected)
+        graph.close()
+
+    def test_flush_triggers(self):
+        storage = MemoryStorage()
+        graph = LayeredGraph(4, storage, write_behind=True, flush_size=100, flush_interval=0.05)
+        hnsw = HNSW(4, graph=graph)
+        vecs = np.random.random((50, 3))
+        for i, vec in enumerate(vecs):
+            hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        # flushed by size on the way, then by age in the background
+        self.assertGreater(len(storage), 0)
+        for _ in range(100):
+            if len(storage) == 50:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(storage), 50)
+        graph.close()
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,24 @@
+''' Data and indexes shared by the tests
+'''
+from typing import Tuple
+
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.point import Point
+
+
+def random_data(count: int, queries: int, dim: int = 8, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    ''' count points and queries drawn uniformly from the unit cube, float32
+    '''
+    rng = np.random.default_rng(seed)
+    return rng.random((count, dim)).astype(np.float32), rng.random((queries, dim)).astype(np.float32)
+
+
+def build(vecs: np.ndarray, **kwargs) -> HNSW:
+    ''' An index of vecs, point i holding vecs[i]. kwargs are passed to HNSW
+    '''
+    hnsw = HNSW(4, **kwargs)
+    for i, vec in enumerate(vecs):
+        hnsw.insert(Point(i, vec), 6, 12, 32, 4)
+    return hnsw
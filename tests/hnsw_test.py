@@ -1,8 +1,11 @@
+import asyncio
 import numpy as np
 import unittest
 
-from merak.point import Point
+from merak.graph import LayeredGraph
+from merak.point import Point, batch_distance
 from merak.hnsw import HNSW
+from merak.storage import MemoryStorage
 
 
 class TestHNSW(unittest.TestCase):
@@ -34,6 +37,88 @@ class TestHNSW(unittest.TestCase):
         for p in knns:
             print(p)
 
+    def test_degree_bound(self):
+        hnsw = HNSW(self._ml)
+        m_max, m_max0 = 4, 6
+        for i, vec in enumerate(np.random.random((200, 3))):
+            hnsw.insert(Point(i, vec), 3, m_max, 16, self._ml, m_max0)
+        graph = hnsw.graph
+        for i in range(200):
+            ids = graph.get_neighbor_ids(0, i)
+            self.assertGreater(len(ids), 0)
+            self.assertLessEqual(len(ids), m_max0)
+            for l in range(1, graph.top_layer + 1):
+                self.assertLessEqual(len(graph.get_neighbor_ids(l, i)), m_max)
+
+    def test_concurrent_insert_many(self):
+        class RemoteStorage(MemoryStorage):
+            remote = True
+
+        for write_behind in (False, True):
+            with self.subTest(write_behind=write_behind):
+                storage = RemoteStorage(np.float32)
+                # small buffers, flushes run between the inserts
+                graph = LayeredGraph(self._ml, storage, write_behind=write_behind, flush_size=200,
+                                     flush_interval=0.01)
+                hnsw = HNSW(self._ml, graph=graph)
+                self._check_concurrent_insert_many(hnsw, storage)
+                graph.close()
+
+    def _check_concurrent_insert_many(self, hnsw: HNSW, storage: MemoryStorage):
+        m_max, m_max0 = 8, 12
+        vecs = np.random.default_rng(0).random((500, 8)).astype(np.float32)
+        hnsw.insert_many([Point(i, vec) for i, vec in enumerate(vecs)], 6, m_max, 32, self._ml, m_max0,
+                         workers=8)
+        hnsw.flush()
+
+        fetched = storage.get_neighbors_many(storage.ids())
+        self.assertEqual(len(fetched), 500)
+        edges = {(l, src, dst) for src, (_, neighbors) in fetched.items()
+                 for l, dsts in neighbors.items() for dst in dsts}
+        for l, src, dst in edges:
+            degree = len(fetched[dst][1][l]) if l in fetched[dst][1] else 0
+            max_degree = m_max0 if l == 0 else m_max
+            self.assertLessEqual(len(fetched[src][1][l]), max_degree)
+            # every reverse edge is added, it is only missing where pruning at full degree dropped it
+            if (l, dst, src) not in edges:
+                self.assertEqual(degree, max_degree, (l, src, dst))
+
+        # no racing write left an outdated node in the cache
+        cache = hnsw.graph.cache
+        self.assertGreater(len(cache), 0)
+        for id, (vec, neighbors) in fetched.items():
+            if id in cache:
+                node = cache.get(id)
+                self.assertTrue(np.array_equal(node.point.vec, vec))
+                self.assertEqual({l: sorted(dsts) for l, dsts in node.neighbors().items() if dsts},
+                                 {l: sorted(dsts) for l, dsts in neighbors.items() if dsts})
+
+    def test_knn_search_async(self):
+        hnsw = HNSW(self._ml)
+        rng = np.random.default_rng(0)
+        for i, vec in enumerate(rng.random((300, 8))):
+            hnsw.insert(Point(i, vec), 6, 12, 32, self._ml)
+        for q in rng.random((20, 8)):
+            expected = [p.id for p in hnsw.knn_search(Point(-1, q), 10, 32)]
+            for prefetch in (1, 4):
+                knns = asyncio.run(hnsw.knn_search_async(Point(-1, q), 10, 32, prefetch=prefetch))
+                self.assertEqual([p.id for p in knns], expected)
+
+    def test_knn_search_batch(self):
+        rng = np.random.default_rng(0)
+        vecs = rng.random((300, 128))
+        queries = rng.random((30, 128))
+        for dtype in (np.float32, np.float16):
+            hnsw = HNSW(self._ml, MemoryStorage(dtype))
+            for i, vec in enumerate(vecs.astype(dtype)):
+                hnsw.insert(Point(i, vec), 6, 12, 32, self._ml)
+            typed = queries.astype(dtype)
+            ids, distances = hnsw.knn_search_batch(typed, 10, 32)
+            for q, row_ids, row_distances in zip(typed, ids, distances):
+                knns = hnsw.knn_search(Point(-1, q), 10, 32)
+                self.assertEqual(row_ids.tolist(), [p.id for p in knns], dtype)
+                self.assertTrue(np.allclose(row_distances, batch_distance(Point(-1, q), knns), rtol=1e-4))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,132 @@
+import os
+import queue
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+import numpy as np
+
+from merak.__main__ import main
+from merak.hnsw import HNSW
+from merak.importer import BulkImporter, Checkpoint, StreamImporter, list_parts, load_part
+from merak.point import Point
+from merak.storage import MemoryStorage
+
+
+class TestImporter(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = self._dir.name
+        for part in [10, 2, 1]:
+            vec = np.random.random((5, 3)).astype(np.float16)
+            np.savez_compressed(os.path.join(self._path, f'part{part}'), vector=vec)
+        np.savez_compressed(os.path.join(self._path, 'part0'),
+                            id=np.arange(1, 6, dtype=np.int32), vector=np.zeros((5, 3)))
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_list_parts(self):
+        self.assertEqual(list_parts(self._path),
+                         ['part0.npz', 'part1.npz', 'part2.npz', 'part10.npz'])
+
+    def test_load_part(self):
+        ids, vectors = load_part(os.path.join(self._path, 'part0.npz'), 100)
+        self.assertEqual(list(ids), [1, 2, 3, 4, 5])
+        self.assertEqual(vectors.shape, (5, 3))
+        # parts without ids
+        ids, _ = load_part(os.path.join(self._path, 'part2.npz'), 100)
+        self.assertEqual(list(ids), [200, 201, 202, 203, 204])
+
+    def test_checkpoint(self):
+        file = os.path.join(self._path, 'checkpoint.json')
+        checkpoint = Checkpoint(file)
+        self.assertEqual(checkpoint.rows_done('part0.npz'), 0)
+        checkpoint.update('part0.npz', 5, True, 3, 2)
+        checkpoint.update('part1.npz', 2, False, 4, 3)
+
+        resumed = Checkpoint(file)
+        self.assertTrue(resumed.part_done('part0.npz'))
+        self.assertFalse(resumed.part_done('part1.npz'))
+        self.assertEqual(resumed.rows_done('part1.npz'), 2)
+        self.assertEqual(resumed.entry_point, 4)
+        self.assertEqual(resumed.top_layer, 3)
+
+    def test_run(self):
+        importer = BulkImporter(HNSW(4), os.path.join(self._path, 'checkpoint.json'), m=4, m_max=8,
+                                ef=16, workers=2, batch_size=3, id_stride=100)
+        # progress goes to the log, not to stdout
+        with self.assertLogs('merak.importer', 'INFO') as logs:
+            self.assertEqual(importer.run(self._path), 20)
+        self.assertTrue(logs.output[-1].startswith('INFO:merak.importer:imported 20 vectors'), logs.output)
+
+    def test_import_command(self):
+        class CountingStorage(MemoryStorage):
+            remote = True
+            writes = 0
+
+            def write(self, points, edges, deleted_edges=()):
+                self.writes += 1
+                super().write(points, edges, deleted_edges)
+
+        storage = CountingStorage(np.float32)
+        with mock.patch('merak.__main__.Client'), \
+                mock.patch('merak.__main__.NebulaStorage', return_value=storage):
+            main(['import', self._path, '--checkpoint', os.path.join(self._path, 'checkpoint.json'),
+                  '--workers', '2', '--batch-size', '10', '--id-stride', '100',
+                  '--m', '4', '--m-max', '8', '--ef', '16'])
+        self.assertEqual(len(storage), 20)
+        # writes are grouped, at most one per checkpoint instead of one per vector
+        self.assertLessEqual(storage.writes, 4)
+
+
+class TestStreamImporter(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self._vecs = np.random.random((120, 4)).astype(np.float32)
+
+    def test_iterable(self):
+        batches = []
+        hnsw = HNSW(4)
+        importer = StreamImporter(hnsw, m=4, m_max=8, ef=16, workers=2, batch_size=50,
+                                  on_batch=lambda ids, payloads: batches.append((ids, payloads)),
+                                  report_interval=3600)
+        items = ((i, vec, f'text {i}') for i, vec in enumerate(self._vecs))
+        with self.assertLogs('merak.importer', 'INFO') as logs:
+            self.assertEqual(importer.run(items), 120)
+        self.assertIn('imported 120 vectors', logs.output[-1])
+        self.assertEqual(importer.pending, 0)
+        self.assertEqual(sorted(len(ids) for ids, _ in batches), [20, 50, 50])
+        for ids, payloads in batches:
+            self.assertEqual(payloads, [f'text {id}' for id in ids])
+        self.assertEqual(hnsw.knn_search(Point(-1, self._vecs[7]), 1, 16)[0].id, 7)
+
+    def test_queue(self):
+        # two producers, each ending its stream with an empty tuple
+        source = queue.Queue(maxsize=8)
+        sizes = []
+
+        def produce(ids):
+            for i in ids:
+                source.put((i, self._vecs[i]))
+            # a pause longer than max_delay flushes a partial batch
+            time.sleep(0.3)
+            source.put(())
+
+        producers = [threading.Thread(target=produce, args=(range(i, 120, 2),)) for i in range(2)]
+        for producer in producers:
+            producer.start()
+        importer = StreamImporter(HNSW(4), m=4, m_max=8, ef=16, workers=2, batch_size=1000,
+                                  max_delay=0.1, max_pending=1,
+                                  on_batch=lambda ids, _: sizes.append(len(ids)), report_interval=3600)
+        self.assertEqual(importer.run(source, producers=2), 120)
+        for producer in producers:
+            producer.join()
+        # never a full batch, every batch was flushed by age
+        self.assertEqual(sum(sizes), 120)
+        self.assertGreater(importer.lag, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,71 @@
+import unittest
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.metric import METRICS, get_metric
+from merak.point import Point, batch_distance
+from merak.point_store import PointStore
+
+
+class TestMetric(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs = np.random.random((20, 8)).astype(np.float32)
+        self._q = np.random.random(8).astype(np.float32)
+
+    def test_kernels(self):
+        diff = self._vecs - self._q
+        dots = self._vecs @ self._q
+        cos = dots / np.linalg.norm(self._vecs, axis=1) / np.linalg.norm(self._q)
+        expected = {
+            'l2': np.linalg.norm(diff, axis=1),
+            'l2sq': (diff ** 2).sum(axis=1),
+            'ip': -dots,
+            'cosine': 1 - cos,
+        }
+        for name, metric in METRICS.items():
+            vecs, q = metric.prepare(self._vecs), metric.prepare(self._q)
+            self.assertTrue(np.allclose(metric.one_to_many(q, vecs), expected[name], atol=1e-5), name)
+            self.assertAlmostEqual(metric.pair(vecs[3], q), expected[name][3], places=5)
+            rowwise = metric.rowwise(vecs, np.tile(q, (len(vecs), 1)))
+            self.assertTrue(np.allclose(rowwise, expected[name], atol=1e-5), name)
+
+    def test_rowwise_float16(self):
+        a = np.random.random((50, 256)).astype(np.float16)
+        b = np.random.random((50, 256)).astype(np.float16)
+        exact_a, exact_b = a.astype(np.float64), b.astype(np.float64)
+        # accumulated in float16 the sums would be off in the third digit
+        self.assertTrue(np.allclose(get_metric('l2sq').rowwise(a, b),
+                                    ((exact_a - exact_b) ** 2).sum(axis=1), rtol=1e-9))
+        self.assertTrue(np.allclose(get_metric('ip').rowwise(a, b),
+                                    -(exact_a * exact_b).sum(axis=1), rtol=1e-9))
+        # the pair and one-to-many kernels agree with it for float16 queries
+        l2sq = get_metric('l2sq')
+        self.assertAlmostEqual(l2sq.pair(a[0], b[0]), l2sq.rowwise(a, b)[0], places=6)
+        self.assertTrue(np.allclose(l2sq.one_to_many(a[0], b.astype(np.float32)),
+                                    ((exact_b - exact_a[0]) ** 2).sum(axis=1), rtol=1e-5))
+
+    def test_cached_norms(self):
+        store = PointStore(capacity=4)
+        points = [store.add(i, vec) for i, vec in enumerate(self._vecs)]
+        self.assertTrue(np.allclose(store.norms(store.rows([0, 7])), (self._vecs[[0, 7]] ** 2).sum(axis=1)))
+        q = Point(100, self._q)
+        metric = get_metric('l2sq')
+        owned = [Point(p.id, p.vec.copy()) for p in points]
+        self.assertTrue(np.allclose(batch_distance(q, points, metric), batch_distance(q, owned, metric), atol=1e-5))
+        with self.assertRaises(ValueError):
+            get_metric('hamming')
+
+    def test_cosine_search(self):
+        hnsw = HNSW(4, metric='cosine')
+        # scaled copies point the same way, they are all nearest under cosine
+        for i, vec in enumerate(self._vecs):
+            hnsw.insert(Point(i, vec * (i + 1)), 3, 8, 16, 4)
+        knns = hnsw.knn_search(Point(100, self._vecs[5] * 100), 1, 16)
+        self.assertEqual(knns[0].id, 5)
+        ids, distances = hnsw.knn_search_batch(self._vecs[[5]], 1, 16)
+        self.assertEqual(ids[0, 0], 5)
+        self.assertAlmostEqual(distances[0, 0], 0, places=5)
+
+
+if __name__ == '__main__':
+    unittest.main()
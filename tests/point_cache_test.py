@@ -0,0 +1,65 @@
+import unittest
+import numpy as np
+
+from merak.point import Point
+from merak.graph import Node
+from merak.point_cache import PointCache
+
+
+class TestPointCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self._nodes = [Node(Point(i, np.array([i, i], dtype=np.float32)), {0: [i + 1]})
+                       for i in range(10)]
+
+    def test_hit_miss(self):
+        cache = PointCache(max_entries=4)
+        self.assertIsNone(cache.get(0))
+        cache.add(self._nodes[0])
+        self.assertEqual(cache.get(0).id, 0)
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(cache.misses, 1)
+        self.assertEqual(cache.nbytes, self._nodes[0].nbytes)
+
+    def test_lru_eviction(self):
+        cache = PointCache(max_entries=3)
+        for node in self._nodes[:3]:
+            cache.add(node)
+        cache.get(0)
+        cache.add(self._nodes[3])
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(cache.evictions, 1)
+        self.assertTrue(0 in cache)
+        self.assertFalse(1 in cache)
+
+    def test_bytes_bound(self):
+        node_bytes = self._nodes[0].nbytes
+        cache = PointCache(max_entries=100, max_bytes=node_bytes * 2)
+        for node in self._nodes[:5]:
+            cache.add(node)
+        self.assertEqual(len(cache), 2)
+        self.assertLessEqual(cache.nbytes, node_bytes * 2)
+
+    def test_2q_scan_resistant(self):
+        cache = PointCache(max_entries=4, policy='2q')
+        # 0 is hot: evicted from probation once, then admitted to the main queue
+        cache.add(self._nodes[0])
+        for node in self._nodes[1:5]:
+            cache.add(node)
+        self.assertFalse(0 in cache)
+        cache.add(self._nodes[0])
+        # a scan over cold nodes only churns the probation queue
+        for node in self._nodes[5:]:
+            cache.add(node)
+        self.assertTrue(0 in cache)
+        self.assertEqual(len(cache), 4)
+
+    def test_remove(self):
+        cache = PointCache()
+        cache.add(self._nodes[0])
+        cache.remove(0)
+        self.assertFalse(0 in cache)
+        self.assertEqual(cache.nbytes, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,46 @@
+import unittest
+from unittest import mock
+import numpy as np
+
+from merak.point import Point, batch_distance
+from merak.point_store import PointStore
+
+
+class TestPointStore(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs = np.random.random((10, 4)).astype(np.float32)
+        self._store = PointStore(capacity=4)
+        self._points = [self._store.add(i, vec) for i, vec in enumerate(self._vecs)]
+
+    def test_view(self):
+        self.assertEqual(len(self._store), 10)
+        self.assertEqual(self._store.dim, 4)
+        for i, p in enumerate(self._points):
+            self.assertEqual(p, Point(i, self._vecs[i]))
+            self.assertTrue(np.array_equal(p.vec, self._vecs[i]))
+        self.assertFalse(hasattr(self._points[0], '__dict__'))
+        # sized from the store, the row is not copied out
+        with mock.patch.object(PointStore, 'vector', side_effect=AssertionError):
+            self.assertEqual(self._points[0].nbytes, 16)
+
+    def test_distances(self):
+        q = Point(100, np.zeros(4, dtype=np.float32))
+        expected = np.linalg.norm(self._vecs, axis=1)
+        self.assertTrue(np.allclose(batch_distance(q, self._points), expected))
+        rows = self._store.rows([3, 5])
+        self.assertTrue(np.array_equal(self._store.vectors(rows), self._vecs[[3, 5]]))
+
+    def test_remove(self):
+        p = self._points[3]
+        self._store.remove(3)
+        self.assertFalse(3 in self._store)
+        # the released row is reused, the old view keeps its own copy
+        reused = self._store.add(100, np.ones(4))
+        self.assertEqual(reused.row, 3)
+        self.assertIsNone(p.store)
+        self.assertTrue(np.array_equal(p.vec, self._vecs[3]))
+        self.assertEqual(p.nbytes, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,10 @@
 import unittest
 import numpy as np
 
-from merak.point import Point, Points
+from merak.point import Point, DistanceQueue, batch_distance
 
 
-class TestPointsMethods(unittest.TestCase):
+class TestPointMethods(unittest.TestCase):
     def setUp(self):
         self.vec0 = np.array([0, 0])
         self.vec1 = np.array([0, 1])
@@ -18,76 +18,48 @@ class TestPointsMethods(unittest.TestCase):
 
         self.points = [self.p0, self.p1, self.p2, self.p3]
 
-    def test_base(self):
-        points = Points(self.p0, True, self.points)
-        self.assertEqual(points.base, self.p0)
+    def test_distances(self):
+        distances = batch_distance(self.p0, self.points)
+        for p, dist in zip(self.points, distances):
+            self.assertAlmostEqual(dist, p.distance(self.p0))
+        self.assertAlmostEqual(distances[-1], np.sqrt(5))
 
-    def test_length(self):
-        points = Points(self.p0, True, self.points)
-        self.assertEqual(len(points), 4)
 
-    def test_contains(self):
-        points = Points(self.p0, True, self.points)
-        self.assertTrue(self.p0 in points)
-        self.assertTrue(self.p1 in points)
-        self.assertTrue(self.p2 in points)
-        self.assertTrue(self.p3 in points)
-
-    def test_nearest(self):
-        points = Points(self.p0, True, self.points)
-
-        try:
-            points.pop_furthest()
-        except Exception as e:
-            self.assertTrue(isinstance(e, AssertionError))
-
-        self.assertEqual(points.furthest(), self.p3)
-        self.assertEqual(points.nearest(), self.p0)
-        self.assertEqual(points.pop_nearest(), self.p0)
-
-        self.assertEqual(points.furthest(), self.p3)
-        self.assertEqual(points.nearest(), self.p1)
-        self.assertEqual(points.pop_nearest(), self.p1)
-
-        self.assertEqual(points.furthest(), self.p3)
-        self.assertEqual(points.nearest(), self.p2)
-        self.assertEqual(points.pop_nearest(), self.p2)
-
-        self.assertEqual(points.furthest(), self.p3)
-        self.assertEqual(points.nearest(), self.p3)
-        self.assertEqual(points.pop_nearest(), self.p3)
-
-    def test_furthest(self):
-        points = Points(self.p0, False, self.points)
-
-        try:
-            points.pop_nearest()
-        except Exception as e:
-            self.assertTrue(isinstance(e, AssertionError))
-
-        self.assertEqual(points.nearest(), self.p0)
-        self.assertEqual(points.furthest(), self.p3)
-        self.assertEqual(points.pop_furthest(), self.p3)
-
-        self.assertEqual(points.furthest(), self.p2)
-        self.assertEqual(points.nearest(), self.p0)
-        self.assertEqual(points.pop_furthest(), self.p2)
-
-        self.assertEqual(points.furthest(), self.p1)
-        self.assertEqual(points.nearest(), self.p0)
-        self.assertEqual(points.pop_furthest(), self.p1)
-
-        self.assertEqual(points.furthest(), self.p0)
-        self.assertEqual(points.nearest(), self.p0)
-        self.assertEqual(points.pop_furthest(), self.p0)
-
-    def test_values(self):
-        points = Points(self.p0, False, self.points)
-
-        self.assertEqual(len(points.values), len(self.points))
-        self.assertEqual(type(points.values), type(self.points))
-        for val in points.values:
-            self.assertTrue(val in self.points)
+class TestDistanceQueueMethods(unittest.TestCase):
+    def setUp(self):
+        self.pairs = [(float(d), i) for i, d in enumerate(np.random.permutation(100))]
+
+    def test_both_ends(self):
+        queue = DistanceQueue()
+        for dist, id in self.pairs:
+            queue.push(dist, id)
+        self.assertEqual(len(queue), len(self.pairs))
+        self.assertEqual(queue.nearest()[0], 0)
+        self.assertEqual(queue.furthest()[0], 99)
+
+        nearest = [queue.pop_nearest()[0] for _ in range(10)]
+        furthest = [queue.pop_furthest()[0] for _ in range(10)]
+        self.assertEqual(nearest, list(range(10)))
+        self.assertEqual(furthest, list(range(99, 89, -1)))
+        self.assertEqual([dist for dist, _ in queue.sorted()], list(range(10, 90)))
+
+    def test_capacity(self):
+        queue = DistanceQueue(10)
+        for dist, id in self.pairs:
+            queue.push(dist, id)
+        self.assertEqual(len(queue), 10)
+        self.assertEqual(queue.furthest()[0], 9)
+        self.assertFalse(queue.push(50, 1000))
+        self.assertTrue(queue.push(0.5, 1000))
+        self.assertEqual(queue.furthest()[0], 8)
+
+    def test_duplicate(self):
+        queue = DistanceQueue()
+        self.assertTrue(queue.push(1.0, 7))
+        self.assertFalse(queue.push(0.5, 7))
+        self.assertTrue(7 in queue)
+        queue.pop_nearest()
+        self.assertFalse(7 in queue)
 
 
 if __name__ == '__main__':
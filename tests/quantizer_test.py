@@ -0,0 +1,74 @@
+import tempfile
+import unittest
+from unittest import mock
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.metric import METRICS
+from merak.point import Point
+from merak.quantizer import ProductQuantizer, ScalarQuantizer
+
+
+class TestQuantizer(unittest.TestCase):
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+        self._vecs = rng.random((300, 16)).astype(np.float32)
+        self._q = rng.random(16).astype(np.float32)
+
+    def test_scalar(self):
+        sq = ScalarQuantizer()
+        sq.train(self._vecs)
+        codes = sq.encode(self._vecs)
+        self.assertEqual(codes.dtype, np.uint8)
+        self.assertEqual(codes.shape, (300, 16))
+        self.assertLess(np.abs(sq.decode(codes) - self._vecs).max(), 1 / 255)
+
+    def test_product_table(self):
+        pq = ProductQuantizer(4, centroids=32)
+        pq.train(self._vecs)
+        self.assertEqual(pq.code_size, 4)
+        codes = pq.encode(self._vecs)
+        self.assertEqual(codes.shape, (300, 4))
+        self.assertEqual(pq.encode(self._vecs[0]).shape, (4,))
+        # table lookups equal the distances to the decoded vectors
+        decoded = pq.decode(codes)
+        for name, metric in METRICS.items():
+            expected = metric.one_to_many(self._q, decoded)
+            self.assertTrue(np.allclose(pq.table(self._q, metric).distances(codes), expected, atol=1e-4), name)
+        with self.assertRaises(ValueError):
+            ProductQuantizer(5).train(self._vecs)
+
+    def test_search(self):
+        k, ef = 10, 50
+        exact = np.argsort(np.linalg.norm(self._vecs - self._q, axis=1))[:k]
+        for quantizer in (ScalarQuantizer(), ProductQuantizer(8, centroids=64)):
+            hnsw = HNSW(4, quantizer=quantizer)
+            hnsw.train_quantizer(self._vecs)
+            for i, vec in enumerate(self._vecs):
+                hnsw.insert(Point(i, vec), 6, 12, 24, 4)
+            knns = hnsw.knn_search(Point(1000, self._q), k, ef)
+            # re-ranked with full vectors, so results are ordered exactly
+            self.assertEqual([p.id for p in knns], sorted([p.id for p in knns],
+                             key=lambda id: np.linalg.norm(self._vecs[id] - self._q)))
+            recall = len({p.id for p in knns} & set(exact.tolist())) / k
+            self.assertGreaterEqual(recall, 0.8)
+
+    def test_snapshot_codes(self):
+        quantizer = ScalarQuantizer()
+        hnsw = HNSW(4, quantizer=quantizer)
+        hnsw.train_quantizer(self._vecs)
+        for i, vec in enumerate(self._vecs):
+            hnsw.insert(Point(i, vec), 6, 12, 24, 4)
+        with tempfile.TemporaryDirectory() as path:
+            hnsw.save(path)
+            loaded = HNSW.load(path, quantizer=quantizer)
+            self.assertEqual(len(loaded.codes), 300)
+            self.assertTrue(np.array_equal(loaded.codes.gather([0, 7]), hnsw.codes.gather([0, 7])))
+            # the restored codes serve the walk, no point is encoded again
+            with mock.patch.object(quantizer, 'encode', side_effect=AssertionError):
+                knns = loaded.knn_search(Point(1000, self._q), 10, 50)
+        self.assertEqual([p.id for p in knns], [p.id for p in hnsw.knn_search(Point(1000, self._q), 10, 50)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+import time
+import unittest
+import numpy as np
+
+from helpers import build, random_data
+from merak.point import Point
+from merak.result_cache import ResultCache
+
+
+class TestResultCache(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs, queries = random_data(200, 1)
+        self._q = queries[0]
+
+    def test_hits(self):
+        cache = ResultCache(step=0.01)
+        hnsw = build(self._vecs, result_cache=cache)
+        # on the grid, so a small shift rounds to the same key
+        self._q = (np.round(self._q / 0.01) * 0.01).astype(np.float32)
+        expected = [p.id for p in hnsw.knn_search(Point(-1, self._q), 5, 32)]
+        self.assertEqual(cache.misses, 1)
+        # identical and near identical queries hit
+        for vec in (self._q, self._q + 0.001):
+            self.assertEqual([p.id for p in hnsw.knn_search(Point(-1, vec), 5, 32)], expected)
+        self.assertEqual(cache.hits, 2)
+        # a different ef, filter or a larger k miss
+        hnsw.knn_search(Point(-1, self._q), 5, 16)
+        hnsw.knn_search(Point(-1, self._q), 5, 32, filter=list(range(100)))
+        hnsw.knn_search(Point(-1, self._q), 10, 32)
+        self.assertEqual(cache.misses, 4)
+        hnsw.knn_search(Point(-1, self._q), 5, 32, filter=list(range(100)))
+        self.assertEqual(cache.hits, 3)
+
+        # any write invalidates
+        hnsw.delete(expected[0])
+        found = [p.id for p in hnsw.knn_search(Point(-1, self._q), 5, 32)]
+        self.assertNotIn(expected[0], found)
+        self.assertEqual(cache.misses, 5)
+
+    def test_superset(self):
+        cache = ResultCache(superset=True)
+        hnsw = build(self._vecs, result_cache=cache)
+        first = [p.id for p in hnsw.knn_search(Point(-1, self._q), 5, 32)]
+        second = [p.id for p in hnsw.knn_search(Point(-1, self._q), 20, 32)]
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(second[:5], first)
+        self.assertEqual(len(second), 20)
+
+    def test_eviction(self):
+        cache = ResultCache(max_entries=2, ttl=0.05)
+        points = [Point(i, vec) for i, vec in enumerate(self._vecs[:3])]
+        for p in points:
+            cache.put(cache.key(p.vec, 10, None), 0, [p], 1)
+        self.assertIsNone(cache.get(cache.key(points[0].vec, 10, None), 1, 0))
+        self.assertEqual(cache.get(cache.key(points[2].vec, 10, None), 1, 0), [points[2]])
+        # stale versions and expired entries miss
+        self.assertIsNone(cache.get(cache.key(points[1].vec, 10, None), 1, 1))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(cache.key(points[2].vec, 10, None), 1, 0))
+        self.assertEqual(len(cache), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
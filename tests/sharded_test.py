@@ -0,0 +1,50 @@
+import unittest
+import numpy as np
+
+from helpers import random_data
+from merak.hnsw import HNSW
+from merak.point import Point
+from merak.sharded import ShardedHNSW
+
+
+class TestShardedHNSW(unittest.TestCase):
+    def setUp(self) -> None:
+        self._vecs, self._queries = random_data(400, 20)
+        self._points = [Point(i, vec) for i, vec in enumerate(self._vecs)]
+
+    def _exact(self, q, k):
+        return np.argsort(np.linalg.norm(self._vecs - q, axis=1), kind='stable')[:k].tolist()
+
+    def test_partition(self):
+        sharded = ShardedHNSW.memory(3, 4, partition='range', bounds=[100, 250])
+        self.assertEqual([sharded.shard_of(id) for id in (0, 99, 100, 249, 250, 399)], [0, 0, 1, 1, 2, 2])
+        sharded.close()
+        with self.assertRaises(ValueError):
+            ShardedHNSW.memory(3, 4, partition='range', bounds=[100])
+        with self.assertRaises(ValueError):
+            ShardedHNSW([HNSW(4, metric='l2'), HNSW(4, metric='ip')])
+
+    def test_search(self):
+        k = 10
+        sharded = ShardedHNSW.memory(4, 4, efs=[1.0, 1.0, 0.5, 0.5])
+        sharded.insert_many(self._points, 6, 12, 32, 4, workers=2)
+        for i, shard in enumerate(sharded.shards):
+            self.assertEqual(sorted(shard.graph.storage.ids()), list(range(i, 400, 4)))
+
+        hits = 0
+        ids, distances = sharded.knn_search_batch(self._queries, k, 64)
+        for q, batch_ids, batch_distances in zip(self._queries, ids, distances):
+            knns = sharded.knn_search(Point(-1, q), k, 64)
+            found = [p.id for p in knns]
+            self.assertEqual(found, batch_ids.tolist())
+            self.assertTrue(np.all(np.diff(batch_distances) >= 0))
+            hits += len(set(found) & set(self._exact(q, k)))
+        self.assertGreaterEqual(hits / (k * len(self._queries)), 0.9)
+
+        sharded.delete(found[0])
+        self.assertNotIn(found[0], [p.id for p in sharded.knn_search(Point(-1, q), k, 64)])
+        sharded.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import tempfile
+import unittest
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.point import Point
+from merak.snapshot import SnapshotStorage, read_manifest
+from merak.storage import MemoryStorage
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self) -> None:
+        self._dir = tempfile.TemporaryDirectory()
+        self._path = os.path.join(self._dir.name, 'snapshot')
+        self._vecs = np.random.random((200, 6)).astype(np.float32)
+        self._hnsw = HNSW(4, metric='l2sq')
+        for i, vec in enumerate(self._vecs):
+            self._hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        self._hnsw.save(self._path)
+
+    def tearDown(self) -> None:
+        self._dir.cleanup()
+
+    def test_manifest(self):
+        manifest = read_manifest(self._path)
+        self.assertEqual(manifest['count'], 200)
+        self.assertEqual(manifest['dim'], 6)
+        self.assertEqual(manifest['metric'], 'l2sq')
+        self.assertEqual((manifest['entry_point'], manifest['top_layer']), self._hnsw.graph.entry())
+        with self.assertRaises(ValueError):
+            read_manifest(self._dir.name)
+
+    def test_load(self):
+        loaded = HNSW.load(self._path)
+        self.assertEqual(loaded.metric.name, 'l2sq')
+        self.assertEqual(loaded.graph.entry(), self._hnsw.graph.entry())
+        self.assertIsInstance(loaded.graph.storage._vectors, np.memmap)
+        for i in range(0, 200, 20):
+            self.assertEqual(loaded.graph.get_neighbor_ids(0, i), self._hnsw.graph.get_neighbor_ids(0, i))
+            q = Point(1000, self._vecs[i])
+            self.assertEqual([p.id for p in loaded.knn_search(q, 5, 16)],
+                             [p.id for p in self._hnsw.knn_search(q, 5, 16)])
+        with self.assertRaises(RuntimeError):
+            loaded.insert(Point(1000, self._vecs[0]), 4, 8, 16, 4)
+
+    def test_base(self):
+        # the original storage holds the whole graph, new writes go there
+        loaded = HNSW.load(self._path, base=self._hnsw.graph.storage)
+        vec = np.full(6, 2, dtype=np.float32)
+        loaded.insert(Point(1000, vec), 4, 8, 16, 4)
+        self.assertEqual(loaded.knn_search(Point(2000, vec), 1, 16)[0].id, 1000)
+        self.assertEqual(len(loaded.graph.storage.ids()), 201)
+        self.assertIsInstance(loaded.graph.storage, SnapshotStorage)
+
+    def test_unlisted_storage(self):
+        class UnlistedStorage(MemoryStorage):
+            # like nebula, the storage can't list its ids
+            listable = False
+            fetched = 0
+
+            def ids(self):
+                raise NotImplementedError
+
+            def get_neighbors_many(self, vids, layer=None):
+                self.fetched += len(vids)
+                return super().get_neighbors_many(vids, layer)
+
+        storage = UnlistedStorage(np.float32)
+        hnsw = HNSW(4, storage)
+        for i, vec in enumerate(self._vecs):
+            hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        storage.fetched = 0
+        hnsw.save(self._path)
+        self.assertEqual(read_manifest(self._path)['count'], 200)
+        # the walk reads edges only, every vector is read once
+        self.assertEqual(storage.fetched, 200)
+        loaded = HNSW.load(self._path)
+        for i in range(0, 200, 20):
+            q = Point(1000, self._vecs[i])
+            self.assertEqual([p.id for p in loaded.knn_search(q, 5, 16)],
+                             [p.id for p in hnsw.knn_search(q, 5, 16)])
+
+    def test_tombstones(self):
+        hnsw = HNSW(4, compact_ratio=1.0)
+        for i, vec in enumerate(self._vecs):
+            hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+        deleted = list(range(0, 200, 10))
+        for id in deleted:
+            hnsw.delete(id)
+        hnsw.save(self._path)
+        loaded = HNSW.load(self._path)
+        self.assertEqual(sorted(loaded.graph.tombstones()), deleted)
+        for id in deleted:
+            knns = loaded.knn_search(Point(1000, self._vecs[id]), 5, 16)
+            self.assertNotIn(id, [p.id for p in knns])
+
+
+if __name__ == '__main__':
+    unittest.main()
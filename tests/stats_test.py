@@ -0,0 +1,63 @@
+import asyncio
+import unittest
+import numpy as np
+
+from merak.hnsw import HNSW
+from merak.point import Point
+from merak.stats import QueryStats, Registry, collect, count, measure
+from merak.storage import MemoryStorage
+
+
+class RemoteMemoryStorage(MemoryStorage):
+    ''' MemoryStorage pretending to be remote, so nodes go through the cache
+    '''
+    remote = True
+
+
+class TestStats(unittest.TestCase):
+    def setUp(self) -> None:
+        self._hnsw = HNSW(4, RemoteMemoryStorage())
+        self._vecs = np.random.random((100, 4))
+        for i, vec in enumerate(self._vecs):
+            self._hnsw.insert(Point(i, vec), 4, 8, 16, 4)
+
+    def test_knn_search(self):
+        stats = QueryStats()
+        knns = self._hnsw.knn_search(Point(1000, self._vecs[0]), 5, 16, stats=stats)
+        self.assertEqual(knns[0].id, 0)
+        self.assertGreater(stats.distance_evals, 0)
+        self.assertGreater(stats.seconds, 0)
+        self.assertIn(0, stats.visited)
+        # the inserts filled the cache, the search mostly hits it
+        self.assertGreater(stats.cache_hits, 0)
+        self.assertGreater(stats.hit_ratio, 0.5)
+        self.assertEqual(stats.round_trips, 0)
+
+        async_stats = QueryStats()
+        asyncio.run(self._hnsw.knn_search_async(Point(1000, self._vecs[0]), 5, 16, stats=async_stats))
+        self.assertEqual(async_stats.distance_evals, stats.distance_evals)
+
+    def test_collect(self):
+        stats = QueryStats()
+        count('distance_evals', 3)
+        with collect(stats):
+            count('distance_evals', 3)
+        count('distance_evals', 3)
+        self.assertEqual(stats.distance_evals, 3)
+
+    def test_registry(self):
+        registry = Registry()
+        for _ in range(2):
+            with measure('knn_search', QueryStats(), registry):
+                count('round_trips', 2)
+        self.assertEqual(registry.snapshot()['knn_search']['calls'], 2)
+        self.assertEqual(registry.snapshot()['knn_search']['round_trips'], 4)
+        text = registry.prometheus()
+        self.assertIn('merak_round_trips_total{operation="knn_search"} 4', text)
+        self.assertIn('merak_call_seconds_count{operation="knn_search"} 2', text)
+        registry.reset()
+        self.assertEqual(registry.snapshot(), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+
+from merak.point import Point
+from merak.storage import MemoryStorage
+
+
+class TestMemoryStorage(unittest.TestCase):
+    def setUp(self) -> None:
+        self._storage = MemoryStorage(degree=2)
+        self._vecs = np.random.random((10, 3)).astype(np.float32)
+        self._storage.write([Point(i, vec) for i, vec in enumerate(self._vecs)],
+                            [(0, 0, dst) for dst in range(1, 10)] + [(1, 0, 1), (0, 1, 0)])
+
+    def test_get_neighbors(self):
+        fetched = self._storage.get_neighbors_many([0, 1, 42])
+        self.assertEqual(set(fetched), {0, 1})
+        vec, neighbors = fetched[0]
+        self.assertTrue(np.array_equal(vec, self._vecs[0]))
+        # the slab grows past its initial width
+        self.assertEqual(neighbors[0], list(range(1, 10)))
+        self.assertEqual(neighbors[1], [1])
+        self.assertEqual(fetched[1][1], {0: [0]})
+
+        fetched = self._storage.get_neighbors_many([0], layer=1)
+        self.assertEqual(fetched[0][1], {1: [1]})
+        self.assertEqual(self._storage.get_edges_many([0, 1, 42]), {0: neighbors, 1: {0: [0]}})
+        self.assertEqual(self._storage.get_edges_many([0, 1], layer=1), {0: {1: [1]}, 1: {}})
+
+    def test_duplicate_edges(self):
+        self._storage.write([], [(0, 1, 0), (0, 1, 2)])
+        self.assertEqual(self._storage.get_neighbors_many([1])[1][1][0], [0, 2])
+
+    def test_set_neighbors(self):
+        self._storage.set_neighbors(0, 0, [3, 4, 5])
+        self.assertEqual(sorted(self._storage.get_neighbors_many([0])[0][1][0]), [3, 4, 5])
+        # other layers are untouched
+        self.assertEqual(self._storage.get_neighbors_many([0])[0][1][1], [1])
+
+    def test_delete(self):
+        # 0 -> 1 on layers 0 and 1, 1 -> 0 on layer 0
+        self.assertEqual(self._storage.delete([1]), {0})
+        fetched = self._storage.get_neighbors_many([0, 1])
+        self.assertEqual(set(fetched), {0})
+        self.assertEqual(fetched[0][1], {0: list(range(2, 10)), 1: []})
+        self.assertEqual(len(self._storage), 9)
+        # the row of 1 is reused
+        self._storage.write([Point(1, self._vecs[1])], [(0, 1, 2)])
+        self.assertEqual(self._storage.get_neighbors_many([1])[1][1], {0: [2]})
+
+
+if __name__ == '__main__':
+    unittest.main()